@@ -2,7 +2,6 @@
 import json
 import logging
 import uuid
-import copy
 import cis_profile
 from botocore.exceptions import ClientError
 from cis_aws import connect
@@ -20,6 +19,9 @@ logger = logging.getLogger(__name__)
 class Vault(object):
     """Handles flushing profiles to Dynamo when running local or in stream bypass mode."""
 
+    # Attributes that CIS updates itself, see _update_attr_owned_by_cis()
+    CIS_OWNED_ATTRIBUTES = ["last_modified", "active"]
+
     def __init__(self, sequence_number=None, profile_json=None, **kwargs):
         self.connection_object = connect.AWS()
         self.identity_vault_client = None
@@ -92,6 +94,13 @@ class Vault(object):
 
         return user
 
+    def _verify_changed_attributes_only(self):
+        """
+        Returns True if only the attributes changed by a merge (and the CIS owned attributes) should be verified when
+        updating a user, as all other attributes were verified when they were stored in the vault
+        """
+        return self.config("verify_changed_attributes_only", namespace="cis", default="false") == "true"
+
     def _search_and_merge(self, user_id, cis_profile_object):
         """
         Search for an existing user in the vault for the given profile
@@ -106,6 +115,15 @@ class Vault(object):
 
         Returns a cis_profile.User object
         """
+        return self._search_and_merge_difference(user_id, cis_profile_object)[0]
+
+    def _search_and_merge_difference(self, user_id, cis_profile_object):
+        """
+        See _search_and_merge()
+
+        Returns a tuple of (cis_profile.User object, list of str names of the attributes whose signature must be
+        verified, or None for all attributes)
+        """
 
         try:
             self._connect()
@@ -125,8 +143,8 @@ class Vault(object):
                 extra={"user_id": user_id},
             )
 
-            old_user_profile = User(user_structure_json=json.loads(res["Items"][0]["profile"]))
-            new_user_profile = copy.deepcopy(old_user_profile)
+            old_user_profile = User(user_structure_json=res["Items"][0]["profile"])
+            new_user_profile = old_user_profile.clone()
             difference = new_user_profile.merge(cis_profile_object)
 
             if (
@@ -146,10 +164,19 @@ class Vault(object):
                         extra={"user_id": user_id}
                     )
                 )
-                return None
+                return (None, None)
             else:
                 logger.info("Differences found during merge: {}".format(difference), extra={"user_id": user_id})
 
+            # Attributes which were not merged in are the ones from the vault, which were verified when stored
+            attribute_names = None
+            if self._verify_changed_attributes_only():
+                attribute_names = difference + [attr for attr in self.CIS_OWNED_ATTRIBUTES if attr not in difference]
+                logger.info(
+                    "Only verifying changed and CIS owned attributes: {}".format(attribute_names),
+                    extra={"user_id": user_id},
+                )
+
             # XXX This is safe but this is not great. Probably should have a route to deactivate since its a CIS
             # attribute.
             if difference == ["active"]:
@@ -158,12 +185,12 @@ class Vault(object):
                     "will enforce this check on it's own'",
                     extra={"user_id": user_id},
                 )
-                return new_user_profile
+                return (new_user_profile, attribute_names)
 
             if self.config("verify_publishers", namespace="cis") == "true":
                 logger.info("Verifying publishers", extra={"user_id": user_id})
                 try:
-                    new_user_profile.verify_all_publishers(old_user_profile)
+                    new_user_profile.verify_all_publishers(old_user_profile, attribute_names=attribute_names)
                 except Exception as e:
                     logger.error(
                         "The merged profile failed to pass publisher verification",
@@ -180,7 +207,7 @@ class Vault(object):
                     "Bypassing profile publisher verification due to `verify_publishers` setting being false",
                     extra={"user_id": user_id},
                 )
-            return new_user_profile
+            return (new_user_profile, attribute_names)
         else:
             # This is a new profile, set uuid and primary_username and verify.
             self.condition = "create"
@@ -226,7 +253,7 @@ class Vault(object):
                     "Bypassing profile publisher verification due to `verify_publishers` setting being false",
                     extra={"user_id": user_id},
                 )
-            return cis_profile_object
+            return (cis_profile_object, None)
 
     def put_profile(self, _profile):
         """
@@ -289,7 +316,7 @@ class Vault(object):
 
             # Ensure we merge user_profile data when we have an existing user in the vault
             # This also does publisher verification
-            current_user = self._search_and_merge(user_id, user_profile)
+            current_user, attribute_names = self._search_and_merge_difference(user_id, user_profile)
             # No difference found, no merging occured, skip!
             if current_user is None:
                 logger.info(
@@ -301,7 +328,10 @@ class Vault(object):
             # Check profile signatures
             if self.config("verify_signatures", namespace="cis") == "true":
                 try:
-                    current_user.verify_all_signatures()
+                    current_user.verify_all_signatures(
+                        workers=self.config("signature_verification_workers", namespace="cis", default="1", parser=int),
+                        attribute_names=attribute_names,
+                    )
                 except Exception as e:
                     logger.error(
                         "The profile failed to pass signature verification for user_id: {}".format(user_id),
@@ -379,9 +409,39 @@ class Vault(object):
                 extra={"profiles": profiles, "error": e, "trace": format_exc()},
             )
             raise IntegrationError({"code": "integration_exception", "description": "{}".format(e)}, 500)
+        except ValueError as e:
+            # None of the transaction chunks of the creates or the updates could be written
+            logger.error(
+                "Could not write these profiles to dynamodb",
+                extra={"profiles": profiles, "error": e, "trace": format_exc()},
+            )
+            raise IntegrationError({"code": "integration_exception", "description": "{}".format(e)}, 500)
         # The result looks something like this:
         # result = {'creates': {'status': '200',
-        # 'sequence_numbers': ['285229813155718975995433494324446866394']}, 'updates': None, 'status': 200}"}
+        # 'sequence_numbers': ['285229813155718975995433494324446866394'], 'failed_ids': []},
+        # 'updates': None, 'status': 200}"}
+        # All profiles of a batch share the same sequence number, failures are reported by user_id (the vault item id)
+        failed = []
+        for res in result:
+            if res is not None:
+                failed.extend(res.get("failed_ids", []))
+
+        if failed and len(failed) == len(profiles):
+            logger.error("None of the profiles could be written to dynamodb", extra={"failed_user_ids": failed})
+            raise IntegrationError(
+                {
+                    "code": "integration_exception",
+                    "description": "No profile could be written, failed user_ids: {}".format(failed),
+                },
+                500,
+            )
+        if failed:
+            # Some profiles were written, the caller retries the failed ones
+            logger.warning(
+                "{} of {} profiles could not be written to dynamodb".format(len(failed), len(profiles)),
+                extra={"failed_user_ids": failed},
+            )
+            return {"creates": result[0], "updates": result[1], "status": 207, "failed_user_ids": failed}
         return {"creates": result[0], "updates": result[1], "status": 200}
 
     def delete_profile(self, profile_json):
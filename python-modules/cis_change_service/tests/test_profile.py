@@ -3,6 +3,7 @@ import json
 import logging
 import os
 import mock
+import pytest
 import random
 import subprocess
 from boto3.dynamodb.conditions import Key
@@ -340,3 +341,80 @@ class TestProfile(object):
     def teardown(self):
         os.killpg(os.getpgid(self.dynaliteprocess.pid), 15)
         self.patcher_salt.stop()
+
+
+class FakeVaultTable(object):
+    name = "local-identity-vault"
+
+
+class FakeVaultClient(object):
+    """An empty vault, which refuses the writes of @failing user ids (and of the rest of their batch)."""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.written = []
+
+    def batch_get_item(self, RequestItems):
+        return {"Responses": {table_name: [] for table_name in RequestItems}}
+
+    def batch_write_item(self, RequestItems):
+        from botocore.exceptions import ClientError
+
+        (table_name, requests), = RequestItems.items()
+        ids = [r["PutRequest"]["Item"]["id"]["S"] for r in requests]
+        if self.failing.intersection(ids):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "invalid"}}, "BatchWriteItem")
+        self.written.extend(ids)
+        return {"UnprocessedItems": {}}
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        from botocore.exceptions import ClientError
+
+        raise ClientError(
+            {
+                "Error": {"Code": "TransactionCanceledException", "Message": "cancelled"},
+                "CancellationReasons": [{"Code": "ConditionalCheckFailed"}],
+            },
+            "TransactWriteItems",
+        )
+
+
+class TestStoreInVault(object):
+    def setup(self):
+        os.environ["AWS_XRAY_SDK_ENABLED"] = "false"
+        os.environ["CIS_ENVIRONMENT"] = "local"
+        os.environ["CIS_CONFIG_INI"] = "tests/mozilla-cis.ini"
+        # The batch writer sends 25 profiles per request, so that a failing profile fails the last 5 profiles
+        self.profiles = [User(user_id="ad|{}".format(i)) for i in range(30)]
+
+    def _store(self, client, transactions=False):
+        from cis_change_service import profile
+
+        v = profile.Vault(sequence_number="1")
+        if transactions:
+            config = v.config
+            v.config = lambda key, **kwargs: "true" if key == "dynamodb_transactions" else config(key, **kwargs)
+        v.identity_vault_client = {"table": FakeVaultTable(), "client": client}
+        with mock.patch.object(profile.Vault, "_connect"):
+            return v._store_in_vault(self.profiles)
+
+    def test_partial_failure(self):
+        client = FakeVaultClient(failing=["ad|29"])
+        res = self._store(client)
+        assert res["status"] == 207
+        # All profiles have the same sequence number, failures are told apart by user_id
+        assert res["failed_user_ids"] == ["ad|{}".format(i) for i in range(25, 30)]
+        assert len(client.written) == 25
+
+        res = self._store(FakeVaultClient())
+        assert res["status"] == 200
+        assert "failed_user_ids" not in res
+
+    def test_nothing_written(self):
+        from cis_change_service.exceptions import IntegrationError
+
+        self.profiles = self.profiles[:3]
+        with pytest.raises(IntegrationError):
+            self._store(FakeVaultClient(failing=["ad|0"]))
+        with pytest.raises(IntegrationError):
+            self._store(FakeVaultClient(), transactions=True)
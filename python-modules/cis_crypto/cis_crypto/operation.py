@@ -1,50 +1,333 @@
+import collections
+import concurrent.futures
+import hashlib
+import itertools
 import json
 import logging
+import math
 import os
+import threading
 import yaml
 from jose import jwk
 from jose import jws
+from jose.backends.base import Key
 from jose.exceptions import JWSError
+from jose.utils import base64url_decode
+from jose.utils import base64url_encode
 from cis_crypto import secret
 from cis_crypto import common
 
 logger = logging.getLogger(__name__)
+
+
+class VerifiedSignatureCache(object):
+    """
+    A bounded LRU cache of successfully verified signatures, so that signatures which were already verified (e.g. those
+    of attributes that did not change since the profile was last seen) are not verified again.
+    Entries are keyed by (keys, publisher, sha256 of the JWS). `keys` identifies the keys the signature was verified
+    with (a KeySet generation, or a public key file and its mtime), so that a keyset change invalidates them.
+    Failed verifications are never cached.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        @max_size int maximum number of entries. Defaults to the verified_signature_cache_size setting, 0 disables the
+        cache
+        """
+        if max_size is None:
+            config = common.get_config()
+            max_size = config("verified_signature_cache_size", namespace="cis", default="10000", parser=int)
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cache_key(keys, publisher, jws_signature, payload=None):
+        """
+        @payload bytes the detached payload of @jws_signature, if any (see sign_detached())
+        """
+        if isinstance(jws_signature, str):
+            jws_signature = jws_signature.encode("utf-8")
+        digest = hashlib.sha256(jws_signature)
+        if payload is not None:
+            digest.update(b".")
+            digest.update(payload)
+        return (keys, publisher, digest.hexdigest())
+
+    def get(self, cache_key):
+        """
+        Returns the verified payload stored under @cache_key (see cache_key()), or None
+        """
+        with self._lock:
+            payload = self._entries.get(cache_key)
+            if payload is not None:
+                self._entries.move_to_end(cache_key)
+            return payload
+
+    def add(self, cache_key, payload):
+        """
+        Stores @payload, the result of a successful verification, under @cache_key (see cache_key())
+        """
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[cache_key] = payload
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+_verified_signatures = None
+_keyset_generations = itertools.count()
+
+
+def get_verified_signature_cache():
+    """
+    Returns the process-wide VerifiedSignatureCache, creating it if needed
+    """
+    global _verified_signatures
+    if _verified_signatures is None:
+        _verified_signatures = VerifiedSignatureCache()
+    return _verified_signatures
+
+
+class KeySet(object):
+    """
+    The public keys of a well-known document (access file and publishers keys), constructed once and indexed by
+    publisher and key id (kid).
+    Use get_keyset() rather than creating these directly, so that keysets are shared.
+    """
+
+    def __init__(self, well_known):
+        """
+        @well_known dict the well-known document (i.e. cis_profile.WellKnown().get_well_known())
+        """
+        # Identifies this keyset in the verified signature cache, unlike id() this is never reused
+        self.generation = next(_keyset_generations)
+        self.access_file_keys = self._index(well_known["access_file"]["jwks"]["keys"])
+        self.publishers_keys = {
+            publisher: self._index(jwks["keys"]) for publisher, jwks in well_known["api"]["publishers_jwks"].items()
+        }
+
+    def _index(self, keys):
+        """
+        Returns {kid: [jose key objects]} for a list of JWK @keys (or a single JWK). Keys without kid have a kid of None
+        """
+        if isinstance(keys, dict):
+            keys = [keys]
+        index = {}
+        for key in keys:
+            kid = key.get("kid")
+            key = {k: v for k, v in key.items() if k not in ["x5t", "x5c"]}
+            index.setdefault(kid, []).append(jwk.construct(key, "RS256"))
+        return index
+
+    def verify(self, jws_signature, publisher=None, payload=None):
+        """
+        Verifies @jws_signature against the key named by its header's kid or, if the signature has no kid, against all
+        keys of @publisher.
+        @jws_signature str a JWS
+        @publisher str a publisher name from the well-known publishers_jwks, or None for the access file keys
+        @payload the payload of a detached @jws_signature (see verify_detached()). Ignored for other signatures.
+        Returns the verified payload or raises JWSError (KeyError for unknown publishers)
+        """
+        if publisher is None:
+            index = self.access_file_keys
+        else:
+            index = self.publishers_keys[publisher]
+
+        payload = _detached_payload(jws_signature, payload)
+        cache = get_verified_signature_cache()
+        cache_key = cache.cache_key(self.generation, publisher, jws_signature, payload)
+        verified = cache.get(cache_key)
+        if verified is not None:
+            return verified
+
+        kid = jws.get_unverified_header(jws_signature).get("kid")
+        if kid is not None:
+            keys = index.get(kid, [])
+        else:
+            logger.debug("Signature has no kid, trying all keys of publisher {}".format(publisher))
+            keys = [key for kid_keys in index.values() for key in kid_keys]
+
+        for key in keys:
+            try:
+                if payload is not None:
+                    verified = verify_detached(jws_signature, payload, key)
+                else:
+                    verified = jws.verify(jws_signature, key, algorithms="RS256", verify=True)
+            except JWSError as e:
+                logger.debug("The signature was not valid for key {} ({})".format(kid, e))
+                continue
+            cache.add(cache_key, verified)
+            return verified
+        raise JWSError("The signature could not be verified for any trusted key", publisher, kid)
+
+
+_keysets = {}
+_keysets_by_digest = {}
+_keysets_lock = threading.Lock()
+
+
+def _keys_digest(well_known):
+    """
+    Returns the sha256 of the keys of @well_known, the only part of the document a KeySet is built from
+    """
+    keys = {"access_file": well_known["access_file"]["jwks"], "publishers": well_known["api"]["publishers_jwks"]}
+    return hashlib.sha256(json.dumps(keys, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def get_keyset(well_known):
+    """
+    Returns the process-wide KeySet of @well_known, creating it if needed.
+    Lookups are by document object first, then by the content of its keys: a refreshed document with the same keys
+    gets the same keyset (and generation), so that verified signatures stay cached until the keys change.
+    @well_known dict the well-known document
+    """
+    entry = _keysets.get(id(well_known))
+    # Also keep the document in the entry: its id cannot be reused by another document while it is cached
+    if entry is not None and entry[0] is well_known:
+        return entry[1]
+
+    digest = _keys_digest(well_known)
+    with _keysets_lock:
+        keyset = _keysets_by_digest.get(digest)
+        if keyset is None:
+            logger.debug("Building the keyset of keys {}".format(digest))
+            keyset = KeySet(well_known)
+            if len(_keysets_by_digest) >= 8:
+                _keysets_by_digest.clear()
+            _keysets_by_digest[digest] = keyset
+        if len(_keysets) >= 8:
+            _keysets.clear()
+        _keysets[id(well_known)] = (well_known, keyset)
+    return keyset
+
+
 # Note:
 # These attrs on sign/verify could be refactored to use object inheritance.  Leaving as is for now for readability.
 
 
+def canonical_payload(payload):
+    """
+    Returns the bytes signed by detached signatures for @payload: its JSON with sorted keys and no whitespace, so that
+    verifiers can rebuild them from the same data
+    @payload dict, or YAML/JSON str (see load_payload()), or bytes as returned by this function
+    """
+    if isinstance(payload, bytes):
+        return payload
+    return json.dumps(load_payload(payload), sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def is_detached(jws_signature):
+    """
+    Returns True if @jws_signature is a compact JWS with a detached (empty) payload section
+    """
+    if isinstance(jws_signature, bytes):
+        jws_signature = jws_signature.decode("utf-8")
+    elif not isinstance(jws_signature, str):
+        return False
+    parts = jws_signature.split(".")
+    return len(parts) == 3 and parts[1] == ""
+
+
+def _detached_payload(jws_signature, payload):
+    """
+    Returns the canonical @payload of a detached @jws_signature, or None if @jws_signature is not detached
+    """
+    if not is_detached(jws_signature):
+        return None
+    if payload is None:
+        raise JWSError("The payload of a detached JWS is required to verify it")
+    return canonical_payload(payload)
+
+
+def sign_detached(payload, key):
+    """
+    Signs @payload with an unencoded, detached payload (RFC 7797): the JWS does not contain the payload, which
+    verifiers rebuild from their own copy of the data. This is the same signature as a regular JWS, minus one base64
+    copy of the payload.
+    @payload dict, or YAML/JSON str (see canonical_payload())
+    @key jose key object, or anything jose.jwk.construct() takes
+    Returns str a compact JWS with an empty payload section: "header..signature"
+    """
+    header = {"alg": "RS256", "b64": False, "crit": ["b64"], "typ": "JWT"}
+    encoded_header = base64url_encode(json.dumps(header, sort_keys=True, separators=(",", ":")).encode("utf-8"))
+    if not isinstance(key, Key):
+        key = jwk.construct(key, "RS256")
+    signature = key.sign(encoded_header + b"." + canonical_payload(payload))
+    return (encoded_header + b".." + base64url_encode(signature)).decode("utf-8")
+
+
+def verify_detached(jws_signature, payload, key):
+    """
+    Verifies a detached @jws_signature (see sign_detached()) of @payload
+    @payload dict, or YAML/JSON str, or bytes (see canonical_payload())
+    @key jose key object, or anything jose.jwk.construct() takes
+    Returns bytes the verified payload, like jose.jws.verify(), or raises JWSError
+    """
+    if isinstance(jws_signature, str):
+        jws_signature = jws_signature.encode("utf-8")
+    try:
+        encoded_header, encoded_payload, encoded_signature = jws_signature.split(b".")
+        header = json.loads(base64url_decode(encoded_header).decode("utf-8"))
+        signature = base64url_decode(encoded_signature)
+    except (ValueError, TypeError) as e:
+        raise JWSError("Invalid detached JWS: {}".format(e))
+    if encoded_payload != b"" or header.get("alg") != "RS256":
+        raise JWSError("Not a RS256 detached JWS")
+    if header.get("b64") is not False or "b64" not in header.get("crit", []):
+        raise JWSError("Not an unencoded payload JWS (RFC 7797)")
+
+    payload = canonical_payload(payload)
+    try:
+        if not isinstance(key, Key):
+            key = jwk.construct(key, "RS256")
+        valid = key.verify(encoded_header + b"." + payload, signature)
+    except Exception as e:
+        raise JWSError(e)
+    if not valid:
+        raise JWSError("Signature verification failed.")
+    return payload
+
+
 class Sign(object):
     def __init__(self):
         self.config = common.get_config()
         self.key_name = self.config("signing_key_name", namespace="cis", default="file")
         self._jwk = None
         self.secret_manager = self.config("secret_manager", namespace="cis", default="file")
+        # Detached payload signatures (see sign_detached()) are opt-in, with the jws_detached_payload setting
+        self.detached = self.config("jws_detached_payload", namespace="cis", default="false") == "true"
         self.payload = None
 
     def load(self, data):
         """Loads a payload to the object and ensures that the thing is serializable."""
-        try:
-            data = yaml.safe_load(data)
-        except yaml.scanner.ScannerError:
-            logger.debug("This file is likely not YAML.  Attempting JSON load.")
-        except AttributeError:
-            logger.debug("This file is likely not YAML.  Attempting JSON load.")
-
-        if isinstance(data, str):
-            data = json.loads(data)
-        else:
-            pass
-
-        self.payload = data
+        self.payload = load_payload(data)
         return self.payload
 
-    def jws(self, keyname=None):
-        """Assumes you loaded a payload.  Returns a jws."""
+    def jws(self, keyname=None, detached=None):
+        """
+        Assumes you loaded a payload.  Returns a jws.
+        @detached bool if True, returns a detached payload JWS (see sign_detached()). Defaults to the
+        jws_detached_payload setting.
+        """
         # Override key name
         if keyname is not None:
             self.key_name = keyname
         key_jwk = self._get_key()
-        sig = jws.sign(self.payload, key_jwk.to_dict(), algorithm="RS256")
+        if detached is None:
+            detached = self.detached
+        if detached:
+            return sign_detached(self.payload, key_jwk)
+        sig = jws.sign(self.payload, key_jwk, algorithm="RS256")
         return sig
 
     def _get_key(self):
@@ -54,6 +337,86 @@ class Sign(object):
         return self._jwk
 
 
+class BatchSign(object):
+    """
+    Signs many payloads in one call, possibly with different keys.
+    Each key is loaded once and used as-is for all its signatures, and dict payloads are not probed for YAML.
+    With processes > 1, signatures are computed by a pool of processes. This requires multiprocessing support, which
+    some environments (such as AWS Lambda) do not provide.
+    """
+
+    def __init__(self, processes=None):
+        """
+        @processes int number of processes to sign with. None or 1 to sign in the current process.
+        """
+        self.config = common.get_config()
+        self.secret_manager = self.config("secret_manager", namespace="cis", default="file")
+        self.detached = self.config("jws_detached_payload", namespace="cis", default="false") == "true"
+        self.processes = processes
+
+    def jws(self, items, detached=None):
+        """
+        @items list of (payload, key_name) tuples. payload is a dict, or a YAML/JSON str (see Sign.load())
+        @detached bool see Sign.jws()
+        Returns list of str JWS, in the same order as @items
+        """
+        if detached is None:
+            detached = self.detached
+        items = [(load_payload(payload), key_name) for payload, key_name in items]
+        if self.processes is None or self.processes <= 1 or len(items) < 2:
+            return _sign_payloads(self.secret_manager, items, detached)
+
+        chunk_size = math.ceil(len(items) / self.processes)
+        chunks = []
+        for start in range(0, len(items), chunk_size):
+            end = start + chunk_size
+            chunks.append(items[start:end])
+        logger.debug("Signing {} payloads with {} processes".format(len(items), len(chunks)))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+            results = executor.map(
+                _sign_payloads, [self.secret_manager] * len(chunks), chunks, [detached] * len(chunks)
+            )
+            return [sig for chunk in results for sig in chunk]
+
+
+def _sign_payloads(secret_manager, items, detached=False):
+    """
+    Signs (payload, key_name) @items with keys from @secret_manager. Runs in pool processes, see BatchSign.
+    """
+    manager = secret.Manager(provider_type=secret_manager)
+    keys = {}
+    sigs = []
+    for payload, key_name in items:
+        key = keys.get(key_name)
+        if key is None:
+            key = keys[key_name] = manager.get_key(key_name=key_name)
+        if detached:
+            sigs.append(sign_detached(payload, key))
+        else:
+            sigs.append(jws.sign(payload, key, algorithm="RS256"))
+    return sigs
+
+
+def load_payload(data):
+    """
+    Returns @data as a serializable payload
+    @data dict, or YAML/JSON str
+    """
+    if isinstance(data, dict):
+        return data
+
+    try:
+        data = yaml.safe_load(data)
+    except yaml.scanner.ScannerError:
+        logger.debug("This file is likely not YAML.  Attempting JSON load.")
+    except AttributeError:
+        logger.debug("This file is likely not YAML.  Attempting JSON load.")
+
+    if isinstance(data, str):
+        data = json.loads(data)
+    return data
+
+
 class Verify(object):
     def __init__(self):
         self.config = common.get_config()
@@ -61,31 +424,47 @@ class Verify(object):
         self.well_known_mode = self.config("well_known_mode", namespace="cis", default="file")
         self.public_key_name = None  # Optional for use with file based well known mode
         self.jws_signature = None
+        self.payload = None  # Payload of detached signatures
         self.well_known = None  # Well known JSON data
 
-    def load(self, jws_signature):
-        """Takes data in the form of a dict() and a JWS sig."""
+    def load(self, jws_signature, payload=None):
+        """
+        Takes data in the form of a dict() and a JWS sig.
+        @payload dict (or YAML/JSON str) the signed data, for detached JWS (see sign_detached()). Attached JWS carry
+        their own payload, this is ignored for them.
+        """
         # Store the original form in the jws_signature attribute
         self.jws_signature = jws_signature
+        self.payload = payload
+
+    def _public_key_path(self):
+        key_dir = self.config(
+            "secret_manager_file_path",
+            namespace="cis",
+            default=("{}/.mozilla-iam/keys/".format(os.path.expanduser("~"))),
+        )
+        key_name = self.config("public_key_name", namespace="cis", default="access-file-key")
+        file_name = "{}".format(key_name)
+        return os.path.join(key_dir, file_name)
 
     def _get_public_key(self, keyname=None):
         """Returns a jwk construct for the public key and mode specified."""
         if self.well_known_mode == "file":
-            key_dir = self.config(
-                "secret_manager_file_path",
-                namespace="cis",
-                default=("{}/.mozilla-iam/keys/".format(os.path.expanduser("~"))),
+            path = self._public_key_path()
+            key_dict = secret.get_key_cache().get(
+                ("file-public", os.path.abspath(path)), lambda: self._load_public_key(path), os.stat(path).st_mtime
             )
-            key_name = self.config("public_key_name", namespace="cis", default="access-file-key")
-            file_name = "{}".format(key_name)
-            fh = open((os.path.join(key_dir, file_name)), "rb")
-            key_content = fh.read()
-            key_construct = jwk.construct(key_content, "RS256")
-            return [key_construct.to_dict()]
+            # jws() modifies the keys it tries
+            return [dict(key_dict)]
         elif self.well_known_mode == "http" or self.well_known_mode == "https":
             logger.debug("Well known mode engaged.  Reducing key structure.", extra={"well_known": self.well_known})
             return self._reduce_keys(keyname)
 
+    def _load_public_key(self, path):
+        with open(path, "rb") as fh:
+            key_content = fh.read()
+        return jwk.construct(key_content, "RS256").to_dict()
+
     def _reduce_keys(self, keyname):
         access_file_keys = self.well_known["access_file"]["jwks"]["keys"]
         publishers_supported = self.well_known["api"]["publishers_jwks"]
@@ -103,6 +482,26 @@ class Verify(object):
 
     def jws(self, keyname=None):
         """Assumes you loaded a payload.  Return the same jws or raise a custom exception."""
+        if self.well_known_mode == "http" or self.well_known_mode == "https":
+            keyset = get_keyset(self.well_known)
+            if "access-file-key" in self.config("public_key_name", namespace="cis"):
+                logger.debug("This is an access file verification.")
+                return keyset.verify(self.jws_signature, payload=self.payload)
+            logger.debug("Publisher based verification for: {}".format(keyname))
+            return keyset.verify(self.jws_signature, keyname, payload=self.payload)
+
+        payload = _detached_payload(self.jws_signature, self.payload)
+
+        cache = get_verified_signature_cache()
+        cache_key = None
+        if self.well_known_mode == "file":
+            path = self._public_key_path()
+            keys = ("file", os.path.abspath(path), os.stat(path).st_mtime)
+            cache_key = cache.cache_key(keys, None, self.jws_signature, payload)
+            sig = cache.get(cache_key)
+            if sig is not None:
+                return sig
+
         key_material = self._get_public_key(keyname)
 
         logger.debug(
@@ -120,10 +519,15 @@ class Verify(object):
 
                 logger.debug("Attempting to match against: {}".format(key))
                 try:
-                    sig = jws.verify(self.jws_signature, key, algorithms="RS256", verify=True)
+                    if payload is not None:
+                        sig = verify_detached(self.jws_signature, payload, key)
+                    else:
+                        sig = jws.verify(self.jws_signature, key, algorithms="RS256", verify=True)
                     logger.debug(
                         "Matched a verified signature for: {}".format(key), extra={"signature": self.jws_signature}
                     )
+                    if cache_key is not None:
+                        cache.add(cache_key, sig)
                     return sig
                 except JWSError as e:
                     logger.error(
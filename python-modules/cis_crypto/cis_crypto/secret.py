@@ -3,6 +3,8 @@ import boto3
 import json
 import os
 import logging
+import random
+import threading
 import time
 from cis_crypto import common
 from jose import jwk
@@ -12,6 +14,232 @@ from botocore.exceptions import ClientError
 logger = logging.getLogger(__name__)
 
 
+class KeyCache(object):
+    """
+    Thread-safe, process-wide cache of parsed keys (jose jwk objects), so that each key is loaded and parsed once per
+    process rather than once per Sign/Verify operation.
+    Entries expire after `secret_manager_cache_ttl` seconds (default 3600) so that rotated keys are picked up.
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get(self, cache_key, load, version=None):
+        """
+        Returns the cached key for @cache_key, calling @load() to load it if it is not cached or has expired
+        @cache_key hashable identifier of the key, e.g. ("file", "/path/to/key.pem")
+        @load function returning the key
+        @version anything identifying the key's current version (e.g. file modification time). The key is reloaded
+        when it changes.
+        """
+        entry = self._keys.get(cache_key)
+        if entry is not None and entry[0] > time.time() and entry[1] == version:
+            return entry[2]
+
+        # Only one thread loads a given key, the others wait for it
+        with self._lock:
+            key_lock = self._locks.setdefault(cache_key, threading.Lock())
+        with key_lock:
+            entry = self._keys.get(cache_key)
+            if entry is not None and entry[0] > time.time() and entry[1] == version:
+                return entry[2]
+            key = load()
+            ttl = common.get_config()("secret_manager_cache_ttl", namespace="cis", default="3600", parser=int)
+            self._keys[cache_key] = (time.time() + ttl, version, key)
+            return key
+
+    def clear(self):
+        """
+        Drops all cached keys
+        """
+        with self._lock:
+            self._keys = {}
+
+
+_key_cache = KeyCache()
+
+
+def get_key_cache():
+    """
+    Returns the process-wide KeyCache
+    """
+    return _key_cache
+
+
+class SecretCache(object):
+    """
+    Thread-safe, process-wide cache of AWS SSM parameter store secrets (decrypted parameter values), shared by all
+    secret managers of a region (see get_secret_cache()).
+    - Secrets which are not cached are fetched together, with one get_parameters call per 10 names
+    - Cached secrets are refreshed in the background once `secret_manager_cache_refresh` (default 0.8) of their TTL
+    (`secret_manager_cache_ttl`, default 3600 seconds) has passed, so that callers do not wait for SSM
+    - SSM errors (such as throttling) are retried up to `secret_manager_ssm_retries` (default 8) times with exponential
+    backoff and full jitter, starting at `secret_manager_ssm_backoff` (default 0.5) seconds
+    Set `secret_manager_ssm_endpoint_url` to use a local stand-in for SSM.
+    """
+
+    # get_parameters limit
+    MAX_NAMES_PER_CALL = 10
+    MAX_BACKOFF = 30
+
+    def __init__(self, region_name=None, ssm_client=None):
+        """
+        @region_name str AWS region, defaults to the `secret_manager_ssm_region` setting
+        @ssm_client boto3 SSM client to use instead of creating one
+        """
+        config = common.get_config()
+        if region_name is None:
+            region_name = config("secret_manager_ssm_region", namespace="cis", default="us-west-2")
+        self.region_name = region_name
+        self.endpoint_url = config("secret_manager_ssm_endpoint_url", namespace="cis", default="") or None
+        self.ttl = config("secret_manager_cache_ttl", namespace="cis", default="3600", parser=int)
+        refresh = config("secret_manager_cache_refresh", namespace="cis", default="0.8", parser=float)
+        self.refresh_after = self.ttl * refresh
+        self.retries = config("secret_manager_ssm_retries", namespace="cis", default="8", parser=int)
+        self.backoff = config("secret_manager_ssm_backoff", namespace="cis", default="0.5", parser=float)
+        self._ssm_client = ssm_client
+        # {name: (fetch time, value)}
+        self._secrets = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        # Only one thread fetches missing secrets at a time, the others wait for it
+        self._fetch_lock = threading.Lock()
+
+    @property
+    def ssm_client(self):
+        if self._ssm_client is None:
+            session = boto3.session.Session(region_name=self.region_name)
+            self._ssm_client = session.client("ssm", endpoint_url=self.endpoint_url)
+        return self._ssm_client
+
+    def get(self, name):
+        """
+        Returns the value of the SSM parameter @name
+        @name str full parameter name, e.g. "/iam/uuid_salt"
+        Raises KeyError if the parameter does not exist, botocore.exceptions.ClientError if SSM keeps failing
+        """
+        return self.get_many([name])[name]
+
+    def get_many(self, names, optional=None):
+        """
+        Returns {name: value} of the SSM parameters @names, fetching all uncached ones in as few calls as possible
+        @names list of str full parameter names
+        @optional list of str names from @names which may not exist. These are left out of the result.
+        Raises KeyError if any other parameter does not exist, botocore.exceptions.ClientError if SSM keeps failing
+        """
+        required = [name for name in names if name not in (optional or [])]
+        secrets, stale = self._cached(names)
+        if len(stale) > 0:
+            self._refresh_in_background(stale)
+
+        # Optional parameters are only fetched along with required ones
+        if any(name not in secrets for name in required):
+            with self._fetch_lock:
+                secrets, _ = self._cached(names)
+                if any(name not in secrets for name in required):
+                    secrets.update(self._fetch([name for name in names if name not in secrets]))
+
+        missing = [name for name in required if name not in secrets]
+        if len(missing) > 0:
+            raise KeyError("SSM parameters not found", missing)
+        return secrets
+
+    def clear(self):
+        """
+        Drops all cached secrets
+        """
+        with self._lock:
+            self._secrets = {}
+
+    def _cached(self, names):
+        """
+        Returns ({name: value} of cached and unexpired @names, list of names due for a refresh)
+        """
+        now = time.time()
+        secrets = {}
+        stale = []
+        for name in names:
+            entry = self._secrets.get(name)
+            if entry is None or now - entry[0] >= self.ttl:
+                continue
+            secrets[name] = entry[1]
+            if now - entry[0] >= self.refresh_after:
+                stale.append(name)
+        return (secrets, stale)
+
+    def _fetch(self, names):
+        """
+        Fetches and caches @names from SSM
+        Returns {name: value} of the parameters that exist
+        """
+        secrets = {}
+        for start in range(0, len(names), self.MAX_NAMES_PER_CALL):
+            end = start + self.MAX_NAMES_PER_CALL
+            response = self._get_parameters(names[start:end])
+            now = time.time()
+            with self._lock:
+                for parameter in response.get("Parameters", []):
+                    self._secrets[parameter["Name"]] = (now, parameter["Value"])
+                    secrets[parameter["Name"]] = parameter["Value"]
+            if len(response.get("InvalidParameters", [])) > 0:
+                logger.error("SSM parameters not found: {}".format(response["InvalidParameters"]))
+        return secrets
+
+    def _get_parameters(self, names):
+        attempt = 0
+        while True:
+            try:
+                logger.debug("Secret manager SSM provider loading: {}".format(names))
+                return self.ssm_client.get_parameters(Names=names, WithDecryption=True)
+            except ClientError as e:
+                if attempt >= self.retries:
+                    logger.error("Failed to fetch secrets due to: {} (after {} retries)".format(e, attempt))
+                    raise
+                backoff = random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt))
+                attempt = attempt + 1
+                logger.debug("Backing-off: fetch secrets due to: {} retry {} backoff {}".format(e, attempt, backoff))
+                time.sleep(backoff)
+
+    def _refresh_in_background(self, names):
+        with self._lock:
+            names = [name for name in names if name not in self._refreshing]
+            self._refreshing.update(names)
+        if len(names) > 0:
+            thread = threading.Thread(target=self._refresh, args=(names,), name="cis_crypto_secret_refresh")
+            thread.daemon = True
+            thread.start()
+
+    def _refresh(self, names):
+        try:
+            self._fetch(names)
+        except Exception as e:
+            # Cached values are used until they expire
+            logger.warning("Failed to refresh secrets {} due to: {}".format(names, e))
+        finally:
+            with self._lock:
+                self._refreshing.difference_update(names)
+
+
+_secret_caches = {}
+_secret_caches_lock = threading.Lock()
+
+
+def get_secret_cache(region_name=None):
+    """
+    Returns the process-wide SecretCache of @region_name, creating it if needed
+    @region_name str AWS region, defaults to the `secret_manager_ssm_region` setting
+    """
+    if region_name is None:
+        region_name = common.get_config()("secret_manager_ssm_region", namespace="cis", default="us-west-2")
+    with _secret_caches_lock:
+        cache = _secret_caches.get(region_name)
+        if cache is None:
+            cache = _secret_caches[region_name] = SecretCache(region_name)
+        return cache
+
+
 class Manager(object):
     """Top level manager object.  Will instantiate the appropriate provider based on configuration."""
 
@@ -44,11 +272,14 @@ class FileProvider(object):
             default=("{}/.mozilla-iam/keys/".format(os.path.expanduser("~"))),
         )
         file_name = "{}".format(key_name)
-        logger.debug("Secret manager file provider loading key file: {}/{}".format(key_dir, key_name))
-        fh = open((os.path.join(key_dir, file_name)), "rb")
-        key_content = fh.read()
-        key_construct = jwk.construct(key_content, "RS256")
-        return key_construct
+        path = os.path.join(key_dir, file_name)
+        return get_key_cache().get(("file", os.path.abspath(path)), lambda: self._load(path), os.stat(path).st_mtime)
+
+    def _load(self, path):
+        logger.debug("Secret manager file provider loading key file: {}".format(path))
+        with open(path, "rb") as fh:
+            key_content = fh.read()
+        return jwk.construct(key_content, "RS256")
 
 
 class AWSParameterstoreProvider(object):
@@ -57,71 +288,27 @@ class AWSParameterstoreProvider(object):
     def __init__(self):
         self.config = common.get_config()
         self.region_name = self.config("secret_manager_ssm_region", namespace="cis", default="us-west-2")
-        self.boto_session = boto3.session.Session(region_name=self.region_name)
-        self.ssm_client = self.boto_session.client("ssm")
-        self._cache = {}
 
     def key(self, key_name):
-        retries = 30
-        backoff = 1
-        result = None
-
-        if "key_construct" in self._cache:
-            logger.debug("Returning memory-cached version of the parameter key_construct")
-            return self._cache["key_construct"]
-
-        while result is None:
-            try:
-                ssm_namespace = self.config("secret_manager_ssm_path", namespace="cis", default="/iam")
-                ssm_response = self.ssm_client.get_parameter(
-                    Name="{}/{}".format(ssm_namespace, key_name), WithDecryption=True
-                )
-                logger.debug("Secret manager SSM provider loading key: {}:{}".format(ssm_namespace, key_name))
-                result = ssm_response.get("Parameter")
-            except ClientError as e:
-                retries = retries - 1
-                backoff = backoff + 1
-                time.sleep(backoff)
-                logger.debug("Backing-off: fetch secret due to: {} retries {} backoff {}".format(e, retries, backoff))
-            if retries <= 0:
-                break
-
-        if result is None:
-            logger.error("Failed to fetch secret due to: retries {} backoff {}".format(retries, backoff))
+        ssm_namespace = self.config("secret_manager_ssm_path", namespace="cis", default="/iam")
+        return get_key_cache().get(
+            ("aws-ssm", self.region_name, "{}/{}".format(ssm_namespace, key_name)),
+            lambda: self._load(ssm_namespace, key_name),
+        )
 
+    def _load(self, ssm_namespace, key_name):
+        value = get_secret_cache(self.region_name).get("{}/{}".format(ssm_namespace, key_name))
         try:
-            key_dict = json.loads(result.get("Value"))
+            key_dict = json.loads(value)
             key_construct = jwk.construct(key_dict, "RS256")
         except json.decoder.JSONDecodeError:
-            key_construct = jwk.construct(result.get("Value"), "RS256")
-        self._cache["key_construct"] = key_construct
+            key_construct = jwk.construct(value, "RS256")
         return key_construct
 
     def uuid_salt(self):
-        retries = 30
-        backoff = 1
-        result = None
-
-        if "uuid_salt" in self._cache:
-            logger.debug("Returning memory-cached version of uuid_salt")
-            return self._cache["uuid_salt"]
-
-        while result is None:
-            try:
-                ssm_path = self.config("secret_manager_ssm_uuid_salt", namespace="cis", default="/iam")
-                ssm_response = self.ssm_client.get_parameter(Name=ssm_path, WithDecryption=True)
-                result = ssm_response.get("Parameter").get("Value")
-                logger.debug("Secret manager SSM provider loading uuid_salt: {}".format(ssm_path))
-            except ClientError as e:
-                retries = retries - 1
-                backoff = backoff + 1
-                logger.debug("Backing-off: fetch secret due to: {} retries {} backoff {}".format(e, retries, backoff))
-                time.sleep(backoff)
-            if retries <= 0:
-                break
-
-        if result is None:
-            logger.error("Failed to fetch uuid_salt due to: retries {} backoff {}".format(retries, backoff))
-
-        self._cache["uuid_salt"] = result
-        return result
+        ssm_path = self.config("secret_manager_ssm_uuid_salt", namespace="cis", default="/iam")
+        try:
+            return get_secret_cache(self.region_name).get(ssm_path)
+        except KeyError as e:
+            logger.error("Failed to fetch uuid_salt due to: {}".format(e))
+            return None
@@ -161,6 +161,65 @@ class TestOperation(object):
         with pytest.raises(JWSError):
             o.jws()
 
+    def test_detached_sign_verify_operation(self):
+        from cis_crypto import operation
+        from jose.exceptions import JWSError
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = "tests/fixture"
+        os.environ["CIS_SECRET_MANAGER"] = "file"
+        os.environ["CIS_SIGNING_KEY_NAME"] = "fake-access-file-key.priv.pem"
+        os.environ["CIS_PUBLIC_KEY_NAME"] = "fake-access-file-key.pub.pem"
+        os.environ["CIS_WELL_KNOWN_MODE"] = "file"
+
+        sample_payload = {"values": {"my blog": "https://example.net/blog"}, "metadata": {"verified": False}}
+        s = operation.Sign()
+        s.load(sample_payload)
+        attached = s.jws()
+        sig = s.jws(detached=True)
+        assert operation.is_detached(sig)
+        assert not operation.is_detached(attached)
+        assert len(sig) < len(attached)
+
+        o = operation.Verify()
+        # Key order does not matter
+        reordered = {"metadata": {"verified": False}, "values": {"my blog": "https://example.net/blog"}}
+        o.load(sig, payload=json.dumps(reordered))
+        assert json.loads(o.jws()) == sample_payload
+        # Attached signatures ignore the payload
+        o.load(attached, payload={"values": {}})
+        assert json.loads(o.jws()) == sample_payload
+
+        for payload in [{"values": {"my blog": "https://example.net/evil"}, "metadata": {"verified": False}}, None]:
+            o.load(sig, payload=payload)
+            with pytest.raises(JWSError):
+                o.jws()
+
+        # Detached signatures need an unencoded payload (RFC 7797) header
+        header, _, signature = attached.split(".")
+        o.load("{}..{}".format(header, signature), payload=sample_payload)
+        with pytest.raises(JWSError):
+            o.jws()
+
+    def test_detached_batch_sign_keyset(self):
+        from cis_crypto import operation
+        from jose.exceptions import JWSError
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = "tests/fixture"
+        os.environ["CIS_SECRET_MANAGER"] = "file"
+
+        with open("tests/fixture/fake-well-known.json") as fd:
+            fake_wk = json.loads(fd.read())
+        keyset = operation.get_keyset(fake_wk)
+
+        payloads = [{"value": "test{}".format(i)} for i in range(3)]
+        sigs = operation.BatchSign().jws([(p, "fake-publisher-key_0.priv.pem") for p in payloads], detached=True)
+        for payload, sig in zip(payloads, sigs):
+            assert operation.is_detached(sig)
+            assert json.loads(keyset.verify(sig, "hris", payload=payload)) == payload
+            # A verified signature is only cached with its payload
+            with pytest.raises(JWSError):
+                keyset.verify(sig, "hris", payload={"value": "other"})
+
     def test_sign_verify_operation_jwks(self):
         # This test is a sign + verify operation with fake local keys ("full chain" test)
         from cis_crypto import operation
@@ -236,3 +295,144 @@ class TestOperation(object):
         assert key_material is not None
         res = json.loads(o.jws(keyname="mozilliansorg"))
         assert isinstance(res, dict) is True
+
+    def test_keyset(self):
+        from cis_crypto import operation
+        from jose import jwk
+        from jose import jws
+        from jose.exceptions import JWSError
+
+        with open("tests/fixture/fake-well-known.json") as fd:
+            fake_wk = json.loads(fd.read())
+        with open("tests/fixture/fake-publisher-key_0.priv.jwk") as fd:
+            fake_jwk_priv = jwk.construct(json.loads(fd.read()), "RS256").to_dict()
+        with open("tests/fixture/evil-signing-key.priv.pem") as fd:
+            evil_jwk_priv = jwk.construct(fd.read(), "RS256").to_dict()
+
+        keyset = operation.get_keyset(fake_wk)
+        assert operation.get_keyset(fake_wk) is keyset
+
+        payload = {"value": "test"}
+        with_kid = jws.sign(payload, fake_jwk_priv, headers={"kid": "FakeId"}, algorithm="RS256")
+        without_kid = jws.sign(payload, fake_jwk_priv, algorithm="RS256")
+        unknown_kid = jws.sign(payload, fake_jwk_priv, headers={"kid": "UnknownId"}, algorithm="RS256")
+        evil = jws.sign(payload, evil_jwk_priv, headers={"kid": "FakeId"}, algorithm="RS256")
+
+        assert json.loads(keyset.verify(with_kid, "hris")) == payload
+        assert json.loads(keyset.verify(without_kid, "hris")) == payload
+        with pytest.raises(JWSError):
+            keyset.verify(unknown_kid, "hris")
+        with pytest.raises(JWSError):
+            keyset.verify(evil, "hris")
+        with pytest.raises(KeyError):
+            keyset.verify(with_kid, "not-a-publisher")
+
+        # The well-known document is not modified
+        assert "x5c" in fake_wk["api"]["publishers_jwks"]["hris"]["keys"][0]
+
+    def test_verified_signature_cache(self):
+        from cis_crypto import operation
+        from jose import jwk
+        from jose import jws
+        from jose.exceptions import JWSError
+        from unittest import mock
+
+        with open("tests/fixture/fake-well-known.json") as fd:
+            fake_wk = json.loads(fd.read())
+        with open("tests/fixture/fake-publisher-key_0.priv.jwk") as fd:
+            fake_jwk_priv = jwk.construct(json.loads(fd.read()), "RS256").to_dict()
+        with open("tests/fixture/evil-signing-key.priv.pem") as fd:
+            evil_jwk_priv = jwk.construct(fd.read(), "RS256").to_dict()
+
+        payload = {"value": "cached"}
+        sig = jws.sign(payload, fake_jwk_priv, headers={"kid": "FakeId"}, algorithm="RS256")
+        evil = jws.sign(payload, evil_jwk_priv, headers={"kid": "FakeId"}, algorithm="RS256")
+        keyset = operation.get_keyset(fake_wk)
+        assert json.loads(keyset.verify(sig, "hris")) == payload
+
+        with mock.patch("cis_crypto.operation.jws.verify", wraps=jws.verify) as verify:
+            # Already verified with this keyset and publisher
+            assert json.loads(keyset.verify(sig, "hris")) == payload
+            assert verify.call_count == 0
+            # Other publishers do not share entries
+            assert json.loads(keyset.verify(sig, "ldap")) == payload
+            assert verify.call_count == 1
+            # Failures are not cached
+            for _ in range(2):
+                with pytest.raises(JWSError):
+                    keyset.verify(evil, "hris")
+            calls = verify.call_count
+            # A refreshed well-known document with the same keys keeps the keyset and its cached signatures
+            refreshed_wk = json.loads(json.dumps(fake_wk))
+            refreshed_wk["api"]["endpoint"] = "https://refreshed.example.com/"
+            assert operation.get_keyset(refreshed_wk) is keyset
+            assert json.loads(keyset.verify(sig, "hris")) == payload
+            assert verify.call_count == calls
+            # A new keyset (i.e. the keys changed) verifies again
+            rotated_wk = json.loads(json.dumps(fake_wk))
+            rotated_wk["api"]["publishers_jwks"]["rotated"] = rotated_wk["api"]["publishers_jwks"]["hris"]
+            keyset = operation.get_keyset(rotated_wk)
+            assert json.loads(keyset.verify(sig, "hris")) == payload
+            assert verify.call_count == calls + 1
+
+    def test_verified_signature_cache_size(self):
+        from cis_crypto import operation
+
+        cache = operation.VerifiedSignatureCache(max_size=2)
+        keys = [cache.cache_key(0, "hris", "sig{}".format(i)) for i in range(3)]
+        cache.add(keys[0], b"0")
+        cache.add(keys[1], b"1")
+        assert cache.get(keys[0]) == b"0"
+        cache.add(keys[2], b"2")
+        # keys[1] was the least recently used
+        assert len(cache) == 2
+        assert cache.get(keys[1]) is None
+        assert cache.get(keys[0]) == b"0"
+        assert cache.get(keys[2]) == b"2"
+
+        disabled = operation.VerifiedSignatureCache(max_size=0)
+        disabled.add(keys[0], b"0")
+        assert disabled.get(keys[0]) is None
+
+    def test_batch_sign_operation(self):
+        from cis_crypto import operation
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = "tests/fixture"
+        os.environ["CIS_SECRET_MANAGER"] = "file"
+        os.environ["CIS_SIGNING_KEY_NAME"] = "fake-access-file-key.priv.pem"
+
+        items = [
+            ({"value": "test"}, "fake-access-file-key.priv.pem"),
+            ('{"value": "test"}', "fake-access-file-key.priv.pem"),
+            ({"value": "test"}, "fake-publisher-key_0.priv.pem"),
+        ]
+        sigs = operation.BatchSign().jws(items)
+        assert len(sigs) == 3
+        assert sigs[0] == sigs[1]
+        assert sigs[0] != sigs[2]
+
+        o = operation.Sign()
+        o.load({"value": "test"})
+        assert sigs[0] == o.jws()
+
+        # Same results with a pool of processes
+        assert operation.BatchSign(processes=2).jws(items) == sigs
+
+    def test_batch_sign_operation_benchmark(self):
+        from cis_crypto import operation
+        import time
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = "tests/fixture"
+        os.environ["CIS_SECRET_MANAGER"] = "file"
+
+        items = [({"value": "test{}".format(i)}, "fake-access-file-key.priv.pem") for i in range(200)]
+        for processes in [1, 2]:
+            start = time.time()
+            operation.BatchSign(processes=processes).jws(items)
+            taken = time.time() - start
+            print(
+                "test_batch_sign_operation_benchmark() has taken {} seconds to sign {} payloads with {} process(es), "
+                "or {} signatures per second per process".format(
+                    taken, len(items), processes, len(items) / taken / processes
+                )
+            )
@@ -3,6 +3,7 @@ import json
 import os
 import pytest
 import logging
+import threading
 
 from jose import jwk
 from moto import mock_ssm
@@ -11,6 +12,29 @@ logging.basicConfig(level=logging.INFO, format="%(asctime)s:%(levelname)s:%(name
 logger = logging.getLogger(__name__)
 
 
+class FakeSSM(object):
+    """
+    A local stand-in for the SSM client, which counts calls and fails the first @failures of them
+    """
+
+    def __init__(self, parameters, failures=0):
+        self.parameters = parameters
+        self.failures = failures
+        self.calls = []
+
+    def get_parameters(self, Names, WithDecryption):
+        from botocore.exceptions import ClientError
+
+        self.calls.append(Names)
+        if self.failures > 0:
+            self.failures = self.failures - 1
+            raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, "GetParameters")
+        return {
+            "Parameters": [{"Name": name, "Value": self.parameters[name]} for name in Names if name in self.parameters],
+            "InvalidParameters": [name for name in Names if name not in self.parameters],
+        }
+
+
 class TestSecretManager(object):
     def test_file_provider(self):
         from cis_crypto import secret
@@ -20,6 +44,137 @@ class TestSecretManager(object):
         key_material = manager.get_key("fake-access-file-key.priv.pem")
         assert key_material is not None
 
+    def test_file_provider_key_cache(self):
+        from cis_crypto import secret
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = "tests/fixture"
+        key_material = secret.Manager(provider_type="file").get_key("fake-access-file-key.priv.pem")
+        assert secret.Manager(provider_type="file").get_key("fake-access-file-key.priv.pem") is key_material
+        assert secret.FileProvider().key("fake-publisher-key_0.priv.pem") is not key_material
+
+    def test_file_provider_key_rotation(self, tmpdir):
+        import shutil
+        from cis_crypto import secret
+
+        os.environ["CIS_SECRET_MANAGER_FILE_PATH"] = str(tmpdir)
+        path = os.path.join(str(tmpdir), "key.pem")
+        shutil.copy("tests/fixture/fake-access-file-key.priv.pem", path)
+        old_key = secret.FileProvider().key("key.pem")
+        assert secret.FileProvider().key("key.pem") is old_key
+
+        # Replaced key file
+        shutil.copy("tests/fixture/fake-publisher-key_0.priv.pem", path)
+        os.utime(path, (0, 0))
+        new_key = secret.FileProvider().key("key.pem")
+        assert new_key.to_dict() != old_key.to_dict()
+
+        # Expired key
+        os.environ["CIS_SECRET_MANAGER_CACHE_TTL"] = "0"
+        try:
+            secret.get_key_cache().clear()
+            assert secret.FileProvider().key("key.pem") is not secret.FileProvider().key("key.pem")
+        finally:
+            del os.environ["CIS_SECRET_MANAGER_CACHE_TTL"]
+
+    def test_key_cache_threads(self):
+        import threading
+        import time
+        from cis_crypto import secret
+
+        cache = secret.KeyCache()
+        loads = []
+
+        def load():
+            loads.append(1)
+            time.sleep(0.1)
+            return object()
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get("key", load))) for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(loads) == 1
+        assert len(set(id(r) for r in results)) == 1
+
+    def test_secret_cache_batching(self):
+        from cis_crypto import secret
+
+        ssm = FakeSSM({"/iam/secret{}".format(i): "value{}".format(i) for i in range(12)})
+        cache = secret.SecretCache(ssm_client=ssm)
+        names = sorted(ssm.parameters.keys())
+        assert cache.get_many(names) == ssm.parameters
+        # get_parameters takes up to 10 names
+        assert [len(call) for call in ssm.calls] == [10, 2]
+        assert cache.get("/iam/secret3") == "value3"
+        assert len(ssm.calls) == 2
+
+        with pytest.raises(KeyError):
+            cache.get("/iam/not-a-secret")
+        assert len(ssm.calls) == 3
+        # Optional secrets are fetched along with required ones only
+        assert cache.get_many(["/iam/secret0", "/iam/not-a-secret"], optional=["/iam/not-a-secret"]) == {
+            "/iam/secret0": "value0"
+        }
+        assert len(ssm.calls) == 3
+
+    def test_secret_cache_backoff(self):
+        from botocore.exceptions import ClientError
+        from cis_crypto import secret
+        from unittest import mock
+
+        ssm = FakeSSM({"/iam/secret": "value"}, failures=3)
+        cache = secret.SecretCache(ssm_client=ssm)
+        with mock.patch("time.sleep") as sleep:
+            assert cache.get("/iam/secret") == "value"
+        assert len(ssm.calls) == 4
+        # Exponential backoff with full jitter
+        for attempt, call in enumerate(sleep.call_args_list):
+            assert 0 <= call[0][0] <= cache.backoff * 2 ** attempt
+
+        ssm = FakeSSM({"/iam/secret": "value"}, failures=100)
+        cache = secret.SecretCache(ssm_client=ssm)
+        with mock.patch("time.sleep"):
+            with pytest.raises(ClientError):
+                cache.get("/iam/secret")
+        assert len(ssm.calls) == cache.retries + 1
+
+    def test_secret_cache_refresh(self):
+        from cis_crypto import secret
+
+        ssm = FakeSSM({"/iam/secret": "value"})
+        cache = secret.SecretCache(ssm_client=ssm)
+        assert cache.get("/iam/secret") == "value"
+
+        # Due for a refresh, but not expired: the cached value is returned while it is refreshed
+        cache.refresh_after = 0
+        ssm.parameters["/iam/secret"] = "rotated"
+        assert cache.get("/iam/secret") == "value"
+        for thread in threading.enumerate():
+            if thread.name == "cis_crypto_secret_refresh":
+                thread.join()
+        cache.refresh_after = cache.ttl
+        assert cache.get("/iam/secret") == "rotated"
+        assert len(ssm.calls) == 2
+
+        # Expired
+        cache.ttl = 0
+        ssm.parameters["/iam/secret"] = "rotated again"
+        assert cache.get("/iam/secret") == "rotated again"
+
+    def test_ssm_provider_uuid_salt_cache(self):
+        from cis_crypto import secret
+        from unittest import mock
+
+        ssm = FakeSSM({"/iam/uuid_salt": "salt"})
+        env = {"CIS_SECRET_MANAGER_SSM_REGION": "eu-west-1", "CIS_SECRET_MANAGER_SSM_UUID_SALT": "/iam/uuid_salt"}
+        with mock.patch.dict(secret._secret_caches, {"eu-west-1": secret.SecretCache("eu-west-1", ssm)}):
+            with mock.patch.dict(os.environ, env):
+                # One SSM call for all providers
+                assert [secret.AWSParameterstoreProvider().uuid_salt() for _ in range(3)] == ["salt"] * 3
+        assert len(ssm.calls) == 1
+
     @mock_ssm
     def test_ssm_provider(self):
         from cis_crypto import secret
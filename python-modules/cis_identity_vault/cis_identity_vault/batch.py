@@ -0,0 +1,344 @@
+"""Batched DynamoDB operations shared by the identity vault models.
+
+DynamoDB batch calls can partially succeed: whatever is returned as unprocessed must be resent, with an exponential
+backoff so that a throttled table gets a chance to recover.
+"""
+import json
+import logging
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from cis_identity_vault.common import get_config
+
+
+logger = logging.getLogger(__name__)
+
+# BatchGetItem accepts up to 100 keys per call
+MAX_GET_KEYS = 100
+# BatchWriteItem accepts up to 25 items per call
+MAX_WRITE_ITEMS = 25
+# TransactWriteItems accepts up to 100 operations and 4MB per call
+MAX_TRANSACTION_ITEMS = 100
+MAX_TRANSACTION_BYTES = 4 * 1024 * 1024
+# Never wait longer than this between two retries
+MAX_BACKOFF = 5.0
+
+# A transaction failing with one of these may succeed if sent again
+RETRYABLE_TRANSACTION_ERRORS = [
+    "TransactionConflictException",
+    "TransactionInProgressException",
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "InternalServerError",
+]
+# A batch write failing with one of these is throttled, and is sent again later
+THROTTLING_ERRORS = [
+    "ProvisionedThroughputExceededException",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "InternalServerError",
+]
+RETRYABLE_CANCELLATION_REASONS = ["TransactionConflict", "ProvisionedThroughputExceeded", "ThrottlingError"]
+
+
+def chunks(items, size):
+    """
+    Returns @items split in lists of at most @size items
+    @items list
+    @size int
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def backoff(attempt, base=None):
+    """
+    Sleeps before retry number @attempt (starting at 0), with full jitter
+    @attempt int
+    @base float seconds, defaults to the `batch_backoff` config
+    """
+    if base is None:
+        base = get_config()("batch_backoff", namespace="cis", default="0.05", parser=float)
+    time.sleep(random.uniform(0, min(MAX_BACKOFF, base * (2 ** attempt))))
+
+
+def _get_chunk(dynamodb_client, table_name, keys, projection, retries):
+    request = {table_name: {"Keys": keys}}
+    if projection is not None:
+        request[table_name]["ProjectionExpression"] = projection
+
+    items = []
+    attempt = 0
+    while request:
+        response = dynamodb_client.batch_get_item(RequestItems=request)
+        items.extend(response.get("Responses", {}).get(table_name, []))
+        request = response.get("UnprocessedKeys")
+        if request:
+            if attempt >= retries:
+                raise RuntimeError(
+                    "{} keys still unprocessed after {} retries".format(len(request[table_name]["Keys"]), retries)
+                )
+            logger.debug("Retrying {} unprocessed keys".format(len(request[table_name]["Keys"])))
+            backoff(attempt)
+            attempt += 1
+    return items
+
+
+def batch_get_items(dynamodb_client, table_name, keys, projection=None, workers=None):
+    """
+    Returns the items of @table_name matching @keys, in no particular order. Keys that do not exist are left out.
+    @dynamodb_client a boto3 dynamodb client
+    @table_name str
+    @keys list of low level keys, e.g. [{"id": {"S": "ad|foo"}}], without duplicates
+    @projection str a ProjectionExpression, or None for the whole items
+    @workers int number of BatchGetItem calls in flight, defaults to the `batch_workers` config
+    Raises RuntimeError if some keys are still unprocessed after the `batch_retries` config retries
+    """
+    config = get_config()
+    if workers is None:
+        workers = config("batch_workers", namespace="cis", default="8", parser=int)
+    retries = config("batch_retries", namespace="cis", default="8", parser=int)
+
+    key_chunks = chunks(keys, MAX_GET_KEYS)
+    if len(key_chunks) <= 1 or workers <= 1:
+        results = [_get_chunk(dynamodb_client, table_name, chunk, projection, retries) for chunk in key_chunks]
+    else:
+        with ThreadPoolExecutor(max_workers=min(workers, len(key_chunks))) as executor:
+            results = list(
+                executor.map(
+                    lambda chunk: _get_chunk(dynamodb_client, table_name, chunk, projection, retries), key_chunks
+                )
+            )
+    return [item for items in results for item in items]
+
+
+def _transaction_key(transact_item):
+    (operation,) = transact_item.values()
+    key = operation.get("Key") or {"id": operation["Item"]["id"]}
+    return (operation["TableName"], json.dumps(key, sort_keys=True))
+
+
+def _base64_placeholder(value):
+    # Binary attributes are sent base64 encoded
+    return "x" * (4 * ((len(bytes(value)) + 2) // 3))
+
+
+def _request_size(transact_item):
+    return len(json.dumps(transact_item, default=_base64_placeholder))
+
+
+def transaction_waves(transact_items, max_items=MAX_TRANSACTION_ITEMS, max_bytes=MAX_TRANSACTION_BYTES):
+    """
+    Returns @transact_items split in waves of chunks: [[chunk, ...], ...]
+    A chunk holds at most @max_items operations and @max_bytes of JSON request payload, which overestimates the size
+    DynamoDB accounts for. Chunks of one wave touch different items and can be sent concurrently. An item touched
+    several times is touched once per wave, in the original order, as a transaction cannot touch an item twice.
+    @transact_items list of TransactWriteItems operations, e.g. [{"Put": {...}}, {"Update": {...}}]
+    """
+    waves = []
+    seen = {}
+    for transact_item in transact_items:
+        key = _transaction_key(transact_item)
+        wave = seen.get(key, 0)
+        seen[key] = wave + 1
+        if wave == len(waves):
+            waves.append([])
+        waves[wave].append(transact_item)
+
+    chunked_waves = []
+    for wave in waves:
+        chunk_list = [[]]
+        size = 0
+        for transact_item in wave:
+            item_size = _request_size(transact_item)
+            if chunk_list[-1] and (len(chunk_list[-1]) >= max_items or size + item_size > max_bytes):
+                chunk_list.append([])
+                size = 0
+            chunk_list[-1].append(transact_item)
+            size += item_size
+        chunked_waves.append(chunk_list)
+    return chunked_waves
+
+
+def _is_retryable_transaction_error(error):
+    code = error.response.get("Error", {}).get("Code")
+    if code in RETRYABLE_TRANSACTION_ERRORS:
+        return True
+    if code != "TransactionCanceledException":
+        return False
+    reasons = [reason.get("Code") for reason in error.response.get("CancellationReasons", [])]
+    if not reasons:
+        return "TransactionConflict" in error.response.get("Error", {}).get("Message", "")
+    # A failed condition check fails again, whatever else went wrong
+    return "ConditionalCheckFailed" not in reasons and any(
+        reason in RETRYABLE_CANCELLATION_REASONS for reason in reasons
+    )
+
+
+def _transact_chunk(dynamodb_client, chunk, retries):
+    attempt = 0
+    while True:
+        try:
+            dynamodb_client.transact_write_items(
+                TransactItems=chunk, ReturnConsumedCapacity="TOTAL", ReturnItemCollectionMetrics="SIZE"
+            )
+            return {"items": chunk, "status": "200", "error": None, "attempts": attempt + 1}
+        except ClientError as e:
+            if attempt < retries and _is_retryable_transaction_error(e):
+                logger.debug("Retrying conflicting transaction of {} items: {}".format(len(chunk), e))
+                backoff(attempt)
+                attempt += 1
+                continue
+            logger.warning("Transaction failed", extra={"reason": e, "items": len(chunk)})
+            return {"items": chunk, "status": "500", "error": e, "attempts": attempt + 1}
+
+
+def run_transactions(dynamodb_client, transact_items, workers=None):
+    """
+    Writes @transact_items in as many TransactWriteItems calls as needed, see transaction_waves()
+    Each chunk is atomic on its own, and only chunks that failed on a conflict or on throttling are retried.
+    Returns the outcome of each chunk, in order:
+    [{"items": [...], "status": "200" or "500", "error": the last ClientError or None, "attempts": int}, ...]
+    @dynamodb_client a boto3 dynamodb client
+    @transact_items list of TransactWriteItems operations
+    @workers int number of transactions in flight, defaults to the `batch_workers` config
+    """
+    config = get_config()
+    if workers is None:
+        workers = config("batch_workers", namespace="cis", default="8", parser=int)
+    retries = config("batch_retries", namespace="cis", default="8", parser=int)
+
+    outcomes = []
+    for wave in transaction_waves(transact_items):
+        if len(wave) <= 1 or workers <= 1:
+            outcomes.extend(_transact_chunk(dynamodb_client, chunk, retries) for chunk in wave)
+        else:
+            with ThreadPoolExecutor(max_workers=min(workers, len(wave))) as executor:
+                outcomes.extend(executor.map(lambda chunk: _transact_chunk(dynamodb_client, chunk, retries), wave))
+    return outcomes
+
+
+class BatchWriter(object):
+    """
+    Puts items with concurrent BatchWriteItem calls of up to 25 items.
+    Unprocessed items and throttled calls are sent again after a backoff. The number of calls in flight follows an
+    AIMD scheme: it grows by one after each call that went through entirely, and halves after each throttled call,
+    which keeps the writes close to the provisioned capacity of the table.
+
+    Ex:
+    results = BatchWriter(dynamodb_client, "purple-identity-vault").write(items)
+    """
+
+    def __init__(self, dynamodb_client, table_name, workers=None, retries=None, key="id"):
+        """
+        @dynamodb_client a boto3 dynamodb client
+        @table_name str
+        @workers int maximum number of calls in flight, defaults to the `batch_workers` config
+        @retries int number of times items are sent again, defaults to the `batch_retries` config
+        @key str the hash key attribute of the table
+        """
+        config = get_config()
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.key = key
+        if workers is None:
+            workers = config("batch_workers", namespace="cis", default="8", parser=int)
+        if retries is None:
+            retries = config("batch_retries", namespace="cis", default="8", parser=int)
+        self.workers = max(1, workers)
+        self.retries = retries
+        self.concurrency = self.workers
+        self.throttled = 0
+        self._cond = threading.Condition()
+
+    def write(self, items):
+        """
+        Returns the result of each of @items, in order: [{"id": ..., "status": "200" or "500", "error": ...}, ...]
+        Items are low level, e.g. {"id": {"S": "ad|foo"}, ...}. The last of several items with the same key wins.
+        @items list of items to put
+        """
+        by_key = {}
+        for item in items:
+            by_key[item[self.key]["S"]] = item
+
+        self._pending = deque((chunk, 0) for chunk in chunks(list(by_key.values()), MAX_WRITE_ITEMS))
+        self._in_flight = 0
+        self._results = {}
+        threads = [
+            threading.Thread(target=self._worker, name="cis_identity_vault_batch_writer")
+            for _ in range(min(self.workers, len(self._pending)))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return [dict(self._results[item[self.key]["S"]], id=item[self.key]["S"]) for item in items]
+
+    def _next(self):
+        with self._cond:
+            while True:
+                if self._pending and self._in_flight < self.concurrency:
+                    self._in_flight += 1
+                    return self._pending.popleft()
+                if not self._pending and self._in_flight == 0:
+                    return None
+                self._cond.wait()
+
+    def _worker(self):
+        while True:
+            request = self._next()
+            if request is None:
+                return
+            chunk, attempt = request
+            if attempt > 0:
+                backoff(attempt - 1)
+
+            error = None
+            unprocessed = []
+            try:
+                response = self.client.batch_write_item(
+                    RequestItems={self.table_name: [{"PutRequest": {"Item": item}} for item in chunk]}
+                )
+                unprocessed = [
+                    r["PutRequest"]["Item"] for r in response.get("UnprocessedItems", {}).get(self.table_name, [])
+                ]
+            except ClientError as e:
+                error = e
+                if e.response.get("Error", {}).get("Code") in THROTTLING_ERRORS:
+                    unprocessed = chunk
+            except Exception as e:
+                error = e
+            self._done(chunk, attempt, unprocessed, error)
+
+    def _done(self, chunk, attempt, unprocessed, error):
+        unprocessed_keys = set(item[self.key]["S"] for item in unprocessed)
+        with self._cond:
+            self._in_flight -= 1
+            if unprocessed:
+                self.throttled += 1
+                self.concurrency = max(1, self.concurrency // 2)
+                logger.debug(
+                    "{} items unprocessed, lowering concurrency to {}".format(len(unprocessed), self.concurrency)
+                )
+            elif error is None:
+                self.concurrency = min(self.workers, self.concurrency + 1)
+
+            for item in chunk:
+                item_key = item[self.key]["S"]
+                if item_key not in unprocessed_keys:
+                    failed = error is not None
+                    self._results[item_key] = {"status": "500" if failed else "200", "error": error}
+                elif attempt >= self.retries:
+                    self._results[item_key] = {"status": "500", "error": error or "Unprocessed after retries"}
+
+            if unprocessed and attempt < self.retries:
+                self._pending.append((unprocessed, attempt + 1))
+            elif error is not None or unprocessed:
+                logger.warning(
+                    "Could not write {} items".format(len(unprocessed) or len(chunk)), extra={"reason": error}
+                )
+            self._cond.notify_all()
@@ -0,0 +1,111 @@
+"""Storage codecs of the profile JSON stored in the identity vault.
+
+With the `plain` codec (the default), the `profile` attribute is the profile JSON, as a string. With the `zlib` codec
+it is a binary attribute: a format marker followed by the zlib compressed profile JSON. Reads accept both formats, so
+the codec can be changed on a live table, and items are converted as they get written again.
+
+The codec is chosen with the `profile_storage_codec` config. Independently of the codec, profiles can be stored
+sparse (see cis_profile.sparse) with the `profile_storage_sparse` config: cis_profile.User and ProfileView load them
+as full profiles.
+
+Ex:
+stored = encode_profile(user.as_json(), codec="zlib")
+profile_json = decode_profile(stored)
+"""
+import base64
+import json
+import zlib
+
+from cis_identity_vault.common import get_config
+from cis_profile.sparse import sparsify
+
+
+PLAIN = "plain"
+ZLIB = "zlib"
+CODECS = [PLAIN, ZLIB]
+
+# Prefixed to compressed profiles, bump the version when the format changes
+ZLIB_MARKER = b"cisz1:"
+ZLIB_LEVEL = 6
+
+
+def get_codec():
+    """Returns the configured profile storage codec."""
+    codec = get_config()("profile_storage_codec", namespace="cis", default=PLAIN)
+    if codec not in CODECS:
+        raise ValueError("Unknown profile storage codec: {}, use one of {}".format(codec, CODECS))
+    return codec
+
+
+def get_sparse():
+    """Returns True if profiles are configured to be stored sparse."""
+    return get_config()("profile_storage_sparse", namespace="cis", default="false") == "true"
+
+
+def encode_profile(profile_json, codec=None, sparse=None):
+    """
+    Returns @profile_json as stored with @codec: a str for the plain codec, bytes for the others
+    @profile_json str the profile JSON
+    @codec str one of CODECS, defaults to the configured codec
+    @sparse bool store the profile without its null attributes, defaults to the configured setting
+    """
+    if codec is None:
+        codec = get_codec()
+    if sparse is None:
+        sparse = get_sparse()
+    if sparse:
+        profile_json = json.dumps(sparsify(json.loads(profile_json)))
+    if codec == PLAIN:
+        return profile_json
+    if codec == ZLIB:
+        return ZLIB_MARKER + zlib.compress(profile_json.encode("utf-8"), ZLIB_LEVEL)
+    raise ValueError("Unknown profile storage codec: {}, use one of {}".format(codec, CODECS))
+
+
+def decode_profile(stored):
+    """
+    Returns the profile JSON of a @stored profile, whatever codec it was stored with
+    @stored str, bytes or boto3 Binary, as read from the vault
+    Raises ValueError if @stored is binary but not in a known format
+    """
+    if isinstance(stored, str):
+        return stored
+    # boto3 wraps binary attributes read through a table resource
+    stored = bytes(getattr(stored, "value", stored))
+    if stored.startswith(ZLIB_MARKER):
+        return zlib.decompress(stored[len(ZLIB_MARKER):]).decode("utf-8")
+    raise ValueError("Unknown stored profile format: {}".format(stored[:8]))
+
+
+def profile_attribute(profile_json, codec=None, sparse=None):
+    """
+    Returns the low level DynamoDB attribute of @profile_json stored with @codec, e.g. {"S": ...} or {"B": ...}
+    @profile_json str the profile JSON
+    @codec str one of CODECS, defaults to the configured codec
+    @sparse bool store the profile without its null attributes, defaults to the configured setting
+    """
+    stored = encode_profile(profile_json, codec, sparse)
+    if isinstance(stored, str):
+        return {"S": stored}
+    return {"B": stored}
+
+
+def decode_item(item):
+    """
+    Decodes the `profile` attribute of a vault @item in place, and returns it. Low level items, as returned by the
+    dynamodb client or found in stream records, get their profile as {"S": profile JSON}.
+    @item dict a vault item
+    """
+    stored = item.get("profile")
+    if stored is None:
+        return item
+    if isinstance(stored, dict):
+        if "B" in stored:
+            binary = stored["B"]
+            # Stream records delivered to lambda functions as JSON carry binary attributes base64 encoded
+            if isinstance(binary, str):
+                binary = base64.b64decode(binary)
+            item["profile"] = {"S": decode_profile(binary)}
+    else:
+        item["profile"] = decode_profile(stored)
+    return item
@@ -14,11 +14,18 @@ import logging
 import uuid
 from boto3.dynamodb.conditions import Attr
 from boto3.dynamodb.conditions import Key
-from boto3.dynamodb.types import TypeDeserializer
 from botocore.exceptions import ClientError
 from botocore.exceptions import ParamValidationError
-from traceback import format_exc
 
+from cis_identity_vault.batch import BatchWriter
+from cis_identity_vault.batch import batch_get_items
+from cis_identity_vault.batch import run_transactions
+from cis_identity_vault.codec import decode_item
+from cis_identity_vault.codec import encode_profile
+from cis_identity_vault.codec import get_codec
+from cis_identity_vault.codec import get_sparse
+from cis_identity_vault.codec import profile_attribute
+from cis_identity_vault.parallel_scan import ParallelScan
 from cis_profile import User
 
 
@@ -26,30 +33,89 @@ logger = logging.getLogger(__name__)
 
 
 class Profile(object):
-    def __init__(self, dynamodb_table_resource=None, dynamodb_client=None, transactions=True):
-        """Take a dynamodb table resource to use for operations."""
+    def __init__(
+        self, dynamodb_table_resource=None, dynamodb_client=None, transactions=True, codec=None, sparse=None
+    ):
+        """
+        Take a dynamodb table resource to use for operations.
+        @codec str how profiles are stored, see cis_identity_vault.codec. Profiles are read whatever their codec.
+        @sparse bool store profiles without their null attributes, see cis_identity_vault.codec
+        """
         self.table = dynamodb_table_resource
         self.client = dynamodb_client
         self.transactions = transactions
-        self.deserializer = TypeDeserializer()
+        self.codec = codec or get_codec()
+        self.sparse = get_sparse() if sparse is None else sparse
 
-    def _run_transaction(self, transact_items):
+    def _decode_items(self, response):
+        for item in response.get("Items", []):
+            decode_item(item)
+        return response
+
+    @staticmethod
+    def _sequence_numbers(transact_items):
         sequence_numbers = []
         for t in transact_items:
             if "Update" in t:
                 sequence_numbers.append(t["Update"]["ExpressionAttributeValues"][":sn"]["S"])
             else:
                 sequence_numbers.append(t["Put"]["Item"]["sequence_number"]["S"])
+        return sequence_numbers
 
-        try:
-            self.client.transact_write_items(
-                TransactItems=transact_items, ReturnConsumedCapacity="TOTAL", ReturnItemCollectionMetrics="SIZE"
-            )
-        except ClientError as e:
-            logger.warning("Transaction failed", extra={"reason": e, "trace": format_exc()})
-            raise ValueError("Transaction failed - profile issue?", e)
+    @staticmethod
+    def _ids(transact_items):
+        ids = []
+        for t in transact_items:
+            if "Update" in t:
+                ids.append(t["Update"]["Key"]["id"]["S"])
+            else:
+                ids.append(t["Put"]["Item"]["id"]["S"])
+        return ids
 
-        return {"status": "200", "ResponseMetadata": {"HTTPStatusCode": 200}, "sequence_numbers": sequence_numbers}
+    def _run_transaction(self, transact_items):
+        """
+        @transact_items list of TransactWriteItems operations, of any length, see cis_identity_vault.batch
+        Returns the overall status, the sequence_numbers written, the failed_sequence_numbers and failed_ids (vault
+        item ids) and the outcome of each transaction chunk. The status is 207 when only some of the chunks were
+        written.
+        Raises ValueError if no chunk could be written
+        """
+        chunks = []
+        sequence_numbers = []
+        failed_sequence_numbers = []
+        failed_ids = []
+        failed = []
+        for outcome in run_transactions(self.client, transact_items):
+            chunk = {
+                "status": outcome["status"],
+                "sequence_numbers": self._sequence_numbers(outcome["items"]),
+                "ids": self._ids(outcome["items"]),
+                "attempts": outcome["attempts"],
+            }
+            if outcome["error"] is None:
+                sequence_numbers.extend(chunk["sequence_numbers"])
+            else:
+                chunk["error"] = "{}".format(outcome["error"])
+                failed_sequence_numbers.extend(chunk["sequence_numbers"])
+                failed_ids.extend(chunk["ids"])
+                failed.append(outcome["error"])
+            chunks.append(chunk)
+
+        if failed and not sequence_numbers:
+            logger.warning("Transaction failed", extra={"reason": failed[0], "chunks": len(chunks)})
+            raise ValueError("Transaction failed - profile issue?", failed[0])
+
+        status = 207 if failed else 200
+        if failed:
+            logger.warning("{} of {} transaction chunks failed".format(len(failed), len(chunks)))
+        return {
+            "status": "{}".format(status),
+            "ResponseMetadata": {"HTTPStatusCode": status},
+            "sequence_numbers": sequence_numbers,
+            "failed_sequence_numbers": failed_sequence_numbers,
+            "failed_ids": failed_ids,
+            "chunks": chunks,
+        }
 
     def create(self, user_profile):
         if self.transactions:
@@ -67,21 +133,18 @@ class Profile(object):
         if user_profile["sequence_number"] is None:
             user_profile["sequence_number"] = str(uuid.uuid4().int)
 
-        cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
+        cis_profile_user_object = User(user_structure_json=user_profile["profile"])
 
         return self.table.put_item(
             Item={
                 "id": user_profile["id"],
                 "user_uuid": user_profile["user_uuid"],
-                "profile": user_profile["profile"],
+                "profile": encode_profile(user_profile["profile"], self.codec, self.sparse),
                 "primary_email": user_profile["primary_email"],
                 "primary_username": user_profile["primary_username"],
                 "sequence_number": user_profile["sequence_number"],
-                "active": bool(json.loads(user_profile["profile"])["active"]["value"]),
-                "flat_profile": {
-                    k: self.deserializer.deserialize(v)
-                    for k, v in cis_profile_user_object.as_dynamo_flat_dict().items()
-                },
+                "active": bool(cis_profile_user_object.active.value),
+                "flat_profile": cis_profile_user_object.as_dynamo_flat_dict(low_level=False),
             }
         )
 
@@ -89,18 +152,18 @@ class Profile(object):
         if user_profile["sequence_number"] is None:
             user_profile["sequence_number"] = str(uuid.uuid4().int)
 
-        cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
+        cis_profile_user_object = User(user_structure_json=user_profile["profile"])
 
         transact_items = {
             "Put": {
                 "Item": {
                     "id": {"S": user_profile["id"]},
                     "user_uuid": {"S": user_profile["user_uuid"]},
-                    "profile": {"S": user_profile["profile"]},
+                    "profile": profile_attribute(user_profile["profile"], self.codec, self.sparse),
                     "primary_email": {"S": user_profile["primary_email"]},
                     "primary_username": {"S": user_profile["primary_username"]},
                     "sequence_number": {"S": user_profile["sequence_number"]},
-                    "active": {"BOOL": json.loads(user_profile["profile"])["active"]["value"]},
+                    "active": {"BOOL": cis_profile_user_object.active.value},
                     "flat_profile": {"M": cis_profile_user_object.as_dynamo_flat_dict()},
                 },
                 "ConditionExpression": "attribute_not_exists(id)",
@@ -118,17 +181,17 @@ class Profile(object):
         return res
 
     def _update_with_transaction(self, user_profile):
-        cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
+        cis_profile_user_object = User(user_structure_json=user_profile["profile"])
         transact_items = {
             "Update": {
                 "Key": {"id": {"S": user_profile["id"]}},
                 "ExpressionAttributeValues": {
-                    ":p": {"S": user_profile["profile"]},
+                    ":p": profile_attribute(user_profile["profile"], self.codec, self.sparse),
                     ":u": {"S": user_profile["user_uuid"]},
                     ":pe": {"S": user_profile["primary_email"]},
                     ":pn": {"S": user_profile["primary_username"]},
                     ":sn": {"S": user_profile["sequence_number"]},
-                    ":a": {"BOOL": json.loads(user_profile["profile"])["active"]["value"]},
+                    ":a": {"BOOL": cis_profile_user_object.active.value},
                     ":fp": {"M": cis_profile_user_object.as_dynamo_flat_dict()},
                 },
                 "ConditionExpression": "attribute_exists(id)",
@@ -141,21 +204,18 @@ class Profile(object):
         return self._run_transaction([transact_items])
 
     def _update_without_transaction(self, user_profile):
-        cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
+        cis_profile_user_object = User(user_structure_json=user_profile["profile"])
 
         return self.table.put_item(
             Item={
                 "id": user_profile["id"],
                 "user_uuid": user_profile["user_uuid"],
-                "profile": user_profile["profile"],
+                "profile": encode_profile(user_profile["profile"], self.codec, self.sparse),
                 "primary_email": user_profile["primary_email"],
                 "primary_username": user_profile["primary_username"],
                 "sequence_number": user_profile["sequence_number"],
-                "active": bool(json.loads(user_profile["profile"])["active"]["value"]),
-                "flat_profile": {
-                    k: self.deserializer.deserialize(v)
-                    for k, v in cis_profile_user_object.as_dynamo_flat_dict().items()
-                },
+                "active": bool(cis_profile_user_object.active.value),
+                "flat_profile": cis_profile_user_object.as_dynamo_flat_dict(low_level=False),
             }
         )
 
@@ -176,39 +236,82 @@ class Profile(object):
             if res.get("ResponseMetadata", False):
                 status_code = res["ResponseMetadata"]["HTTPStatusCode"]
 
-            return {"status": status_code, "sequence_numbers": sequence_numbers}
+            return {
+                "status": status_code,
+                "sequence_numbers": res["sequence_numbers"],
+                "failed_sequence_numbers": res["failed_sequence_numbers"],
+                "failed_ids": res["failed_ids"],
+                "chunks": res["chunks"],
+            }
         else:
             try:
                 res = self._put_items_without_transaction(list_of_profiles)
-                return {"status": "200", "sequence_numbers": sequence_numbers}
+                return {
+                    "status": res["status"],
+                    "sequence_numbers": res["sequence_numbers"],
+                    "failed_sequence_numbers": res["failed_sequence_numbers"],
+                    "failed_ids": res["failed_ids"],
+                    "items": res["items"],
+                }
             except Exception as e:
                 logger.error("Could not write batch due to: {}".format(e))
-                return {"status": "500", "sequence_numbers": sequence_numbers}
+                return {
+                    "status": "500",
+                    "sequence_numbers": [],
+                    "failed_sequence_numbers": sequence_numbers,
+                    "failed_ids": [profile["id"] for profile in list_of_profiles],
+                }
 
     def _put_items_without_transaction(self, list_of_profiles):
+        """
+        @list_of_profiles list of vault profiles
+        Returns the overall status, the sequence_numbers written, the failed_sequence_numbers and failed_ids (vault
+        item ids) and the result of each profile. The status is 207 when only some of the profiles were written, 500
+        when none was.
+        """
+        items = []
+        for profile in list_of_profiles:
+            cis_profile_user_object = User(user_structure_json=profile["profile"])
+            items.append(
+                {
+                    "id": {"S": profile["id"]},
+                    "user_uuid": {"S": profile["user_uuid"]},
+                    "profile": profile_attribute(profile["profile"], self.codec, self.sparse),
+                    "primary_email": {"S": profile["primary_email"]},
+                    "primary_username": {"S": profile["primary_username"]},
+                    "sequence_number": {"S": profile["sequence_number"]},
+                    "active": {"BOOL": bool(cis_profile_user_object.active.value)},
+                    "flat_profile": {"M": cis_profile_user_object.as_dynamo_flat_dict()},
+                }
+            )
+
+        results = BatchWriter(self.client, self.table.name).write(items)
         sequence_numbers = []
-        with self.table.batch_writer() as batch:
-            for profile in list_of_profiles:
-                cis_profile_user_object = User(user_structure_json=json.loads(profile["profile"]))
-
-                batch.put_item(
-                    Item={
-                        "id": profile["id"],
-                        "user_uuid": profile["user_uuid"],
-                        "profile": profile["profile"],
-                        "primary_email": profile["primary_email"],
-                        "primary_username": profile["primary_username"],
-                        "sequence_number": profile["sequence_number"],
-                        "active": bool(json.loads(profile["profile"])["active"]["value"]),
-                        "flat_profile": {
-                            k: self.deserializer.deserialize(v)
-                            for k, v in cis_profile_user_object.as_dynamo_flat_dict().items()
-                        },
-                    }
-                )
+        failed_sequence_numbers = []
+        failed_ids = []
+        for profile, result in zip(list_of_profiles, results):
+            result["sequence_number"] = profile["sequence_number"]
+            if result["error"] is None:
                 sequence_numbers.append(profile["sequence_number"])
-
-        return {"status": "200", "ResponseMetadata": {"HTTPStatusCode": 200}, "sequence_numbers": sequence_numbers}
+            else:
+                failed_sequence_numbers.append(profile["sequence_number"])
+                failed_ids.append(profile["id"])
+                result["error"] = "{}".format(result["error"])
+
+        if len(sequence_numbers) == len(results):
+            status = 200
+        elif sequence_numbers:
+            status = 207
+        else:
+            status = 500
+        return {
+            "status": "{}".format(status),
+            "ResponseMetadata": {"HTTPStatusCode": status},
+            "sequence_numbers": sequence_numbers,
+            "failed_sequence_numbers": failed_sequence_numbers,
+            "failed_ids": failed_ids,
+            "items": results,
+        }
 
     def _create_items_with_transaction(self, list_of_profiles):
         transact_items = []
@@ -217,17 +320,17 @@ class Profile(object):
                 user_profile["sequence_number"] = str(uuid.uuid4().int)
 
             # XXX TBD cover this with tests.  Currently dynalite does not support tests for transactions.
-            cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
+            cis_profile_user_object = User(user_structure_json=user_profile["profile"])
             transact_item = {
                 "Put": {
                     "Item": {
                         "id": {"S": user_profile["id"]},
                         "user_uuid": {"S": user_profile["user_uuid"]},
-                        "profile": {"S": user_profile["profile"]},
+                        "profile": profile_attribute(user_profile["profile"], self.codec, self.sparse),
                         "primary_email": {"S": user_profile["primary_email"]},
                         "primary_username": {"S": user_profile["primary_username"]},
                         "sequence_number": {"S": user_profile["sequence_number"]},
-                        "active": {"BOOL": json.loads(user_profile["profile"])["active"]["value"]},
+                        "active": {"BOOL": cis_profile_user_object.active.value},
                         "flat_profile": {"M": cis_profile_user_object.as_dynamo_flat_dict()},
                     },
                     "ConditionExpression": "attribute_not_exists(id)",
@@ -249,19 +352,20 @@ class Profile(object):
     def _update_batch_with_transaction(self, list_of_profiles):
         transact_items = []
         for user_profile in list_of_profiles:
-            cis_profile_user_object = User(user_structure_json=json.loads(user_profile["profile"]))
-            logger.info(cis_profile_user_object.as_dynamo_flat_dict())
+            cis_profile_user_object = User(user_structure_json=user_profile["profile"])
+            flat_profile = cis_profile_user_object.as_dynamo_flat_dict()
+            logger.info(flat_profile)
             transact_item = {
                 "Update": {
                     "Key": {"id": {"S": user_profile["id"]}},
                     "ExpressionAttributeValues": {
-                        ":p": {"S": user_profile["profile"]},
+                        ":p": profile_attribute(user_profile["profile"], self.codec, self.sparse),
                         ":u": {"S": user_profile["user_uuid"]},
                         ":pe": {"S": user_profile["primary_email"]},
                         ":pn": {"S": user_profile["primary_username"]},
                         ":sn": {"S": user_profile["sequence_number"]},
-                        ":a": {"BOOL": json.loads(user_profile["profile"])["active"]["value"]},
-                        ":fp": {"M": cis_profile_user_object.as_dynamo_flat_dict()},
+                        ":a": {"BOOL": cis_profile_user_object.active.value},
+                        ":fp": {"M": flat_profile},
                     },
                     "ConditionExpression": "attribute_exists(id)",
                     "UpdateExpression": "SET profile = :p, primary_email = :pe, sequence_number = :sn, user_uuid = :u, primary_username = :pn,"
@@ -276,27 +380,37 @@ class Profile(object):
 
     def find_by_id(self, id):
         result = self.table.query(KeyConditionExpression=Key("id").eq(id))
-        return result
+        return self._decode_items(result)
+
+    def find_by_ids(self, ids):
+        """
+        @ids list of user_ids
+        Returns {user_id: {"id": ..., "sequence_number": ...}} of the ids that exist in the vault, in a few
+        concurrent BatchGetItem calls
+        """
+        keys = [{"id": {"S": id}} for id in sorted(set(ids))]
+        items = batch_get_items(self.client, self.table.name, keys, projection="id, sequence_number")
+        return {item["id"]["S"]: item for item in items}
 
     def find_by_email(self, primary_email):
         result = self.table.query(
             IndexName="{}-primary_email".format(self.table.table_name),
             KeyConditionExpression=Key("primary_email").eq(primary_email),
         )
-        return result
+        return self._decode_items(result)
 
     def find_by_uuid(self, uuid):
         result = self.table.query(
             IndexName="{}-user_uuid".format(self.table.table_name), KeyConditionExpression=Key("user_uuid").eq(uuid)
         )
-        return result
+        return self._decode_items(result)
 
     def find_by_username(self, primary_username):
         result = self.table.query(
             IndexName="{}-primary_username".format(self.table.table_name),
             KeyConditionExpression=Key("primary_username").eq(primary_username),
         )
-        return result
+        return self._decode_items(result)
 
     @property
     def all(self):
@@ -305,59 +419,55 @@ class Profile(object):
         while "LastEvaluatedKey" in response:
             response = self.table.scan(ExclusiveStartKey=response["LastEvaluatedKey"])
             users.extend(response["Items"])
+        for user in users:
+            decode_item(user)
         return users
 
-    def _get_segment(self, segment=0, total_segments=10, connection_method=None, active=None):
-        logger.info("Getting segment: {} of total: {}".format(segment, total_segments))
+    def _filtered_scan_kwargs(self, connection_method=None, active=None):
+        kwargs = {"ProjectionExpression": "id, primary_email, user_uuid, active"}
+        expression_attr = {}
+        filter_expressions = []
+
+        if active is not None:
+            logger.info("Asking for only the users with active state: {}".format(active))
+            expression_attr[":a"] = {"BOOL": active}
+            filter_expressions.append(":a = active")
 
         if connection_method:
-            expression_attr = {":id": {"S": connection_method}}
-            filter_expression = "begins_with(id, :id)"
+            expression_attr[":id"] = {"S": connection_method}
+            filter_expressions.append("begins_with(id, :id)")
 
-        if connection_method and active is not None:
-            logger.info("Asking for only the users with active state: {}".format(active))
-            expression_attr = {":id": {"S": connection_method}, ":a": {"BOOL": active}}
-            filter_expression = ":a = active AND begins_with(id, :id) AND attribute_exists(active)"
-
-        response = self.client.scan(
-            TableName=self.table.name,
-            TotalSegments=total_segments,
-            Segment=segment,
-            ProjectionExpression="id, primary_email, user_uuid, active",
-            FilterExpression=filter_expression,
-            ExpressionAttributeValues=expression_attr,
-        )
-        users = response.get("Items", [])
-        while "LastEvaluatedKey" in response:
-            response = self.client.scan(
-                TableName=self.table.name,
-                TotalSegments=total_segments,
-                Segment=segment,
-                ProjectionExpression="id, primary_email, user_uuid, active",
-                FilterExpression=filter_expression,
-                ExpressionAttributeValues=expression_attr,
-                ExclusiveStartKey=response["LastEvaluatedKey"],
-            )
-            users.extend(response["Items"])
-        return users
+        if active is not None:
+            filter_expressions.append("attribute_exists(active)")
+
+        if filter_expressions:
+            kwargs["FilterExpression"] = " AND ".join(filter_expressions)
+            kwargs["ExpressionAttributeValues"] = expression_attr
+        return kwargs
 
-    def all_filtered(self, connection_method=None, active=None):
+    def iter_filtered(self, connection_method=None, active=None, segments=None):
         """
-        @query_filter str login_method
-        Returns a dict of all users filtered by query_filter
+        @connection_method str login method, i.e. the user_id prefix
+        @active bool only return users with this active state, or all users if None
+        @segments int number of parallel scan segments, see cis_identity_vault.parallel_scan
+        Returns a generator of all users filtered by connection_method and active, streamed as scan pages complete
         """
-        pool = []
-        # We're choosing to divide the table in 3, then...
-        pool_size = 5
-        users = []
-        for x in range(pool_size):
-            # XXX TBD async this with asyncio
-            users.extend(
-                self._get_segment(
-                    segment=x, total_segments=pool_size, connection_method=connection_method, active=active
-                )
+        return iter(
+            ParallelScan(
+                self.client,
+                self.table.name,
+                segments=segments,
+                **self._filtered_scan_kwargs(connection_method, active)
             )
-        return users
+        )
+
+    def all_filtered(self, connection_method=None, active=None, segments=None):
+        """
+        @connection_method str login method, i.e. the user_id prefix
+        @active bool only return users with this active state, or all users if None
+        Returns a list of all users filtered by connection_method and active
+        """
+        return list(self.iter_filtered(connection_method=connection_method, active=active, segments=segments))
 
     def find_or_create(self, user_profile):
         profilev2 = json.loads(user_profile["profile"])
@@ -370,15 +480,16 @@ class Profile(object):
         return res
 
     def find_or_create_batch(self, user_profiles):
+        user_ids = [json.loads(user_profile["profile"])["user_id"]["value"] for user_profile in user_profiles]
+        existing = self.find_by_ids(user_ids)
         updates = []
         creations = []
-        for user_profile in user_profiles:
-            profilev2 = json.loads(user_profile["profile"])
-            if len(self.find_by_id(profilev2["user_id"]["value"])["Items"]) > 0:
-                logger.debug("Adding profile to the list of updates to perform: {}".format(profilev2))
+        for user_id, user_profile in zip(user_ids, user_profiles):
+            if user_id in existing:
+                logger.debug("Adding profile to the list of updates to perform: {}".format(user_id))
                 updates.append(user_profile)
             else:
-                logger.debug("Adding profile to the list of creations to perform: {}".format(profilev2))
+                logger.debug("Adding profile to the list of creations to perform: {}".format(user_id))
                 creations.append(user_profile)
 
         try:
@@ -417,4 +528,4 @@ class Profile(object):
             response = self.table.scan(Limit=limit, ExclusiveStartKey=next_page)
         else:
             response = self.table.scan(Limit=limit)
-        return response
+        return self._decode_items(response)
@@ -0,0 +1,184 @@
+"""Parallel segmented scans of the identity vault.
+
+A scan is split into DynamoDB scan segments, each paged by a worker thread. Pages are handed back to the caller
+through a bounded queue as soon as they arrive, so results stream while the other segments are still being read.
+
+The number of segments is taken from the `scan_segments` config, or scaled up from MIN_SEGMENTS with the table item
+count when it is 0 (the default). Consumed read capacity can be capped with `scan_max_capacity_per_second` so that
+large scans do not starve the other readers of the table.
+
+Ex:
+scan = ParallelScan(dynamodb_client, "purple-identity-vault", ProjectionExpression="id, primary_email")
+for item in scan:
+    ...
+"""
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from cis_identity_vault.common import get_config
+
+
+logger = logging.getLogger(__name__)
+
+# The fixed number of segments scans used before they were sized from the item count
+MIN_SEGMENTS = 5
+# DynamoDB accepts up to 1,000,000 segments, we never want more threads than this
+MAX_SEGMENTS = 64
+# Table item counts are only refreshed by DynamoDB every ~6 hours, no point in asking more often
+ITEM_COUNT_TTL = 3600
+
+_item_counts = {}
+_item_counts_lock = threading.Lock()
+
+
+def table_item_count(dynamodb_client, table_name):
+    """
+    Returns the (approximate) item count of @table_name, cached for ITEM_COUNT_TTL seconds
+    @dynamodb_client a boto3 dynamodb client
+    @table_name str
+    """
+    now = time.monotonic()
+    with _item_counts_lock:
+        cached = _item_counts.get(table_name)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    item_count = dynamodb_client.describe_table(TableName=table_name)["Table"].get("ItemCount", 0)
+    with _item_counts_lock:
+        _item_counts[table_name] = (now + ITEM_COUNT_TTL, item_count)
+    return item_count
+
+
+class CapacityLimiter(object):
+    """
+    Caps the read capacity units consumed per second across all segments of a scan.
+    Capacity is only known once a page has been read, so workers pay after the fact and sleep off any debt.
+    """
+
+    def __init__(self, units_per_second, clock=time.monotonic, sleep=time.sleep):
+        """
+        @units_per_second float capacity units allowed per second, the first second's worth is available at once
+        @clock function returning the current time in seconds
+        @sleep function sleeping for a number of seconds
+        """
+        self.units_per_second = float(units_per_second)
+        self._clock = clock
+        self._sleep = sleep
+        self._available = self.units_per_second
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, units):
+        with self._lock:
+            now = self._clock()
+            self._available = min(
+                self.units_per_second, self._available + (now - self._last) * self.units_per_second
+            )
+            self._last = now
+            self._available -= units
+            debt = -self._available
+        if debt > 0:
+            self._sleep(debt / self.units_per_second)
+
+
+class ParallelScan(object):
+    def __init__(
+        self, dynamodb_client, table_name, segments=None, workers=None, max_capacity_per_second=None, **kwargs
+    ):
+        """
+        @dynamodb_client a boto3 dynamodb client
+        @table_name str
+        @segments int number of scan segments, sized from the table item count if None or 0
+        @workers int number of worker threads, defaults to one per segment up to the `scan_workers` config
+        @max_capacity_per_second float read capacity units per second the whole scan may consume, None or 0 for no cap
+        @kwargs extra `scan` parameters, e.g. ProjectionExpression, FilterExpression, ExpressionAttributeValues
+        """
+        self.config = get_config()
+        self.client = dynamodb_client
+        self.table_name = table_name
+        self.scan_kwargs = kwargs
+
+        if segments is None:
+            segments = self.config("scan_segments", namespace="cis", default="0", parser=int)
+        if not segments:
+            segments = self._auto_segments()
+        self.segments = max(1, min(MAX_SEGMENTS, segments))
+
+        if workers is None:
+            workers = self.config("scan_workers", namespace="cis", default="16", parser=int)
+        self.workers = max(1, min(self.segments, workers))
+
+        if max_capacity_per_second is None:
+            max_capacity_per_second = self.config(
+                "scan_max_capacity_per_second", namespace="cis", default="0", parser=float
+            )
+        self.limiter = CapacityLimiter(max_capacity_per_second) if max_capacity_per_second else None
+
+    def _auto_segments(self):
+        """Returns one segment per `scan_items_per_segment` items in the table, and no less than MIN_SEGMENTS."""
+        items_per_segment = self.config("scan_items_per_segment", namespace="cis", default="5000", parser=int)
+        try:
+            item_count = table_item_count(self.client, self.table_name)
+        except Exception as e:
+            logger.warning(
+                "Could not get the item count of {}, using {} segments: {}".format(self.table_name, MIN_SEGMENTS, e)
+            )
+            return MIN_SEGMENTS
+        return max(MIN_SEGMENTS, int(math.ceil(item_count / float(items_per_segment))))
+
+    def _scan_segment(self, segment, pages, stop):
+        """Pages through @segment, putting each page's items on the @pages queue until done or @stop is set."""
+        logger.debug("Getting segment: {} of total: {}".format(segment, self.segments))
+        kwargs = dict(self.scan_kwargs, TableName=self.table_name, TotalSegments=self.segments, Segment=segment)
+        if self.limiter is not None:
+            kwargs["ReturnConsumedCapacity"] = "TOTAL"
+
+        try:
+            while not stop.is_set():
+                response = self.client.scan(**kwargs)
+                if self.limiter is not None:
+                    self.limiter.consume(response.get("ConsumedCapacity", {}).get("CapacityUnits", 0))
+                self._put(pages, response.get("Items", []), stop)
+                if "LastEvaluatedKey" not in response:
+                    break
+                kwargs["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+        except Exception as e:
+            self._put(pages, e, stop)
+        finally:
+            self._put(pages, None, stop)
+
+    def _put(self, pages, page, stop):
+        # The consumer may have stopped reading, never block forever on a full queue
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def __iter__(self):
+        """Yields the scanned items, in no particular order, as pages complete."""
+        pages = queue.Queue(maxsize=self.workers * 2)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            for segment in range(self.segments):
+                executor.submit(self._scan_segment, segment, pages, stop)
+
+            remaining = self.segments
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    raise page
+                else:
+                    for item in page:
+                        yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
@@ -0,0 +1,403 @@
+import os
+import pytest
+import threading
+import time
+from botocore.exceptions import ClientError
+from cis_identity_vault import batch
+
+
+class InFlight(object):
+    """Counts the calls in flight. With @parties, each call waits until that many calls are in flight at once."""
+
+    def __init__(self, parties=None):
+        self.count = 0
+        self.max = 0
+        self.lock = threading.Lock()
+        self.barrier = threading.Barrier(parties, timeout=10) if parties else None
+
+    def __enter__(self):
+        with self.lock:
+            self.count += 1
+            self.max = max(self.max, self.count)
+        if self.barrier is not None:
+            self.barrier.wait()
+
+    def __exit__(self, *args):
+        with self.lock:
+            self.count -= 1
+
+
+class FakeDynamoDBClient(object):
+    """Stores items by id, and leaves the last @unprocessed keys of the next @throttled calls unprocessed."""
+
+    def __init__(self, ids, throttled=0, unprocessed=10):
+        self.items = {id: {"id": {"S": id}, "sequence_number": {"S": "1"}} for id in ids}
+        self.throttled = throttled
+        self.unprocessed = unprocessed
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def batch_get_item(self, RequestItems):
+        (table_name, request), = RequestItems.items()
+        with self.lock:
+            self.calls.append(request)
+            throttled = self.throttled > 0
+            self.throttled -= 1
+        keys = request["Keys"]
+        if len(keys) > 100:
+            raise ValueError("Too many keys")
+
+        processed, unprocessed = keys, []
+        if throttled:
+            processed, unprocessed = keys[:-self.unprocessed], keys[-self.unprocessed:]
+        response = {
+            "Responses": {
+                table_name: [self.items[key["id"]["S"]] for key in processed if key["id"]["S"] in self.items]
+            }
+        }
+        if unprocessed:
+            response["UnprocessedKeys"] = {table_name: dict(request, Keys=unprocessed)}
+        return response
+
+
+class FakeTransactionClient(object):
+    """Fails the transactions touching @conflicting ids on a conflict @conflicts times, and @failing ids for good."""
+
+    def __init__(self, conflicting=(), conflicts=1, failing=(), latency=0.0):
+        self.conflicting = set(conflicting)
+        self.conflicts = conflicts
+        self.failing = set(failing)
+        self.latency = latency
+        self.calls = []
+        self.written = []
+        self.lock = threading.Lock()
+        self.in_flight = InFlight()
+
+    def transact_write_items(self, TransactItems, **kwargs):
+        with self.in_flight:
+            time.sleep(self.latency)
+        ids = [batch._transaction_key(t)[1] for t in TransactItems]
+        assert len(TransactItems) <= 100 and len(set(ids)) == len(ids)
+        with self.lock:
+            self.calls.append(TransactItems)
+            if self.failing.intersection(ids):
+                reasons = [{"Code": "ConditionalCheckFailed"}]
+            elif self.conflicting.intersection(ids) and self.conflicts > 0:
+                self.conflicts -= 1
+                reasons = [{"Code": "None"}, {"Code": "TransactionConflict"}]
+            else:
+                self.written.extend(ids)
+                return {}
+        raise ClientError(
+            {"Error": {"Code": "TransactionCanceledException", "Message": "cancelled"}, "CancellationReasons": reasons},
+            "TransactWriteItems",
+        )
+
+
+class FakeWriteClient(object):
+    """Accepts @capacity items per @window seconds, the others are left unprocessed or the call is throttled."""
+
+    def __init__(self, capacity=100, window=0.05, latency=0.005, raise_throttling=False, failing=()):
+        self.capacity = capacity
+        self.window = window
+        self.latency = latency
+        self.raise_throttling = raise_throttling
+        self.failing = set(failing)
+        self.used = {}
+        self.calls = 0
+        self.written = {}
+        self.lock = threading.Lock()
+        self.in_flight = InFlight()
+
+    def batch_write_item(self, RequestItems):
+        (table_name, requests), = RequestItems.items()
+        assert len(requests) <= 25
+        with self.in_flight:
+            time.sleep(self.latency)
+        items = [r["PutRequest"]["Item"] for r in requests]
+        if self.failing.intersection(item["id"]["S"] for item in items):
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "invalid"}}, "BatchWriteItem")
+
+        with self.lock:
+            self.calls += 1
+            window = int(time.time() / self.window)
+            available = self.capacity - self.used.get(window, 0)
+            if available <= 0 and self.raise_throttling:
+                raise ClientError(
+                    {"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "slow down"}},
+                    "BatchWriteItem",
+                )
+            accepted = items[: max(0, available)]
+            self.used[window] = self.used.get(window, 0) + len(accepted)
+            for item in accepted:
+                self.written[item["id"]["S"]] = item
+        unprocessed = items[len(accepted):]
+        if unprocessed:
+            return {"UnprocessedItems": {table_name: [{"PutRequest": {"Item": item}} for item in unprocessed]}}
+        return {"UnprocessedItems": {}}
+
+
+def put(id, sequence_number="1", size=10):
+    return {
+        "Put": {
+            "Item": {"id": {"S": id}, "sequence_number": {"S": sequence_number}, "profile": {"S": "x" * size}},
+            "TableName": "purple-identity-vault",
+        }
+    }
+
+
+def key(id):
+    return '{"id": {"S": "%s"}}' % id
+
+
+class TestBatch(object):
+    def setup(self):
+        os.environ["CIS_ENVIRONMENT"] = "purple"
+        os.environ["CIS_REGION_NAME"] = "us-east-1"
+        os.environ["CIS_BATCH_BACKOFF"] = "0.001"
+
+    def teardown(self):
+        del os.environ["CIS_BATCH_BACKOFF"]
+
+    def test_chunks(self):
+        assert batch.chunks(list(range(5)), 2) == [[0, 1], [2, 3], [4]]
+        assert batch.chunks([], 2) == []
+
+    def test_batch_get_items(self):
+        client = FakeDynamoDBClient(["ad|{}".format(i) for i in range(0, 250, 2)])
+        keys = [{"id": {"S": "ad|{}".format(i)}} for i in range(250)]
+        items = batch.batch_get_items(client, "purple-identity-vault", keys, projection="id, sequence_number")
+        assert sorted(item["id"]["S"] for item in items) == sorted("ad|{}".format(i) for i in range(0, 250, 2))
+        assert len(client.calls) == 3
+        assert all(call["ProjectionExpression"] == "id, sequence_number" for call in client.calls)
+
+    def test_batch_get_items_unprocessed(self):
+        client = FakeDynamoDBClient(["ad|{}".format(i) for i in range(100)], throttled=2)
+        keys = [{"id": {"S": "ad|{}".format(i)}} for i in range(100)]
+        items = batch.batch_get_items(client, "purple-identity-vault", keys)
+        assert len(items) == 100
+        assert len(client.calls) == 3
+        assert len(client.calls[-1]["Keys"]) == 10
+
+    def test_batch_get_items_gives_up(self):
+        os.environ["CIS_BATCH_RETRIES"] = "2"
+        try:
+            client = FakeDynamoDBClient(["ad|1"], throttled=10, unprocessed=1)
+            with pytest.raises(RuntimeError):
+                batch.batch_get_items(client, "purple-identity-vault", [{"id": {"S": "ad|1"}}])
+            assert len(client.calls) == 3
+        finally:
+            del os.environ["CIS_BATCH_RETRIES"]
+
+    def test_find_by_ids(self):
+        from cis_identity_vault.models import user
+
+        class FakeTable(object):
+            name = "purple-identity-vault"
+
+        client = FakeDynamoDBClient(["ad|1", "ad|3"])
+        profile = user.Profile(FakeTable(), client, transactions=False)
+        existing = profile.find_by_ids(["ad|1", "ad|2", "ad|3", "ad|1"])
+        assert sorted(existing.keys()) == ["ad|1", "ad|3"]
+        assert existing["ad|1"]["sequence_number"]["S"] == "1"
+        assert len(client.calls) == 1
+
+    def test_find_or_create_batch(self):
+        from cis_identity_vault.models import user
+        from cis_profile import FakeUser
+        import json
+
+        class FakeTable(object):
+            name = "purple-identity-vault"
+
+        class FakeClient(FakeDynamoDBClient):
+            transact_items = []
+
+            def transact_write_items(self, TransactItems, **kwargs):
+                self.transact_items.extend(TransactItems)
+
+        profiles = []
+        for i in range(3):
+            fake_user = FakeUser(seed=i).as_dict()
+            profiles.append(
+                {
+                    "id": fake_user["user_id"]["value"],
+                    "user_uuid": fake_user["uuid"]["value"],
+                    "primary_email": fake_user["primary_email"]["value"],
+                    "primary_username": fake_user["primary_username"]["value"],
+                    "sequence_number": str(i),
+                    "profile": json.dumps(fake_user),
+                }
+            )
+        client = FakeClient([profiles[1]["id"]])
+        res_create, res_update = user.Profile(FakeTable(), client, transactions=True).find_or_create_batch(profiles)
+        assert res_create["sequence_numbers"] == ["0", "2"]
+        assert res_update["sequence_numbers"] == ["1"]
+        assert len(client.calls) == 1
+
+    def test_transaction_waves(self):
+        items = [put("ad|{}".format(i)) for i in range(250)]
+        waves = batch.transaction_waves(items)
+        assert [len(chunk) for chunk in waves[0]] == [100, 100, 50]
+
+        items = [put("ad|{}".format(i), size=1024 * 1024) for i in range(10)]
+        waves = batch.transaction_waves(items)
+        assert [len(chunk) for chunk in waves[0]] == [3, 3, 3, 1]
+
+        # The same item twice goes to a later wave
+        items = [put("ad|1", "1"), put("ad|2"), put("ad|1", "2")]
+        waves = batch.transaction_waves(items)
+        assert waves == [[[put("ad|1", "1"), put("ad|2")]], [[put("ad|1", "2")]]]
+
+    def test_run_transactions(self):
+        client = FakeTransactionClient(conflicting=[key("ad|150")], failing=[key("ad|250")])
+        items = [put("ad|{}".format(i)) for i in range(300)]
+        outcomes = batch.run_transactions(client, items)
+        assert [outcome["status"] for outcome in outcomes] == ["200", "200", "500"]
+        assert [outcome["attempts"] for outcome in outcomes] == [1, 2, 1]
+        assert outcomes[2]["error"] is not None
+        # Only the conflicting chunk was retried, the failing one was not
+        assert len(client.calls) == 4
+        assert len(client.written) == 200
+
+    def test_profile_run_transaction(self):
+        from cis_identity_vault.models import user
+
+        client = FakeTransactionClient(failing=[key("ad|150")])
+        profile = user.Profile(None, client, transactions=True)
+        res = profile._run_transaction([put("ad|{}".format(i), str(i)) for i in range(200)])
+        assert res["status"] == "207"
+        assert res["sequence_numbers"] == [str(i) for i in range(100)]
+        assert res["failed_sequence_numbers"] == [str(i) for i in range(100, 200)]
+        assert res["failed_ids"] == ["ad|{}".format(i) for i in range(100, 200)]
+        assert [chunk["status"] for chunk in res["chunks"]] == ["200", "500"]
+        assert res["chunks"][1]["sequence_numbers"] == [str(i) for i in range(100, 200)]
+
+        res = profile._run_transaction([put("ad|1")])
+        assert res["status"] == "200"
+        with pytest.raises(ValueError):
+            profile._run_transaction([put("ad|150")])
+
+    def test_transactions_concurrency(self):
+        items = [put("ad|{}".format(i)) for i in range(800)]
+        client = FakeTransactionClient(latency=0.01)
+        assert len(batch.run_transactions(client, items, workers=1)) == 8
+        assert client.in_flight.max == 1
+
+        # All 8 chunks must be in flight at once for any of them to complete
+        client = FakeTransactionClient()
+        client.in_flight = InFlight(parties=8)
+        assert len(batch.run_transactions(client, items, workers=8)) == 8
+        assert len(client.written) == 800
+
+        client = FakeTransactionClient(latency=0.01)
+        batch.run_transactions(client, items, workers=4)
+        assert client.in_flight.max <= 4
+
+    def test_transactions_benchmark(self):
+        items = [put("ad|{}".format(i)) for i in range(800)]
+        client = FakeTransactionClient(latency=0.05)
+        start = time.time()
+        outcomes = batch.run_transactions(client, items, workers=1)
+        taken_serial = time.time() - start
+        start = time.time()
+        batch.run_transactions(client, items, workers=8)
+        taken = time.time() - start
+        assert len(outcomes) == 8
+        print("test_transactions_benchmark() 8 chunks: {}s serially, {}s concurrently".format(taken_serial, taken))
+
+    def test_batch_writer(self):
+        client = FakeWriteClient(capacity=1000)
+        items = [put("ad|{}".format(i))["Put"]["Item"] for i in range(100)]
+        items.append(put("ad|1", "2")["Put"]["Item"])
+        writer = batch.BatchWriter(client, "purple-identity-vault", workers=4)
+        results = writer.write(items)
+        assert len(results) == 101
+        assert all(result["status"] == "200" for result in results)
+        assert results[1]["id"] == "ad|1"
+        assert len(client.written) == 100
+        assert client.written["ad|1"]["sequence_number"]["S"] == "2"
+        assert client.calls == 4
+
+    def test_batch_writer_throttled(self):
+        for raise_throttling in [False, True]:
+            client = FakeWriteClient(capacity=60, raise_throttling=raise_throttling)
+            items = [put("ad|{}".format(i))["Put"]["Item"] for i in range(500)]
+            writer = batch.BatchWriter(client, "purple-identity-vault", workers=8, retries=50)
+            results = writer.write(items)
+            assert all(result["status"] == "200" for result in results)
+            assert len(client.written) == 500
+            assert writer.throttled > 0
+
+    def test_batch_writer_failures(self):
+        client = FakeWriteClient(capacity=1000, failing=["ad|30"])
+        items = [put("ad|{}".format(i))["Put"]["Item"] for i in range(50)]
+        results = batch.BatchWriter(client, "purple-identity-vault", workers=2).write(items)
+        assert [result["status"] for result in results] == ["200"] * 25 + ["500"] * 25
+        assert isinstance(results[30]["error"], ClientError)
+
+        client = FakeWriteClient(capacity=0)
+        results = batch.BatchWriter(client, "purple-identity-vault", retries=2).write(items[:1])
+        assert results[0]["status"] == "500"
+        assert client.calls == 3
+
+    def test_profile_put_items(self):
+        from cis_identity_vault.models import user
+        from cis_profile import FakeUser
+        import json
+
+        class FakeTable(object):
+            name = "purple-identity-vault"
+
+        profiles = []
+        for i in range(30):
+            fake_user = FakeUser(seed=i).as_dict()
+            profiles.append(
+                {
+                    "id": fake_user["user_id"]["value"],
+                    "user_uuid": fake_user["uuid"]["value"],
+                    "primary_email": fake_user["primary_email"]["value"],
+                    "primary_username": fake_user["primary_username"]["value"],
+                    "sequence_number": str(i),
+                    "profile": json.dumps(fake_user),
+                }
+            )
+        client = FakeWriteClient(capacity=1000, failing=[profiles[29]["id"]])
+        profile = user.Profile(FakeTable(), client, transactions=False)
+        res = profile.create_batch(profiles)
+        assert res["status"] == "207"
+        assert res["sequence_numbers"] == [str(i) for i in range(25)]
+        assert res["failed_sequence_numbers"] == [str(i) for i in range(25, 30)]
+        assert res["failed_ids"] == [profiles[i]["id"] for i in range(25, 30)]
+        assert res["items"][0] == {"id": profiles[0]["id"], "status": "200", "error": None, "sequence_number": "0"}
+        assert res["items"][29]["status"] == "500"
+        json.dumps(res)
+        active = bool(json.loads(profiles[0]["profile"])["active"]["value"])
+        assert client.written[profiles[0]["id"]]["active"] == {"BOOL": active}
+
+    def test_batch_writer_concurrency(self):
+        items = [put("ad|{}".format(i))["Put"]["Item"] for i in range(200)]
+        client = FakeWriteClient(capacity=100000, latency=0.01)
+        batch.BatchWriter(client, "purple-identity-vault", workers=1).write(items)
+        assert client.in_flight.max == 1
+
+        # All 8 requests of 25 items must be in flight at once for any of them to complete
+        client = FakeWriteClient(capacity=100000, latency=0)
+        client.in_flight = InFlight(parties=8)
+        results = batch.BatchWriter(client, "purple-identity-vault", workers=8).write(items)
+        assert all(result["status"] == "200" for result in results)
+        assert len(client.written) == 200
+
+        client = FakeWriteClient(capacity=100000, latency=0.01)
+        batch.BatchWriter(client, "purple-identity-vault", workers=4).write(items)
+        assert client.in_flight.max <= 4
+
+    def test_batch_writer_benchmark(self):
+        items = [put("ad|{}".format(i))["Put"]["Item"] for i in range(1000)]
+        timings = {}
+        for workers in [1, 8]:
+            client = FakeWriteClient(capacity=100000, latency=0.02)
+            start = time.time()
+            batch.BatchWriter(client, "purple-identity-vault", workers=workers).write(items)
+            timings[workers] = time.time() - start
+        print("test_batch_writer_benchmark() 1000 items: {}s with 1 worker, {}s with 8".format(timings[1], timings[8]))
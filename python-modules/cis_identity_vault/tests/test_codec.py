@@ -0,0 +1,165 @@
+import base64
+import json
+import os
+import pytest
+from boto3.dynamodb.types import Binary
+from cis_identity_vault import codec
+from cis_profile import FakeUser
+
+
+class FakeTable(object):
+    name = "purple-identity-vault"
+    table_name = "purple-identity-vault"
+
+    def __init__(self, items):
+        self.items = items
+
+    def query(self, **kwargs):
+        return {"Items": [dict(item) for item in self.items[:1]]}
+
+    def scan(self, **kwargs):
+        return {"Items": [dict(item) for item in self.items]}
+
+
+class TestCodec(object):
+    def setup(self):
+        os.environ["CIS_ENVIRONMENT"] = "purple"
+        os.environ["CIS_REGION_NAME"] = "us-east-1"
+        self.profile_json = json.dumps(FakeUser(seed=1337).as_dict())
+
+    def test_encode_decode(self):
+        assert codec.encode_profile(self.profile_json, codec="plain") == self.profile_json
+        stored = codec.encode_profile(self.profile_json, codec="zlib")
+        assert stored.startswith(codec.ZLIB_MARKER)
+        assert len(stored) < len(self.profile_json)
+        assert codec.decode_profile(stored) == self.profile_json
+        assert codec.decode_profile(Binary(stored)) == self.profile_json
+        assert codec.decode_profile(self.profile_json) == self.profile_json
+
+        with pytest.raises(ValueError):
+            codec.decode_profile(b"not a profile")
+        with pytest.raises(ValueError):
+            codec.encode_profile(self.profile_json, codec="zstd")
+
+    def test_configured_codec(self):
+        assert codec.get_codec() == "plain"
+        os.environ["CIS_PROFILE_STORAGE_CODEC"] = "zlib"
+        try:
+            assert codec.get_codec() == "zlib"
+            assert codec.profile_attribute(self.profile_json)["B"].startswith(codec.ZLIB_MARKER)
+        finally:
+            del os.environ["CIS_PROFILE_STORAGE_CODEC"]
+        assert codec.profile_attribute(self.profile_json) == {"S": self.profile_json}
+
+    def test_configured_sparse(self):
+        assert codec.get_sparse() is False
+        os.environ["CIS_PROFILE_STORAGE_SPARSE"] = "true"
+        try:
+            assert codec.get_sparse() is True
+        finally:
+            del os.environ["CIS_PROFILE_STORAGE_SPARSE"]
+
+    def test_decode_item(self):
+        stored = codec.encode_profile(self.profile_json, codec="zlib")
+        assert codec.decode_item({"id": "ad|foo", "profile": Binary(stored)})["profile"] == self.profile_json
+        assert codec.decode_item({"id": {"S": "ad|foo"}, "profile": {"B": stored}})["profile"] == {
+            "S": self.profile_json
+        }
+        # Stream record, as delivered to a lambda function
+        stream_image = {"id": {"S": "ad|foo"}, "profile": {"B": base64.b64encode(stored).decode("ascii")}}
+        assert codec.decode_item(stream_image)["profile"] == {"S": self.profile_json}
+        assert codec.decode_item({"id": {"S": "ad|foo"}, "profile": {"S": self.profile_json}})["profile"] == {
+            "S": self.profile_json
+        }
+        assert codec.decode_item({"id": {"S": "ad|foo"}}) == {"id": {"S": "ad|foo"}}
+
+    def test_mixed_format_table(self):
+        from cis_identity_vault.models import user
+
+        items = [
+            {"id": "ad|plain", "profile": self.profile_json},
+            {"id": "ad|zlib", "profile": Binary(codec.encode_profile(self.profile_json, codec="zlib"))},
+        ]
+        profile = user.Profile(FakeTable(items), None, transactions=False)
+        assert profile.codec == "plain"
+        for item in profile.all_by_page()["Items"] + profile.all:
+            assert item["profile"] == self.profile_json
+        items.reverse()
+        assert profile.find_by_id("ad|zlib")["Items"][0]["profile"] == self.profile_json
+        assert profile.find_by_email("foo@example.com")["Items"][0]["profile"] == self.profile_json
+
+    def test_compressed_writes(self):
+        from cis_identity_vault.models import user
+
+        class FakeClient(object):
+            transact_items = []
+
+            def transact_write_items(self, TransactItems, **kwargs):
+                self.transact_items.extend(TransactItems)
+
+        fake_user = json.loads(self.profile_json)
+        vault_profile = {
+            "id": fake_user["user_id"]["value"],
+            "user_uuid": fake_user["uuid"]["value"],
+            "primary_email": fake_user["primary_email"]["value"],
+            "primary_username": fake_user["primary_username"]["value"],
+            "sequence_number": "1",
+            "profile": self.profile_json,
+        }
+        client = FakeClient()
+        profile = user.Profile(FakeTable([]), client, transactions=True, codec="zlib")
+        profile.create(vault_profile)
+        profile.update(vault_profile)
+        assert codec.decode_profile(client.transact_items[0]["Put"]["Item"]["profile"]["B"]) == self.profile_json
+        stored = client.transact_items[1]["Update"]["ExpressionAttributeValues"][":p"]["B"]
+        assert codec.decode_profile(stored) == self.profile_json
+
+    def test_sparse_writes(self):
+        from cis_identity_vault.models import user
+        from cis_profile import User
+        from cis_profile.view import ProfileView
+
+        class FakeClient(object):
+            transact_items = []
+
+            def transact_write_items(self, TransactItems, **kwargs):
+                self.transact_items.extend(TransactItems)
+
+        null_user = User(user_id="ad|test", primary_email="test@example.com")
+        profile_json = null_user.as_json()
+        vault_profile = {
+            "id": "ad|test",
+            "user_uuid": "",
+            "primary_email": "test@example.com",
+            "primary_username": "",
+            "sequence_number": "1",
+            "profile": profile_json,
+        }
+        client = FakeClient()
+        profile = user.Profile(FakeTable([]), client, transactions=True, codec="zlib", sparse=True)
+        profile.create(vault_profile)
+        stored = codec.decode_profile(client.transact_items[0]["Put"]["Item"]["profile"]["B"])
+        assert len(stored) < len(profile_json) / 4
+        assert ProfileView(stored).as_dict() == json.loads(profile_json)
+        assert json.loads(User(user_structure_json=stored).as_json()) == json.loads(profile_json)
+        # Sparse profiles are never stored unless asked to
+        assert codec.encode_profile(profile_json, codec="plain") == profile_json
+
+    def test_codec_benchmark(self):
+        import time
+
+        stored = {name: codec.encode_profile(self.profile_json, codec=name) for name in codec.CODECS}
+        timings = {}
+        for name in codec.CODECS:
+            start = time.time()
+            for _ in range(100):
+                json.loads(codec.decode_profile(stored[name]))
+            timings[name] = (time.time() - start) / 100
+
+        # A scan page holds up to 1MB of items, so a scan of the table takes that many fewer pages
+        pages = {name: 10000 * len(stored[name]) / (1024 * 1024) for name in codec.CODECS}
+        print(
+            "test_codec_benchmark() profile size: {}, decode and parse time: {}, scan pages for 10000 profiles: "
+            "{}".format({name: len(stored[name]) for name in codec.CODECS}, timings, pages)
+        )
+        assert len(stored["zlib"]) < len(stored["plain"]) / 2
@@ -0,0 +1,156 @@
+import os
+import pytest
+import threading
+import time
+from cis_identity_vault import parallel_scan
+
+
+class FakeDynamoDBClient(object):
+    """Serves @item_count items, split evenly across segments, @page_size items per scan page."""
+
+    def __init__(self, item_count=1000, page_size=50, latency=0.0):
+        self.item_count = item_count
+        self.page_size = page_size
+        self.latency = latency
+        self.scan_calls = []
+        self.describe_calls = 0
+        self.fail_segment = None
+        self.lock = threading.Lock()
+
+    def describe_table(self, TableName):
+        self.describe_calls += 1
+        return {"Table": {"TableName": TableName, "ItemCount": self.item_count}}
+
+    def scan(self, **kwargs):
+        with self.lock:
+            self.scan_calls.append(kwargs)
+        time.sleep(self.latency)
+        if kwargs["Segment"] == self.fail_segment:
+            raise ValueError("Segment failed")
+
+        ids = list(range(kwargs["Segment"], self.item_count, kwargs["TotalSegments"]))
+        start = kwargs.get("ExclusiveStartKey", {"n": 0})["n"]
+        response = {
+            "Items": [{"id": {"S": "email|{}".format(i)}} for i in ids[start:start + self.page_size]],
+            "ConsumedCapacity": {"CapacityUnits": 10.0},
+        }
+        if start + self.page_size < len(ids):
+            response["LastEvaluatedKey"] = {"n": start + self.page_size}
+        return response
+
+
+class FakeClock(object):
+    """A clock which only moves when slept on."""
+
+    def __init__(self):
+        self.time = 0.0
+        self.sleeps = []
+
+    def now(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.time += seconds
+
+
+class RecordingLimiter(object):
+    def __init__(self, consumed):
+        self.consumed = consumed
+        self.lock = threading.Lock()
+
+    def consume(self, units):
+        with self.lock:
+            self.consumed.append(units)
+
+
+class TestParallelScan(object):
+    def setup(self):
+        os.environ["CIS_ENVIRONMENT"] = "purple"
+        os.environ["CIS_REGION_NAME"] = "us-east-1"
+        parallel_scan._item_counts.clear()
+
+    def test_all_items_scanned(self):
+        client = FakeDynamoDBClient(item_count=1000)
+        scan = parallel_scan.ParallelScan(client, "purple-identity-vault", segments=4, ProjectionExpression="id")
+        items = list(scan)
+        assert len(items) == 1000
+        assert len(set(item["id"]["S"] for item in items)) == 1000
+        assert set(call["Segment"] for call in client.scan_calls) == {0, 1, 2, 3}
+        assert all(call["ProjectionExpression"] == "id" for call in client.scan_calls)
+
+    def test_segments_sized_from_item_count(self):
+        client = FakeDynamoDBClient(item_count=52000)
+        scan = parallel_scan.ParallelScan(client, "purple-identity-vault")
+        assert scan.segments == 11
+        parallel_scan.ParallelScan(client, "purple-identity-vault")
+        assert client.describe_calls == 1
+
+        # Small tables still get the segments of a fixed size scan
+        parallel_scan._item_counts.clear()
+        client = FakeDynamoDBClient(item_count=0)
+        assert parallel_scan.ParallelScan(client, "purple-identity-vault").segments == parallel_scan.MIN_SEGMENTS
+
+        parallel_scan._item_counts.clear()
+        client.describe_table = None
+        assert parallel_scan.ParallelScan(client, "purple-identity-vault").segments == parallel_scan.MIN_SEGMENTS
+
+    def test_segment_failure_raises(self):
+        client = FakeDynamoDBClient(item_count=1000)
+        client.fail_segment = 2
+        with pytest.raises(ValueError):
+            list(parallel_scan.ParallelScan(client, "purple-identity-vault", segments=4))
+
+    def test_stop_early(self):
+        client = FakeDynamoDBClient(item_count=10000, page_size=10)
+        scan = iter(parallel_scan.ParallelScan(client, "purple-identity-vault", segments=4, workers=4))
+        next(scan)
+        scan.close()
+        time.sleep(0.5)
+        calls = len(client.scan_calls)
+        time.sleep(0.5)
+        assert len(client.scan_calls) == calls
+        assert calls < 100
+
+    def test_capacity_limiter(self):
+        clock = FakeClock()
+        limiter = parallel_scan.CapacityLimiter(100.0, clock=clock.now, sleep=clock.sleep)
+        # The first second's worth of units is free
+        limiter.consume(100)
+        assert clock.sleeps == []
+        # Then debts are slept off
+        limiter.consume(50)
+        assert clock.sleeps == [0.5]
+        limiter.consume(50)
+        assert clock.sleeps == [0.5, 0.5]
+        # Unused capacity does not pile up over a second's worth
+        clock.time += 10
+        limiter.consume(100)
+        limiter.consume(20)
+        assert clock.sleeps == [0.5, 0.5, 0.2]
+
+    def test_capacity_cap(self):
+        client = FakeDynamoDBClient(item_count=1600, page_size=50)
+        scan = parallel_scan.ParallelScan(
+            client, "purple-identity-vault", segments=4, max_capacity_per_second=100.0
+        )
+        assert scan.limiter.units_per_second == 100.0
+        consumed = []
+        scan.limiter = RecordingLimiter(consumed)
+        assert len(list(scan)) == 1600
+        assert all(call["ReturnConsumedCapacity"] == "TOTAL" for call in client.scan_calls)
+        # 32 pages of 10 units
+        assert consumed == [10.0] * 32
+
+        assert parallel_scan.ParallelScan(client, "purple-identity-vault", segments=4).limiter is None
+
+    def test_scan_benchmark(self):
+        timings = {}
+        for segments in [1, 2, 4, 8]:
+            client = FakeDynamoDBClient(item_count=1600, page_size=25, latency=0.01)
+            start = time.time()
+            items = list(parallel_scan.ParallelScan(client, "purple-identity-vault", segments=segments))
+            timings[segments] = time.time() - start
+            assert len(items) == 1600
+
+        print("test_scan_benchmark() seconds per segment count: {}".format(timings))
@@ -20,7 +20,7 @@ class Event(object):
         """
         self.config = common.get_config()
         self.event = event
-        self.secret_manager = secret.Manager()
+        self.secret_manager = secret.Manager(prefetch=["client_id", "client_secret"])
         self.access_token = None
 
     def to_notification(self):
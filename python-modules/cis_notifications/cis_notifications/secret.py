@@ -1,8 +1,6 @@
-import boto3
 import http.client
 import json
-import time
-from botocore.exceptions import ClientError
+from cis_crypto.secret import get_secret_cache
 from cis_notifications import common
 from logging import getLogger
 
@@ -57,39 +55,44 @@ class AuthZero(object):
 
 
 class Manager(object):
-    def __init__(self):
+    def __init__(self, prefetch=None):
+        """
+        @prefetch list of str names of the secrets this manager will be asked for. They are fetched along with the first
+        secret which is not cached yet, in a single SSM call.
+        """
         self.config = common.get_config()
         self.region_name = self.config("secret_manager_ssm_region", namespace="cis", default="us-west-2")
-        self.boto_session = boto3.session.Session(region_name=self.region_name)
-        self.ssm_client = self.boto_session.client("ssm")
+        self.prefetch = prefetch or []
+
+    def _parameter_name(self, secret_name):
+        ssm_namespace = self.config("secret_manager_ssm_path", namespace="cis", default="/iam")
+        return "{}/{}".format(ssm_namespace, secret_name)
 
     def secret(self, secret_name):
         """[summary]
         Fetch a secret from the ssm parameter store.
+        Secrets are cached process-wide and refreshed in the background (see cis_crypto.secret.SecretCache).
 
         Arguments:
             secret_name {[type]} -- [The name of the parameter to combine with the SSM path variable.]
 
         Returns:
-            [type] -- [The result of the query or None in the case the secret does not exist.]
+            [type] -- [The result of the query. Raises KeyError in the case the secret does not exist.]
+        """
+        name = self._parameter_name(secret_name)
+        prefetch = [self._parameter_name(prefetch_name) for prefetch_name in self.prefetch]
+        return get_secret_cache(self.region_name).get_many([name] + prefetch, optional=prefetch)[name]
+
+    def secrets(self, secret_names):
+        """[summary]
+        Fetch several secrets from the ssm parameter store, in a single SSM call if none of them are cached.
+
+        Arguments:
+            secret_names {[type]} -- [The names of the parameters to combine with the SSM path variable.]
+
+        Returns:
+            [type] -- [The list of results, in the same order as secret_names.]
         """
-        result = None
-        retry = 5
-        backoff = 1  # how long to sleep between attempts.
-
-        while result is None and retry != 0:
-            try:
-                ssm_namespace = self.config("secret_manager_ssm_path", namespace="cis", default="/iam")
-                ssm_response = self.ssm_client.get_parameter(
-                    Name="{}/{}".format(ssm_namespace, secret_name), WithDecryption=True
-                )
-                logger.debug("Secret manager SSM provider loading key: {}{}".format(ssm_namespace, secret_name))
-                result = ssm_response.get("Parameter", {})
-            except ClientError as e:
-                logger.error("Failed to fetch secret due to: {}".format(e))
-                retry = retry - 1
-                time.sleep(backoff)
-                backoff = backoff + 1
-                logger.debug("Backing off to try again.")
-        logger.debug("Secrets were returned from the function.")
-        return result["Value"]
+        names = [self._parameter_name(secret_name) for secret_name in secret_names]
+        secrets = get_secret_cache(self.region_name).get_many(names)
+        return [secrets[name] for name in names]
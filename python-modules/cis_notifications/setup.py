@@ -6,7 +6,7 @@ from setuptools import setup, find_packages
 with open("README.md", "r") as fh:
     long_description = fh.read()
 
-requirements = ["everett", "boto3", "configobj"]
+requirements = ["everett", "boto3", "configobj", "cis_crypto"]
 
 setup_requirements = ["pytest-runner", "setuptools>=40.5.0"]
 
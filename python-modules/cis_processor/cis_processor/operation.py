@@ -52,7 +52,9 @@ class BaseProcessor(object):
                 logger.info(
                     "Testing signatures for user: {}".format(self.profiles["new_profile"].as_dict()["user_id"]["value"])
                 )
-                signatures_valid = self.profiles["new_profile"].verify_all_signatures()
+                signatures_valid = self.profiles["new_profile"].verify_all_signatures(
+                    workers=self.config("signature_verification_workers", namespace="cis", default="1", parser=int)
+                )
                 logger.info(
                     "The result of signature checking for user: {} resulted in: {}".format(
                         self.profiles["new_profile"].as_dict()["user_id"]["value"], signatures_valid
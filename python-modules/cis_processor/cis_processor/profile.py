@@ -30,7 +30,7 @@ class ProfileDelegate(object):
         search_result = vault_user.find_by_id(user_id)
         if len(search_result.get("Items")) > 0:
             profile_data = search_result.get("Items")[0]
-            user_object = User(user_structure_json=json.loads(profile_data["profile"]))
+            user_object = User(user_structure_json=profile_data["profile"])
             logger.info("A prior integration has been found for user: {}".format(user_id))
             return user_object
         else:
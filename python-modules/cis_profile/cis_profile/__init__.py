@@ -4,7 +4,18 @@ from cis_profile.common import DotDict
 from cis_profile.common import MozillaDataClassification
 from cis_profile.fake_profile import FakeUser
 from cis_profile.common import DisplayLevel
+from cis_profile.view import ProfileView
 
 import cis_profile.exceptions
 
-__all__ = [User, FakeUser, DotDict, WellKnown, MozillaDataClassification, DotDict, cis_profile.exceptions, DisplayLevel]
+__all__ = [
+    User,
+    FakeUser,
+    DotDict,
+    WellKnown,
+    MozillaDataClassification,
+    DotDict,
+    cis_profile.exceptions,
+    DisplayLevel,
+    ProfileView,
+]
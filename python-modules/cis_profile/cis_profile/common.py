@@ -1,10 +1,14 @@
+import hashlib
 import json
 import os
 import os.path
 import time
+import tempfile
 import requests
+import sys
 import requests.exceptions
 import logging
+import threading
 
 from everett.ext.inifile import ConfigIniEnv
 from everett.manager import ConfigManager
@@ -13,6 +17,12 @@ from everett.manager import ConfigOSEnv
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_DISCOVERY_URL = "https://auth.mozilla.com/.well-known/mozilla-iam"
+
+# Process-wide WellKnown instances, keyed by (discovery_url, always_use_local_file). See `get_shared_well_known()`
+_shared_well_known = {}
+_shared_well_known_lock = threading.Lock()
+
 
 def get_config():
     return ConfigManager(
@@ -20,23 +30,29 @@ def get_config():
     )
 
 
+# Keys whose (string) values come from a small set (classification, display level, algorithms...).
+# These values and all keys repeat across all profiles, interning them lets every profile share one copy of each.
+# Keys that user data is also stored under (e.g. "name") are left out, their values are not from a small set.
+_INTERNED_VALUE_KEYS = frozenset(["classification", "display", "alg", "typ"])
+
+
 class DotDict(dict):
     """
     Convert a dict to a fake class/object with attributes, such as:
     test = dict({"test": {"value": 1}})
     test.test.value = 2
+
+    DotDict has no instance `__dict__` (attributes are the dict items), interns keys and enumerated values and
+    converts nested structures directly, so that large trees of these (such as user profiles) stay compact and cheap to
+    build.
     """
 
+    __slots__ = ()
+
     def __init__(self, *args, **kwargs):
-        dict.__init__(self, *args, **kwargs)
-        try:
-            # Python2
-            for k, v in self.iteritems():
-                self.__setitem__(k, v)
-        except AttributeError:
-            # Python3
-            for k, v in self.items():
-                self.__setitem__(k, v)
+        dict.__init__(self)
+        for k, v in dict(*args, **kwargs).items():
+            dict.__setitem__(self, _intern_key(k), DotDict.__convert(v, k))
 
     def __getattr__(self, k):
         try:
@@ -45,7 +61,7 @@ class DotDict(dict):
             raise AttributeError("'DotDict' object has no attribute '" + str(k) + "'")
 
     def __setitem__(self, k, v):
-        dict.__setitem__(self, k, DotDict.__convert(v))
+        dict.__setitem__(self, k, DotDict.__convert(v, k))
 
     __setattr__ = __setitem__
 
@@ -56,22 +72,52 @@ class DotDict(dict):
             raise AttributeError("'DotDict'  object has no attribute '" + str(k) + "'")
 
     @staticmethod
-    def __convert(o):
+    def __convert(o, k=None):
         """
         Recursively convert `dict` objects in `dict`, `list`, `set`, and
         `tuple` objects to `DotDict` objects.
+        @k the key @o is stored at, if any
         """
         if isinstance(o, dict):
-            o = DotDict(o)
+            # Skip __init__, we know the keys are unique and can fill the new DotDict directly
+            d = dict.__new__(DotDict)
+            for key, value in o.items():
+                dict.__setitem__(d, _intern_key(key), DotDict.__convert(value, key))
+            o = d
         elif isinstance(o, list):
-            o = list(DotDict.__convert(v) for v in o)
+            o = [DotDict.__convert(v) for v in o]
         elif isinstance(o, set):
             o = set(DotDict.__convert(v) for v in o)
         elif isinstance(o, tuple):
             o = tuple(DotDict.__convert(v) for v in o)
+        elif type(o) is str and k in _INTERNED_VALUE_KEYS:
+            o = sys.intern(o)
         return o
 
 
+def _intern_key(k):
+    return sys.intern(k) if type(k) is str else k
+
+
+def _dotdict_from_pairs(pairs):
+    d = dict.__new__(DotDict)
+    for k, v in pairs:
+        if type(v) is str and k in _INTERNED_VALUE_KEYS:
+            v = sys.intern(v)
+        dict.__setitem__(d, sys.intern(k), v)
+    return d
+
+
+def loads_dotdict(s):
+    """
+    Parses a JSON document straight into DotDict objects, which is faster than `DotDict(json.loads(s))` as it does
+    not need a second pass over the data.
+    @s str JSON document
+    Return DotDict (or whatever the top-level JSON value is)
+    """
+    return json.loads(s, object_pairs_hook=_dotdict_from_pairs)
+
+
 class MozillaDataClassification(DotDict):
     """
     See https://wiki.mozilla.org/Security/Data_Classification
@@ -109,9 +155,13 @@ class WellKnown(object):
     This object cannot fail to return the schema, but the schema is not garanteed to be up to date in case of network
     issues.
 
-    Tries to get the well-known URL and schema from local cache if the cache has not expired.
-    Else, tries to get the schema from well-known URL and cache it.
-    Else, uses a library-builtin copy of schema.
+    Each document (well-known, schema, publisher rules) goes through these tiers:
+    - memory cache, until `well_known_cache_ttl` expires
+    - disk cache, if fresh. If stale, it is returned right away and refreshed in the background
+    (stale-while-revalidate). Refreshes use HTTP conditional requests (ETag/If-Modified-Since)
+    - network, when there is no disk cache yet
+    - library-builtin copy, when all else failed or when in "bundle" mode (`always_use_local_file` or the
+    `well_known_bundle` setting), which never uses the network
 
     Return: dict Schema dictionary (can be converted to JSON)
 
@@ -122,30 +172,47 @@ class WellKnown(object):
     <Dict: schema>
     """
 
-    def __init__(self, discovery_url="https://auth.mozilla.com/.well-known/mozilla-iam", always_use_local_file=False):
-        self._request_cache = "/tmp/cis_request_cache"  # XXX use `get_config` to configure that
-        self._request_cache_ttl = 900
-        self._well_known_json = None
-        self._schema_json = None
+    # Bump this when the disk cache file format changes, older files are then ignored
+    CACHE_FORMAT_VERSION = 1
+
+    def __init__(self, discovery_url=DEFAULT_DISCOVERY_URL, always_use_local_file=False):
         self.discovery_url = discovery_url
         self.config = get_config()
-        self.always_use_local_file = always_use_local_file
+        self._request_cache = self.config("well_known_cache_path", namespace="cis", default="/tmp/cis_request_cache")
+        self._request_cache_ttl = self.config("well_known_cache_ttl", namespace="cis", default="900", parser=int)
+        self._request_timeout = self.config("well_known_request_timeout", namespace="cis", default="5", parser=int)
+        self.always_use_local_file = always_use_local_file or (
+            self.config("well_known_bundle", namespace="cis", default="false") == "true"
+        )
+        # Memory cache: {name: (expires_at, data)}. The lock ensures a single fetch per document while other callers
+        # wait for it (RLock because get_schema() and get_publisher_rules() call get_well_known())
+        self._memory_cache = {}
+        self._memory_cache_ttl = self._request_cache_ttl
+        self._memory_cache_lock = threading.RLock()
+        # Names of the documents being refreshed in the background
+        self._revalidating = set()
+
+    def __deepcopy__(self, memo):
+        # WellKnown objects are shared (see get_shared_well_known()), copies of objects holding one keep sharing it
+        return self
 
     def get_publisher_rules(self):
         """
-        Public wrapper for _load_rules
+        Returns the CIS publisher rules
         """
-        self._well_known_json = self.get_well_known()
-        rules_url = self._well_known_json.get("publishers_rules_uri")
-        return self.__cache_file(self._load_publisher_rules(rules_url), name="publisher_rules")
+        return self._get_document(
+            "publisher_rules",
+            lambda: self.get_well_known().get("publishers_rules_uri"),
+            "data/well-known/mozilla-iam-publisher-rules",
+        )
 
     def get_schema(self):
         """
-        Public wrapper for _load_well_known()
+        Returns the CIS Profile Schema
         """
-        self._well_known_json = self.get_well_known()
-        schema_url = self._well_known_json.get("api").get("data/profile_schema")
-        return self.__cache_file(self._load_schema(schema_url, stype="data/profile.schema"), name="schema")
+        return self._get_document(
+            "schema", lambda: self.get_well_known().get("api").get("data/profile_schema"), "data/profile.schema"
+        )
 
     def get_core_schema(self):
         """ Deprecated """
@@ -157,109 +224,242 @@ class WellKnown(object):
 
     def get_well_known(self):
         """
-        Public wrapper for _load_well_known
+        Returns the discovery url's data ("well-known")
         """
-        return self.__cache_file(self._load_well_known(), name="well_known")
+        return self._get_document("well_known", lambda: self.discovery_url, "data/well-known/mozilla-iam")
 
-    def __cache_file(self, data, name):
+    def expire(self):
         """
-        @data json dict
-        @name str name of the cached file, must be unique per file to cache
-        returns json dict of @data
+        Expire the memory cache so that the next call goes through the disk cache again
+        """
+        with self._memory_cache_lock:
+            self._memory_cache = {}
+
+    def _get_document(self, name, get_url, builtin_file):
         """
-        fpath = self._request_cache + "_" + name
-        if not os.path.isfile(fpath) or (os.stat(fpath).st_mtime > time.time() + self._request_cache_ttl):
-            logger.debug(
-                "Caching file (well-known endpoint) at {} for {} seconds".format(fpath, self._request_cache_ttl)
-            )
-            with open(fpath, "w+") as fd:
-                fd.write(json.dumps(data))
-            logger.debug("File to cache is {} lines long".format(len(data)))
+        @name str name of the document, must be unique per document
+        @get_url function returning the URL of the document (or None)
+        @builtin_file str path of the library-builtin copy of the document
+        returns json dict of the document
+        """
+        cached = self._memory_cache.get(name)
+        if cached is not None and cached[0] > time.time():
+            return cached[1]
+
+        with self._memory_cache_lock:
+            # Another thread may have refreshed the document while we were waiting for the lock
+            cached = self._memory_cache.get(name)
+            if cached is not None and cached[0] > time.time():
+                return cached[1]
+            logger.debug("Memory cache miss or expired for {} ({})".format(name, self.discovery_url))
+
+            data = None
+            url = None if self.always_use_local_file else get_url()
+            if url is not None:
+                entry = self._read_cache_file(name, url)
+                if entry is None:
+                    entry = self._fetch(url)
+                    if entry is not None:
+                        self._write_cache_file(name, url, entry)
+                elif entry["fetched_at"] + self._request_cache_ttl < time.time():
+                    logger.debug("Using stale cached file for {} while refreshing it".format(name))
+                    self._revalidate_in_background(name, url, entry)
+                if entry is not None:
+                    data = entry["data"]
+
+            # That did not work, fall-back to local, built-in copy
+            if data is None:
+                data = self._load_builtin_file(builtin_file)
+
+            self._memory_cache[name] = (time.time() + self._memory_cache_ttl, data)
             return data
-        else:
-            logger.debug("Using cached file (well-known endpoint) at {}".format(fpath))
-            with open(fpath, "r") as fd:
-                ret = fd.read()
-            logger.debug("Cached file is {} lines long".format(len(ret)))
-            return json.loads(ret)
 
-    def _load_publisher_rules(self, rules_url):
+    def _fetch(self, url, entry=None):
         """
-        Get the CIS integration rules
+        Fetches a JSON document, conditionally if @entry is passed
+        @url str URL of the document
+        @entry dict previous cache entry (see _read_cache_file()) or None
+        returns a new cache entry, or None on failure
         """
-        rules = None
-        if not self.always_use_local_file:
-            if rules_url is not None:
-                try:
-                    r = requests.get(rules_url)
-                    rules = r.json()
-                except (json.JSONDecodeError, requests.exceptions.ConnectionError) as e:
-                    logger.debug("Failed to load rules data from rules_url {} ({})".format(rules_url, e))
-        # Fall-back to built-in copy
-        if self.always_use_local_file or rules is None:
-            rules_file = "data/well-known/mozilla-iam-publisher-rules"
-            if not os.path.isfile(rules_file):
-                dirname = os.path.dirname(os.path.realpath(__file__))
-                path = dirname + "/" + rules_file
-            else:
-                path = rules_file
-
-            rules = json.load(open(path))
-        return rules
-
-    def _load_well_known(self):
+        headers = {}
+        if entry is not None:
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        try:
+            r = requests.get(url, headers=headers, timeout=self._request_timeout)
+            if entry is not None and r.status_code == 304:
+                logger.debug("Document at {} has not been modified".format(url))
+                # 304 responses may omit validators, keep the previous ones in that case
+                return dict(
+                    entry,
+                    fetched_at=time.time(),
+                    etag=r.headers.get("ETag", entry.get("etag")),
+                    last_modified=r.headers.get("Last-Modified", entry.get("last_modified")),
+                )
+            r.raise_for_status()
+            data = r.json()
+        except (ValueError, requests.exceptions.RequestException) as e:
+            logger.debug("Failed to fetch document from {} ({})".format(url, e))
+            return None
+
+        return {
+            "fetched_at": time.time(),
+            "etag": r.headers.get("ETag"),
+            "last_modified": r.headers.get("Last-Modified"),
+            "data": data,
+        }
+
+    def _revalidate_in_background(self, name, url, entry):
         """
-        Gets the discovery url's data ("well-known")
-        Return dict,None the well-known JSON data copy
+        Refreshes a stale document in a background thread, unless a refresh is already running for it
         """
-        # Memory cache
-        if self._well_known_json is not None:
-            return self._well_known_json
+        if name in self._revalidating:
+            return
+        self._revalidating.add(name)
 
-        if not self.always_use_local_file:
+        def revalidate():
             try:
-                r = requests.get(self.discovery_url)
-                self._well_known_json = r.json()
-            except (json.JSONDecodeError, requests.exceptions.ConnectionError) as e:
-                logger.debug("Failed to fetch schema url from discovery {} ({})".format(self.discovery_url, e))
-                logger.debug("Using builtin copy")
-
-        if self._well_known_json is None or self.always_use_local_file:
-            well_known_file = "data/well-known/mozilla-iam"  # Local fall-back
-            if not os.path.isfile(well_known_file):
-                dirname = os.path.dirname(os.path.realpath(__file__))
-                path = dirname + "/" + well_known_file
-            else:
-                path = well_known_file
-            self._well_known_json = json.load(open(path))
-
-        return self._well_known_json
-
-    def _load_schema(self, schema_url, stype="data/profile.schema"):
+                new_entry = self._fetch(url, entry)
+                if new_entry is not None:
+                    self._write_cache_file(name, url, new_entry)
+                    with self._memory_cache_lock:
+                        self._memory_cache[name] = (time.time() + self._memory_cache_ttl, new_entry["data"])
+            finally:
+                self._revalidating.discard(name)
+
+        threading.Thread(target=revalidate, name="cis_well_known_{}".format(name), daemon=True).start()
+
+    def _cache_file_path(self, name, url):
+        url_hash = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        return "{}_{}_{}.v{}".format(self._request_cache, name, url_hash, self.CACHE_FORMAT_VERSION)
+
+    def _read_cache_file(self, name, url):
         """
-        Loads JSON Schema from an URL
-        @schema_url: str,None the schema URL
-        @stype: str, type of schema to load. This is also the name of the library builtin, local copy.
-        Return dict JSON object which is the CIS Profile Schema
+        returns the cache entry dict for this document, or None if there is no usable cached file
         """
-        schema = None
-        if not self.always_use_local_file:
-            if schema_url is not None:
-                try:
-                    r = requests.get(schema_url)
-                    schema = r.json()
-                except (json.JSONDecodeError, requests.exceptions.ConnectionError) as e:
-                    logger.debug("Failed to load schema from schema_url {} ({})".format(schema_url, e))
-
-        # That did not work, fall-back to local, built-in copy
-        if schema is None or self.always_use_local_file:
-            # Builtin, hardcoded schema from library
-            schema_file = stype
-            if not os.path.isfile(schema_file):
-                dirname = os.path.dirname(os.path.realpath(__file__))
-                path = dirname + "/" + schema_file
-            else:
-                path = schema_file
-
-            schema = json.load(open(path))
-        return schema
+        fpath = self._cache_file_path(name, url)
+        try:
+            with open(fpath, "r") as fd:
+                entry = json.load(fd)
+        except (OSError, ValueError) as e:
+            logger.debug("No usable cached file at {} ({})".format(fpath, e))
+            return None
+        if entry.get("url") != url or "data" not in entry:
+            return None
+        logger.debug("Using cached file (well-known endpoint) at {}".format(fpath))
+        return entry
+
+    def _write_cache_file(self, name, url, entry):
+        """
+        Atomically writes the cache entry for this document: readers see either the previous or the new file
+        """
+        fpath = self._cache_file_path(name, url)
+        entry = dict(entry, url=url)
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(fpath) or ".", prefix=".cis_request_cache")
+        except OSError as e:
+            logger.debug("Could not write cached file at {} ({})".format(fpath, e))
+            return
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, fpath)
+            logger.debug("Caching file (well-known endpoint) at {}".format(fpath))
+        except OSError as e:
+            logger.debug("Could not write cached file at {} ({})".format(fpath, e))
+            os.unlink(tmp_path)
+
+    def _load_builtin_file(self, builtin_file):
+        """
+        Loads the library-builtin copy of a document
+        """
+        if not os.path.isfile(builtin_file):
+            dirname = os.path.dirname(os.path.realpath(__file__))
+            path = dirname + "/" + builtin_file
+        else:
+            path = builtin_file
+        logger.debug("Using builtin copy of {}".format(path))
+        with open(path) as fd:
+            return json.load(fd)
+
+
+class CompiledDocumentCache(object):
+    """
+    Process-wide cache of objects compiled from JSON documents (such as the schema or the publisher rules), so that
+    they are built once per document version rather than once per use.
+    Lookups are by document object first (documents usually come from the WellKnown memory cache, thus are the same
+    object), then by document content.
+
+    Ex:
+    validators = CompiledDocumentCache(ProfileValidator)
+    validators.get(WellKnown().get_schema())
+    """
+
+    def __init__(self, compile_document, max_size=8):
+        """
+        @compile_document function taking a document (dict) and returning the compiled object
+        @max_size int number of document versions to keep
+        """
+        self._compile_document = compile_document
+        self._max_size = max_size
+        self._by_id = {}
+        self._by_digest = {}
+        self._lock = threading.Lock()
+
+    def get(self, document):
+        """
+        Returns the compiled object for @document, compiling it if needed
+        """
+        cached = self._by_id.get(id(document))
+        # The document object is kept in the cache, so its id() cannot be reused by another object while cached
+        if cached is not None and cached[0] is document:
+            return cached[1]
+
+        digest = hashlib.sha256(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()
+        with self._lock:
+            compiled = self._by_digest.get(digest)
+            if compiled is None:
+                logger.debug("Compiling document {}".format(digest))
+                compiled = self._compile_document(document)
+                if len(self._by_digest) >= self._max_size:
+                    self._by_digest.clear()
+                self._by_digest[digest] = compiled
+            if len(self._by_id) >= self._max_size:
+                self._by_id.clear()
+            self._by_id[id(document)] = (document, compiled)
+        return compiled
+
+
+def get_shared_well_known(discovery_url=None, always_use_local_file=False):
+    """
+    Returns the process-wide WellKnown object for @discovery_url, creating it if needed.
+    All users of the same discovery URL share one memory cache, thus documents are only fetched once per TTL for the
+    whole process instead of once per WellKnown object.
+
+    @discovery_url str the well-known Mozilla IAM URL (defaults to CIS_DISCOVERY_URL or DEFAULT_DISCOVERY_URL)
+    @always_use_local_file bool passed to WellKnown()
+    Return WellKnown object
+    """
+    if discovery_url is None:
+        discovery_url = os.environ.get("CIS_DISCOVERY_URL", DEFAULT_DISCOVERY_URL)
+    key = (discovery_url, always_use_local_file)
+
+    wk = _shared_well_known.get(key)
+    if wk is None:
+        with _shared_well_known_lock:
+            wk = _shared_well_known.get(key)
+            if wk is None:
+                wk = WellKnown(discovery_url, always_use_local_file=always_use_local_file)
+                _shared_well_known[key] = wk
+    return wk
+
+
+def reset_shared_well_known():
+    """
+    Forget all process-wide WellKnown objects (mostly useful for tests)
+    """
+    with _shared_well_known_lock:
+        _shared_well_known.clear()
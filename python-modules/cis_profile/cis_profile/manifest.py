@@ -0,0 +1,56 @@
+"""
+Signature manifests: one signature per publisher and profile, instead of one signature per attribute.
+
+A manifest lists the (attribute path, payload hash) of every attribute a publisher published, sorted by path, and is
+signed once. Verifying a profile against its manifests is then one RSA verification per publisher, plus hashing each
+attribute. The hashed payload is the same as the one signed by per-attribute signatures (the attribute without its
+`signature` structure), so both kinds of signatures can coexist while publishers migrate.
+
+Manifests are not part of the profile schema: they are carried next to the profile, as a dict of
+{publisher name: manifest JWS}.
+
+Ex:
+manifests = {"ldap": user.sign_manifest("ldap")}
+user.verify_manifests(manifests)  # Attributes not covered by a manifest fall back to their own signature
+"""
+import hashlib
+import json
+
+
+# Bump when the manifest payload changes in an incompatible way
+MANIFEST_VERSION = 1
+
+
+def attribute_digest(attr):
+    """
+    Returns the hex SHA-256 of @attr's canonical JSON, without its signature structure
+    @attr dict a user attribute
+    """
+    attrnosig = {k: v for k, v in attr.items() if k != "signature"}
+    canonical = json.dumps(attrnosig, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def build_manifest(attributes, publisher_name):
+    """
+    Returns the manifest payload of @attributes
+    @attributes list of (attribute path, attribute), e.g. [("access_information.ldap", {...}), ...]
+    @publisher_name str the publisher signing the manifest
+    """
+    return {
+        "version": MANIFEST_VERSION,
+        "publisher": publisher_name,
+        "attributes": sorted([path, attribute_digest(attr)] for path, attr in attributes),
+    }
+
+
+def manifest_digests(payload, publisher_name):
+    """
+    Returns {attribute path: digest} of a verified manifest @payload
+    @payload dict a manifest, as returned by build_manifest()
+    @publisher_name str the publisher the manifest is expected to be signed by
+    Raises ValueError if the manifest is not a manifest of @publisher_name
+    """
+    if payload.get("version") != MANIFEST_VERSION or payload.get("publisher") != publisher_name:
+        raise ValueError("Not a version {} manifest of publisher {}".format(MANIFEST_VERSION, publisher_name))
+    return {path: digest for path, digest in payload["attributes"]}
@@ -1,12 +1,20 @@
 #!/usr/bin/env python
 
-from cis_profile.common import WellKnown
 from cis_profile.common import DotDict
 from cis_profile.common import MozillaDataClassification
 from cis_profile.common import DisplayLevel
+from cis_profile.common import get_shared_well_known
+from cis_profile.common import loads_dotdict
+from cis_profile.view import filter_attributes
 
+import concurrent.futures
 import cis_crypto.operation
+import copy
 import cis_profile.exceptions
+import cis_profile.manifest
+import cis_profile.publisher_rules
+import cis_profile.sparse
+import cis_profile.validator
 import jose.exceptions
 import json
 import json.decoder
@@ -21,13 +29,117 @@ try:
     from json.decoder import JSONDecodeError
 except ImportError:
     JSONDecodeError = ValueError
-import jsonschema
 import logging
 import os
+import threading
 import time
 
 logger = logging.getLogger(__name__)
 
+# Parsed library-builtin profile templates (such as data/user_profile_null.json), by path. See get_profile_from_file()
+_profile_templates = {}
+_profile_templates_lock = threading.Lock()
+
+
+def _clone_dotdict(o):
+    """
+    Fast structural copy of a profile template: JSON data is only made of dicts, lists and immutable scalars, which
+    lets us skip DotDict's conversion and copy.deepcopy()'s bookkeeping.
+    """
+    if isinstance(o, dict):
+        clone = dict.__new__(DotDict)
+        dict.update(clone, {k: _clone_dotdict(v) for k, v in o.items()})
+        return clone
+    elif isinstance(o, list):
+        return [_clone_dotdict(v) for v in o]
+    return o
+
+
+# Serializes what _dynamo_flatten() does not handle itself (numbers, sets, binary), exactly like boto3 does
+_dynamo_serializer = TypeSerializer()
+
+
+def _dynamo_flatten(o):
+    """
+    Flattens and serializes a profile value to the dynamodb low level form in a single pass. Empty strings are removed
+    from dicts and lists, and dicts with either a "value" or a "values" key (i.e. attributes) are replaced by it.
+    """
+    t = type(o)
+    if t is str:
+        return {"S": o}
+    elif o is None:
+        return {"NULL": True}
+    elif t is bool:
+        return {"BOOL": o}
+    elif isinstance(o, dict):
+        flat = {k: _dynamo_flatten(v) for k, v in o.items() if k != "" and v != ""}
+        if "value" in flat:
+            if "values" not in flat:
+                return flat["value"]
+        elif "values" in flat:
+            return flat["values"]
+        return {"M": flat}
+    elif isinstance(o, list):
+        return {"L": [_dynamo_flatten(v) for v in o if v != ""]}
+    return _dynamo_serializer.serialize(o)
+
+
+def _dynamo_flatten_plain(o):
+    """
+    Same as _dynamo_flatten() but outputs plain Python values, as used by boto3 resources.
+    """
+    if isinstance(o, dict):
+        flat = {k: _dynamo_flatten_plain(v) for k, v in o.items() if k != "" and v != ""}
+        if "value" in flat:
+            if "values" not in flat:
+                return flat["value"]
+        elif "values" in flat:
+            return flat["values"]
+        return flat
+    elif isinstance(o, list):
+        return [_dynamo_flatten_plain(v) for v in o if v != ""]
+    return o
+
+
+# Thread pools verifying signatures, by number of threads. See verify_users_signatures()
+_verification_pools = {}
+_verification_pools_lock = threading.Lock()
+
+
+def _get_verification_pool(workers):
+    with _verification_pools_lock:
+        pool = _verification_pools.get(workers)
+        if pool is None:
+            pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cis_profile_verify")
+            _verification_pools[workers] = pool
+        return pool
+
+
+def verify_users_signatures(users, workers=4, attribute_names=None):
+    """
+    Verifies the signatures of all attributes with a value of many users at once, with a bounded pool of threads
+    (RSA verification releases the GIL). This stops at the first invalid signature.
+    @users list of User
+    @workers int maximum number of threads verifying signatures
+    @attribute_names list of str attribute names to verify (see User.verify_all_signatures()), or None for all
+    Returns True, or raises cis_profile.exceptions.SignatureVerificationFailure on the first invalid signature
+    """
+    pool = _get_verification_pool(workers)
+    futures = []
+    for user in users:
+        verify = user._verify_attributes_task()
+        futures.extend(pool.submit(verify, attr) for _, attr in user._attributes_with_value(attribute_names))
+
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            # Raises the verification exception, if any
+            future.result()
+    except Exception:
+        for future in futures:
+            future.cancel()
+        raise
+    return True
+
 
 class User(object):
     """
@@ -47,28 +159,37 @@ class User(object):
     ```
     """
 
-    def __init__(self, user_structure_json=None, user_structure_json_file=None, discovery_url=None, **kwargs):
+    def __init__(
+        self, user_structure_json=None, user_structure_json_file=None, discovery_url=None, well_known=None, **kwargs
+    ):
         """
         @user_structure_json an existing user structure to load in this class
         @user_structure_json_file an existing user structure to load in this class, from a JSON file
         @discovery_url the well-known Mozilla IAM URL
+        @well_known cis_profile.common.WellKnown object to use. Defaults to the process-wide WellKnown object of
+        @discovery_url (see cis_profile.common.get_shared_well_known())
         @kwargs any user profile attribute name to override on initializing, eg "user_id='test'"
         """
-        if discovery_url is None:
-            discovery_url = os.environ.get("CIS_DISCOVERY_URL", "https://auth.mozilla.com/.well-known/mozilla-iam")
-        self.__well_known = WellKnown(discovery_url)
+        if well_known is None:
+            well_known = get_shared_well_known(discovery_url)
+        self.__well_known = well_known
 
         if user_structure_json is not None:
             # Auto-detect if the passed struct is a JSON string or JSON dict
             if isinstance(user_structure_json, str):
-                self.load(json.loads(user_structure_json))
+                # Parse directly into a private DotDict tree, no need to copy it again through load()
+                profile = loads_dotdict(user_structure_json)
+                if cis_profile.sparse.is_sparse(profile):
+                    profile = cis_profile.sparse.rehydrate(profile, copy_template=self.__copy_null_template)
+                self.__dict__.update(profile)
             else:
                 self.load(user_structure_json)
-        elif user_structure_json_file is not None:
-            self.load(self.get_profile_from_file(user_structure_json_file))
         else:
-            # Load builtin defaults
-            self.load(self.get_profile_from_file("data/user_profile_null.json"))
+            if user_structure_json_file is None:
+                # Load builtin defaults
+                user_structure_json_file = "data/user_profile_null.json"
+            # get_profile_from_file() returns a private copy, no need to copy it again through load()
+            self.__dict__.update(self.get_profile_from_file(user_structure_json_file))
 
         # Insert defaults from kwargs
         for kw in kwargs:
@@ -85,13 +206,35 @@ class User(object):
         self.__verifyop = cis_crypto.operation.Verify()
         self.__verifyop.well_known = self.__well_known.get_well_known()
 
+    def clone(self):
+        """
+        Returns a copy of this user. This is much cheaper than copy.deepcopy(): attributes are copied structurally (see
+        _clone_dotdict()), the WellKnown object is shared and the signing and verification operations are shallow
+        copies. Both users can then be modified independently.
+        """
+        clone = self.__class__.__new__(self.__class__)
+        for k, v in self.__dict__.items():
+            if not k.startswith("_"):
+                clone.__dict__[k] = _clone_dotdict(v)
+
+        clone.__well_known = self.__well_known
+        clone.__signop = copy.copy(self.__signop)
+        clone.__verifyop = copy.copy(self.__verifyop)
+        return clone
+
     def load(self, profile_json):
         """
         Load an existing JSON profile
         @profile_json: dict (e.g. from json.load() or json.loads())
         """
         logger.debug("Loading profile JSON data structure into class object")
-        self.__dict__.update(DotDict(profile_json))
+        profile = DotDict(profile_json)
+        if cis_profile.sparse.is_sparse(profile):
+            profile = cis_profile.sparse.rehydrate(profile, copy_template=self.__copy_null_template)
+        self.__dict__.update(profile)
+
+    def __copy_null_template(self):
+        return self.get_profile_from_file("data/user_profile_null.json")
 
     def get_profile_from_file(self, user_structure_json_path):
         """
@@ -104,7 +247,19 @@ class User(object):
             path = dirname + "/" + user_structure_json_path
         else:
             path = user_structure_json_path
-        return DotDict(json.load(open(path)))
+            with open(path) as fd:
+                return DotDict(json.load(fd))
+
+        # Library-builtin templates do not change, parse them once per process and hand out copies
+        template = _profile_templates.get(path)
+        if template is None:
+            with _profile_templates_lock:
+                template = _profile_templates.get(path)
+                if template is None:
+                    with open(path) as fd:
+                        template = _clone_dotdict(json.load(fd))
+                    _profile_templates[path] = template
+        return _clone_dotdict(template)
 
     def merge(self, user_to_merge_in, level=None, _internal_level=None):
         """
@@ -278,55 +433,29 @@ class User(object):
         user = self._clean_dict()
         return dict(user)
 
-    def as_dynamo_flat_dict(self):
+    def as_sparse_json(self):
+        """
+        Outputs a JSON version of this user without the attributes identical to the null profile template (see
+        cis_profile.sparse). Loading it as a User or a ProfileView gives the full profile back. Only pass it to readers
+        that load profiles this way, such as the identity vault.
+        """
+        return json.dumps(cis_profile.sparse.sparsify(self._clean_dict()))
+
+    def as_dynamo_flat_dict(self, low_level=True):
         """
         Flattens out User.as_dict() output into a simple structure without any signature or metadata.
         Effectively, this outputs something like this:
         ```{'uuid': '11c8a5c8-0305-4524-8b41-95970baba84c', 'user_id': 'email|c3cbf9f5830f1358e28d6b68a3e4bf15', ...```
-        `flatten()` is recursive.
+        Empty strings are removed (DynamoDB does not support them) and attributes are replaced by their value(s).
         Note that this form cannot be verified or validated back since it's missing all attributes!
+        @low_level bool True to output the dynamodb client form ({"S": ...}, {"M": ...}), False to output plain
+        Python values for boto3 resources (e.g. Table.put_item())
 
-        Return: dynamodb serialized low level dict of user in a "flattened" form for dynamodb consumption in particular
+        Return: dict of user in a "flattened" form for dynamodb consumption in particular
         """
         user = self._clean_dict()
-
-        def sanitize(attrs):
-            # Types whose values need no sanitization to serialize.
-            supported_base_types = [type(None), bool, int, float]
-
-            # Empty strings cannot be sanitized.
-            def is_nonempty_str(s):
-                return isinstance(s, str) and len(s) > 0
-
-            def not_empty_str(v):
-                return not isinstance(v, str) or is_nonempty_str(v)
-
-            if type(attrs) in supported_base_types or is_nonempty_str(attrs):
-                return attrs
-
-            # We want to remove empty strings from lists and sanitize everything else.
-            if isinstance(attrs, list):
-                cleaned = filter(not_empty_str, attrs)
-
-                return list(map(sanitize, cleaned))
-
-            # We are dealing with a dictionary.
-            cleaned = {
-                key: sanitize(value) for key, value in attrs.items() if not_empty_str(key) and not_empty_str(value)
-            }
-
-            # If we have a dictionary, we want to ensure it only has one of either
-            # the "value" key or "values" key.
-            has_value = "value" in cleaned
-            has_values = "values" in cleaned
-
-            if (has_value and not has_values) or (has_values and not has_value):
-                return cleaned.get("value", cleaned.get("values"))
-
-            return cleaned
-
-        serializer = TypeSerializer()
-        return {k: serializer.serialize(v) for k, v in sanitize(user).items()}
+        encode = _dynamo_flatten if low_level else _dynamo_flatten_plain
+        return {k: encode(v) for k, v in user.items() if k != "" and v != ""}
 
     def filter_scopes(self, scopes=MozillaDataClassification.PUBLIC, level=None):
         """
@@ -346,43 +475,60 @@ class User(object):
     def validate(self):
         """
         Validates against a JSON schema
+        Raises jsonschema.exceptions.ValidationError if the profile is invalid
         """
 
-        return jsonschema.validate(self.as_dict(), self.__well_known.get_schema())
+        return cis_profile.validator.get_validator(self.__well_known.get_schema()).validate(self.as_dict())
 
-    def verify_all_publishers(self, previous_user):
+    def verify_all_publishers(self, previous_user, attribute_names=None):
         """
         Verifies all child nodes have an allowed publisher set according to the rules
         @previous_user profile.User object is the previous user we're updating fields from. This allows for checking if
         fields are being updated (value is already set) or created (values are changed from `null`). It defaults to an
         empty profile (with a bunch of `null` values).
+        @attribute_names list of str only verify these attributes (see verify_all_signatures()), or None for all
 
         Ex: user.verify_all_publishers(cis_profile.profile.User()) #this checks against a brand new user
 
         Returns True on success, False if validation fails.
         """
+        # Snapshot the previous user and rules once for all attributes
+        previous = previous_user.as_dict()
+        rules = self._get_publisher_rules()
         for item in self.__dict__:
             if type(self.__dict__[item]) is not DotDict:
                 continue
             try:
                 attr = self.__dict__[item]
-                ret = self.verify_can_publish(attr, attr_name=item, previous_attribute=previous_user.as_dict()[item])
+                if "signature" in attr and not self._attribute_named(attribute_names, item):
+                    continue
+                ret = self.verify_can_publish(attr, attr_name=item, previous_attribute=previous[item], _rules=rules)
             except (AttributeError, KeyError):
                 # This is the 2nd level attribute match, see also initialize_timestamps()
+                ret = True
                 for subitem in self.__dict__[item]:
+                    if not self._attribute_named(attribute_names, item, subitem):
+                        continue
                     attr = self.__dict__[item][subitem]
                     ret = self.verify_can_publish(
                         attr,
                         attr_name=subitem,
                         parent_name=item,
-                        previous_attribute=previous_user.as_dict()[item][subitem],
+                        previous_attribute=previous[item][subitem],
+                        _rules=rules,
                     )
             if ret is not True:
                 logger.warning("Verification of publisher failed for attribute {}".format(attr))
                 return False
         return True
 
-    def verify_can_publish(self, attr, attr_name, parent_name=None, previous_attribute=None):
+    def _get_publisher_rules(self):
+        """
+        Returns the compiled publisher rules (cis_profile.publisher_rules.PublisherRules)
+        """
+        return cis_profile.publisher_rules.get_publisher_rules(self.__well_known.get_publisher_rules())
+
+    def verify_can_publish(self, attr, attr_name, parent_name=None, previous_attribute=None, _rules=None):
         """
         Verifies that the selected publisher is allowed to change this attribute.
         This works for both first-time publishers ('created' permission) and subsequent updates ('update' permission).
@@ -399,6 +545,7 @@ class User(object):
         considered to be "updated" from the current value stored in self.__dict__. Otherwise, it will check against
         the passed value if it's `null` or set, and consider it "created" if it's `null`, "updated" otherwise. Makes
         sense? Good!
+        @_rules PublisherRules the compiled rules to use, used internally to avoid looking them up for every attribute
 
         Return bool True on publisher allowed to publish, raise Exception otherwise.
         """
@@ -419,22 +566,12 @@ class User(object):
         # Rules JSON structure:
         # { "create": { "user_id": [ "publisherA", "publisherB"], ...}, "update": { "user_id": "publisherA",... }
         # I know `updators` is not English :)
-        # DO NOTE: "create" is a list while "update" is a single item/str (ie check in the list of creators, but check
-        # equality against updators). This is because we explicitely do not support multiple update mechanisms, while we
-        # do support multiple create mechanisms.
-        rules = self.__well_known.get_publisher_rules()
-        if parent_name is None:
-            allowed_creators = rules["create"][attr_name]
-            allowed_updators = rules["update"][attr_name]
-        else:
-            try:
-                allowed_creators = rules["create"][parent_name][attr_name]
-            except TypeError:  # This is not access_information, this is identities or staff_information
-                allowed_creators = rules["create"][parent_name]
-            try:
-                allowed_updators = rules["update"][parent_name][attr_name]
-            except TypeError:  # This is not access_information, this is identities or staff_information
-                allowed_updators = rules["update"][parent_name]
+        # DO NOTE: "create" is a list while "update" is a single item/str. This is because we explicitely do not support
+        # multiple update mechanisms, while we do support multiple create mechanisms. The compiled rules turn both into
+        # sets of publishers (see cis_profile.publisher_rules).
+        rules = _rules if _rules is not None else self._get_publisher_rules()
+        allowed_creators = rules.allowed(attr_name, "create", parent_name)
+        allowed_updators = rules.allowed(attr_name, "update", parent_name)
 
         # Do we have an attribute to check against?
         if previous_attribute is not None:
@@ -459,7 +596,7 @@ class User(object):
                         "[noop] {} skipped verification for  {} (no changes)".format(publisher_name, attr_name)
                     )
                     return True
-                elif publisher_name == allowed_updators:
+                elif publisher_name in allowed_updators:
                     logger.debug("[update] {} is allowed to publish field {}".format(publisher_name, attr_name))
                     return True
 
@@ -469,7 +606,7 @@ class User(object):
                 operation = "create"
                 logger.debug("[create] {} is allowed to publish field {}".format(publisher_name, attr_name))
                 return True
-            elif publisher_name == allowed_updators:
+            elif publisher_name in allowed_updators:
                 logger.debug("[update] {} is allowed to publish field {}".format(publisher_name, attr_name))
                 return True
             else:
@@ -489,29 +626,66 @@ class User(object):
             "[{}] {} is NOT allowed to publish field {}".format(operation, publisher_name, attr_name)
         )
 
-    def verify_all_signatures(self):
+    def verify_all_signatures(self, workers=None, attribute_names=None):
         """
         Verifies all child nodes with a non-null value's signature against a publisher signature
+        @workers int number of threads verifying attributes concurrently. None or 1 to verify them one by one.
+        @attribute_names list of str only verify these attributes, or None for all. Names are as returned by merge(),
+        e.g. ["first_name", "ldap"]: subattributes can be named by their own name ("ldap"), their dotted name
+        ("access_information.ldap") or their parent's name ("access_information", for all of them).
+        Raises cis_profile.exceptions.SignatureVerificationFailure on the first invalid signature
+        """
+        if workers is None or workers <= 1:
+            for attr_name, attr in self._attributes_with_value(attribute_names):
+                logger.debug("Verifying attribute {}".format(attr_name))
+                self._verify_attribute_signature(attr)
+            return True
+        return verify_users_signatures([self], workers=workers, attribute_names=attribute_names)
+
+    def _attributes_with_value(self, attribute_names=None):
+        """
+        Returns list of (attribute name, attribute) of all attributes with a non-null value(s), e.g.
+        [("user_id", {...}), ("access_information.ldap", {...}), ...]
+        @attribute_names list of str only return these attributes (see verify_all_signatures()), or None for all
         """
+        attrs = []
         for item in self.__dict__:
             if type(self.__dict__[item]) is not DotDict:
                 continue
             try:
                 attr = self.__dict__[item]
-                if self._attribute_value_set(attr):
-                    logger.debug("Verifying attribute {}".format(item))
-                    attr = self._verify_attribute_signature(attr)
+                if self._attribute_value_set(attr) and self._attribute_named(attribute_names, item):
+                    attrs.append((item, attr))
             except KeyError:
                 # This is the 2nd level attribute match, see also initialize_timestamps()
                 for subitem in self.__dict__[item]:
                     attr = self.__dict__[item][subitem]
-                    if self._attribute_value_set(attr):
-                        logger.debug("Verifying attribute {}.{}".format(item, subitem))
-                        attr = self._verify_attribute_signature(attr)
-            if attr is None:
-                logger.warning("Verification failed for attribute {}".format(attr))
-                return False
-        return True
+                    if self._attribute_value_set(attr) and self._attribute_named(attribute_names, item, subitem):
+                        attrs.append(("{}.{}".format(item, subitem), attr))
+        return attrs
+
+    @staticmethod
+    def _attribute_named(attribute_names, item, subitem=None):
+        """
+        Returns True if the attribute @item (or its subattribute @subitem) is listed in @attribute_names, as merge()
+        reports them: a subattribute matches by its own name, its dotted name or its parent's name.
+        Everything matches when @attribute_names is None.
+        """
+        if attribute_names is None or item in attribute_names:
+            return True
+        return subitem is not None and (subitem in attribute_names or "{}.{}".format(item, subitem) in attribute_names)
+
+    def _verify_attributes_task(self):
+        """
+        Returns a function verifying an attribute of this user, which can run concurrently with other such functions
+        (each has its own cis_crypto Verify operation)
+        """
+        verifyop = self.__verifyop
+
+        def verify(attr):
+            return self._verify_attribute_signature(attr, _verifyop=copy.copy(verifyop))
+
+        return verify
 
     def verify_attribute_signature(self, req_attr):
         """
@@ -525,13 +699,15 @@ class User(object):
             attr = self.__dict__[req_attrs[0]][req_attrs[1]]
         return self._verify_attribute_signature(attr)
 
-    def _verify_attribute_signature(self, attr, publisher_name=None):
+    def _verify_attribute_signature(self, attr, publisher_name=None, _verifyop=None):
         """
         Verify the signature of an attribute
         @attr dict a structure of this user to be verified
         @publisher_name str this is the name of the publisher that should be signing this attribute. If None, the
         publisher_name from the current user structure is used instead and no check is performed.
+        @_verifyop cis_crypto.operation.Verify to use instead of this user's. Used internally.
         """
+        verifyop = self.__verifyop if _verifyop is None else _verifyop
 
         if not self._attribute_value_set(attr):
             logger.error(
@@ -549,9 +725,12 @@ class User(object):
         logger.debug(
             "Attempting signature verification for publisher: {} and attribute: {}".format(publisher_name, attr)
         )
-        self.__verifyop.load(attr["signature"]["publisher"]["value"])
+        attrnosig = attr.copy()
+        del attrnosig["signature"]
+        # Detached signatures (see cis_crypto.operation.sign_detached()) are verified against the attribute itself
+        verifyop.load(attr["signature"]["publisher"]["value"], payload=attrnosig)
         try:
-            signed = json.loads(self.__verifyop.jws(publisher_name))
+            signed = json.loads(verifyop.jws(publisher_name))
         except jose.exceptions.JWSError as e:
             logger.warning("Attribute signature verification failure: {} ({})".format(attr, publisher_name))
             raise cis_profile.exceptions.SignatureVerificationFailure(
@@ -559,8 +738,6 @@ class User(object):
             )
 
         # Finally check our object matches the stored data
-        attrnosig = attr.copy()
-        del attrnosig["signature"]
 
         if signed is None:
             raise cis_profile.exceptions.SignatureVerificationFailure(
@@ -572,6 +749,71 @@ class User(object):
             )
         return attr
 
+    def sign_manifest(self, publisher_name):
+        """
+        Signs a manifest of all attributes with a non-null value(s) published by @publisher_name (see
+        cis_profile.manifest). Per-attribute signatures are not modified.
+        @publisher_name str a publisher name, which corresponds to the signing key
+        Returns str the manifest JWS
+        """
+        attrs = [
+            (attr_name, attr)
+            for attr_name, attr in self._attributes_with_value()
+            if attr["signature"]["publisher"]["name"] == publisher_name
+        ]
+        logger.debug("Signing a manifest of {} attributes with publisher {}".format(len(attrs), publisher_name))
+        self.__signop.load(cis_profile.manifest.build_manifest(attrs, publisher_name))
+        # Verifiers cannot rebuild the manifest itself, it must be attached
+        return self.__signop.jws(publisher_name, detached=False)
+
+    def verify_manifests(self, manifests, fallback=True, attribute_names=None):
+        """
+        Verifies all child nodes with a non-null value against the signed manifest of their publisher (see
+        cis_profile.manifest)
+        @manifests dict of {publisher name: manifest JWS}
+        @fallback bool if True, attributes which are not listed in their publisher's manifest are verified with their
+        own signature (see verify_all_signatures()). If False, they fail verification.
+        @attribute_names list of str only verify these attributes (see verify_all_signatures()), or None for all
+        Raises cis_profile.exceptions.SignatureVerificationFailure on the first invalid attribute
+        """
+        digests = {}
+        for attr_name, attr in self._attributes_with_value(attribute_names):
+            publisher_name = attr["signature"]["publisher"]["name"]
+            if publisher_name not in digests:
+                digests[publisher_name] = self._verify_manifest(manifests.get(publisher_name), publisher_name)
+
+            digest = digests[publisher_name].get(attr_name)
+            if digest is None:
+                if not fallback:
+                    raise cis_profile.exceptions.SignatureVerificationFailure(
+                        "Attribute {} is not in the manifest of publisher {}".format(attr_name, publisher_name)
+                    )
+                logger.debug("Attribute {} is not in a manifest, verifying its signature".format(attr_name))
+                self._verify_attribute_signature(attr)
+            elif digest != cis_profile.manifest.attribute_digest(attr):
+                raise cis_profile.exceptions.SignatureVerificationFailure(
+                    "Attribute {} does not match the manifest of publisher {}".format(attr_name, publisher_name)
+                )
+        return True
+
+    def _verify_manifest(self, manifest, publisher_name):
+        """
+        Verifies the @manifest JWS of @publisher_name
+        Returns dict {attribute path: digest}, empty if there is no manifest
+        """
+        if manifest is None:
+            return {}
+
+        self.__verifyop.load(manifest)
+        try:
+            payload = json.loads(self.__verifyop.jws(publisher_name))
+            return cis_profile.manifest.manifest_digests(payload, publisher_name)
+        except (jose.exceptions.JWSError, ValueError) as e:
+            logger.warning("Manifest signature verification failure for publisher {}".format(publisher_name))
+            raise cis_profile.exceptions.SignatureVerificationFailure(
+                "Manifest signature verification failure for publisher {} ({})".format(publisher_name, e)
+            )
+
     def sign_all(self, publisher_name, safety=True):
         """
         Sign all child nodes with a non-null value(s) OR empty values (strict=False)
@@ -584,6 +826,8 @@ class User(object):
         """
 
         logger.debug("Signing all profile fields that have a value set with publisher {}".format(publisher_name))
+        # Attributes are all signed at once, see _sign_attributes()
+        to_sign = []
         for item in self.__dict__:
             if type(self.__dict__[item]) is not DotDict:
                 continue
@@ -592,7 +836,7 @@ class User(object):
                 if self._attribute_value_set(attr, strict=True):
                     if attr["signature"]["publisher"]["name"] == publisher_name:
                         logger.debug("Signing attribute {}".format(item))
-                        attr = self._sign_attribute(attr, publisher_name)
+                        to_sign.append(attr)
                     else:
                         logger.error(
                             "Attribute has value set but wrong publisher set, cannot sign: {} (publisher: {})".format(
@@ -610,7 +854,7 @@ class User(object):
                     if self._attribute_value_set(attr, strict=True):
                         if attr["signature"]["publisher"]["name"] == publisher_name:
                             logger.debug("Signing attribute {}.{}".format(item, subitem))
-                            attr = self._sign_attribute(attr, publisher_name)
+                            to_sign.append(attr)
                         else:
                             logger.error(
                                 "Attribute has value set but wrong publisher set, cannot sign: {} (publisher: "
@@ -621,6 +865,8 @@ class User(object):
                                     "Attribute has value set but wrong publisher set, cannot" " sign", attr
                                 )
 
+        self._sign_attributes(to_sign, publisher_name)
+
     def sign_attribute(self, req_attr, publisher_name):
         """
         Sign a single attribute, including null/empty/unset attributes
@@ -670,6 +916,28 @@ class User(object):
         signing key
         This method will not allow signing NULL (None) attributes
         """
+        self.__signop.load(self._signature_payload(attr, publisher_name))
+        return self._set_signature(attr, publisher_name, self.__signop.jws(publisher_name))
+
+    def _sign_attributes(self, attrs, publisher_name):
+        """
+        Same as _sign_attribute() for a list of attributes, which are signed in a single batch (the signing key is
+        only prepared once)
+        @attrs list of CIS Profilev2 attributes
+        @publisher_name str a publisher name (will be set in signature.publisher.name) which corresponds to the
+        signing key
+        """
+        if len(attrs) == 0:
+            return attrs
+        payloads = [(self._signature_payload(attr, publisher_name), publisher_name) for attr in attrs]
+        signatures = cis_crypto.operation.BatchSign().jws(payloads)
+        return [self._set_signature(attr, publisher_name, sig) for attr, sig in zip(attrs, signatures)]
+
+    def _signature_payload(self, attr, publisher_name):
+        """
+        Returns the part of @attr that gets signed, i.e. the attribute without the signature structure itself
+        Raises SignatureRefused for NULL (None) attributes
+        """
         if not self._attribute_value_set(attr):
             logger.error(
                 "Disallowing signing of NULL (None) value(s) attribute: {} for publisher {}".format(
@@ -678,18 +946,20 @@ class User(object):
             )
             raise cis_profile.exceptions.SignatureRefused("Signing NULL (None) attribute is forbidden")
         logger.debug("Will sign {} for publisher {}".format(attr, publisher_name))
-        # Extract the attribute without the signature structure itself
         attrnosig = attr.copy()
         del attrnosig["signature"]
-        self.__signop.load(attrnosig)
+        return attrnosig
 
-        # Add the signed attribute back to the original complete attribute structure (with the signature struct)
-        # This ensure we also don't touch any existing non-publisher signatures
+    def _set_signature(self, attr, publisher_name, signature):
+        """
+        Adds the publisher @signature to the original complete attribute structure (with the signature struct)
+        This ensure we also don't touch any existing non-publisher signatures
+        """
         sigattr = attr["signature"]["publisher"]
         sigattr["name"] = publisher_name
         sigattr["alg"] = "RS256"  # Currently hardcoded in cis_crypto
         sigattr["typ"] = "JWS"  # ""
-        sigattr["value"] = self.__signop.jws(publisher_name)
+        sigattr["value"] = signature
         return attr
 
     def _filter_all(self, level, valid, check):
@@ -699,15 +969,4 @@ class User(object):
         @valid list of valid attributes values, i.e. attribute values that will be retained
         @check str the attribute to check
         """
-        todel = []
-        for attr in level.keys():
-            if attr.startswith("_") or not isinstance(level[attr], dict):
-                continue
-            if "metadata" not in level[attr].keys():
-                self._filter_all(valid=valid, level=level[attr], check=check)
-            elif level[attr]["metadata"][check] not in valid:
-                todel.append(attr)
-
-        for _ in todel:
-            logger.debug("Removing attribute {} because it's not in {}".format(_, valid))
-            del level[_]
+        filter_attributes(level=level, valid=valid, check=check)
@@ -0,0 +1,76 @@
+"""
+Compiled publisher rules.
+
+The rules document (WellKnown().get_publisher_rules()) looks like:
+{ "create": { "user_id": ["publisherA", "publisherB"], "access_information": { "ldap": ["ldap"] }, ...},
+  "update": { "user_id": "publisherA", "access_information": { "ldap": "ldap" }, ... } }
+
+"create" lists all allowed creators while "update" names the single allowed updator. Second level attributes
+(`access_information.ldap`) either have their own rule, or share the rule of their parent (`identities`,
+`staff_information`).
+
+PublisherRules flattens this into {(attribute path, operation): frozenset of publishers} so that checking a publisher
+is a single dict lookup.
+
+Ex:
+from cis_profile import publisher_rules
+rules = publisher_rules.get_publisher_rules(WellKnown().get_publisher_rules())
+"ldap" in rules.allowed("access_information.ldap", "create")
+"""
+import logging
+
+from cis_profile.common import CompiledDocumentCache
+
+
+logger = logging.getLogger(__name__)
+
+
+class PublisherRules(object):
+    OPERATIONS = ["create", "update"]
+
+    def __init__(self, rules):
+        """
+        @rules dict the publisher rules document
+        """
+        self._allowed = {}
+        for operation in self.OPERATIONS:
+            for attr_name, rule in rules.get(operation, {}).items():
+                if isinstance(rule, dict):
+                    for subattr_name, subrule in rule.items():
+                        self._allowed[("{}.{}".format(attr_name, subattr_name), operation)] = self._publishers(subrule)
+                else:
+                    self._allowed[(attr_name, operation)] = self._publishers(rule)
+
+    @staticmethod
+    def _publishers(rule):
+        if isinstance(rule, list):
+            return frozenset(rule)
+        return frozenset([rule])
+
+    def allowed(self, attr_name, operation, parent_name=None):
+        """
+        @attr_name str the attribute name (e.g. "ldap")
+        @operation str "create" or "update"
+        @parent_name str the attribute's parent name for second level attributes (e.g. "access_information")
+        Return frozenset of publisher names allowed to perform @operation on this attribute
+        Raises KeyError if there is no rule for this attribute
+        """
+        if parent_name is None:
+            return self._allowed[(attr_name, operation)]
+
+        allowed = self._allowed.get(("{}.{}".format(parent_name, attr_name), operation))
+        if allowed is None:
+            # The parent has a single rule for all its attributes
+            allowed = self._allowed[(parent_name, operation)]
+        return allowed
+
+
+_publisher_rules = CompiledDocumentCache(PublisherRules)
+
+
+def get_publisher_rules(rules):
+    """
+    Returns the process-wide PublisherRules for the @rules document, creating it if needed
+    @rules dict the publisher rules document (e.g. WellKnown().get_publisher_rules())
+    """
+    return _publisher_rules.get(rules)
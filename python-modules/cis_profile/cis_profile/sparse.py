@@ -0,0 +1,107 @@
+"""
+Sparse user profiles: profiles without the attributes that are identical to the null profile template.
+
+Most attributes of a stored profile are null, and each of them still carries the full `signature` and `metadata`
+structures of data/user_profile_null.json. A sparse profile leaves these attributes out and is marked with a
+`_sparse` key. Loading it (cis_profile.User, cis_profile.view.ProfileView) puts the missing attributes back from the
+null template, which is parsed once per process, so that the loaded profile is the same as the original.
+
+Only whole attributes are left out, e.g. `fun_title` or `access_information.hris`: an attribute that differs from the
+template in any way (value, signature, timestamps) is kept as is.
+
+Sparse profiles are only produced for identity vault storage (see cis_identity_vault.codec). Publishers post full
+profiles to the change service, which reads attributes such as `user_id` from the payload before loading it.
+
+Ex:
+stored = json.dumps(sparsify(user.as_dict()))  # or user.as_sparse_json()
+user = User(user_structure_json=stored)  # the full profile again
+"""
+import json
+import os
+import threading
+
+
+# Marks a sparse profile, and the version of the sparse encoding it uses
+SPARSE_KEY = "_sparse"
+SPARSE_VERSION = 1
+
+NULL_PROFILE_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "data/user_profile_null.json")
+
+_null_template = None
+_null_template_json = None
+_null_template_lock = threading.Lock()
+
+
+def null_template():
+    """
+    Returns the parsed null profile template. It is shared, do not modify it.
+    """
+    global _null_template, _null_template_json
+    if _null_template is None:
+        with _null_template_lock:
+            if _null_template is None:
+                with open(NULL_PROFILE_PATH) as fd:
+                    _null_template_json = fd.read()
+                _null_template = json.loads(_null_template_json)
+    return _null_template
+
+
+def copy_null_template():
+    """
+    Returns a private copy of the null profile template. Parsing it again is cheaper than copying the parsed one.
+    """
+    null_template()
+    return json.loads(_null_template_json)
+
+
+def _is_group(attr):
+    # 2nd level attributes such as `access_information` hold attributes instead of having metadata themselves
+    return isinstance(attr, dict) and "metadata" not in attr
+
+
+def is_sparse(profile):
+    """
+    Returns True if @profile is a sparse profile
+    @profile dict a parsed user profile
+    """
+    return isinstance(profile, dict) and SPARSE_KEY in profile
+
+
+def sparsify(profile):
+    """
+    Returns a sparse copy of @profile. Attributes are not copied, do not modify them.
+    @profile dict a parsed user profile, e.g. User.as_dict()
+    """
+    template = null_template()
+    sparse = {SPARSE_KEY: SPARSE_VERSION}
+    for k, v in profile.items():
+        if k == SPARSE_KEY:
+            continue
+        template_attr = template.get(k)
+        if isinstance(v, dict) and v == template_attr:
+            continue
+        if _is_group(v) and _is_group(template_attr):
+            v = {subk: subv for subk, subv in v.items() if subv != template_attr.get(subk)}
+        sparse[k] = v
+    return sparse
+
+
+def rehydrate(profile, copy_template=copy_null_template):
+    """
+    Returns the full profile of a sparse @profile, in the template attribute order. The attributes of @profile are
+    not copied.
+    @profile dict a parsed sparse user profile
+    @copy_template function returning a private copy of the null profile template, e.g. as a DotDict tree
+    """
+    full = copy_template()
+    for k, attr in profile.items():
+        if k == SPARSE_KEY:
+            continue
+        template_attr = full.get(k)
+        if _is_group(attr) and _is_group(template_attr):
+            for subk, subattr in attr.items():
+                # Plain dict API, DotDict would convert the attribute again
+                dict.__setitem__(template_attr, subk, subattr)
+        else:
+            dict.__setitem__(full, k, attr)
+    return full
@@ -0,0 +1,209 @@
+"""
+Compiled JSON Schema validation for user profiles.
+
+`jsonschema.validate()` checks the schema and builds a new validator on every call, then walks the schema through its
+generic keyword machinery. Profiles are validated a lot (once per converted employee by the HRIS publisher, once per
+record by the stream processor), so instead we:
+- build one validator per schema version, shared by the whole process (see get_validator())
+- compile the schema into plain Python checks when it only uses the keywords our profile schema uses. These are only
+used to tell that a profile is valid: invalid profiles always go through jsonschema so that errors are the same as
+before. Schemas using other keywords are validated by jsonschema only.
+
+Ex:
+from cis_profile import validator
+validator.validate(profile_dict)  # Raises jsonschema.exceptions.ValidationError
+"""
+import jsonschema
+import logging
+
+from cis_profile.common import CompiledDocumentCache
+from cis_profile.common import get_shared_well_known
+
+
+logger = logging.getLogger(__name__)
+
+
+class _UnsupportedSchema(Exception):
+    pass
+
+
+class _SchemaCompiler(object):
+    """
+    Compiles a draft-04 JSON Schema into a function returning True if an instance is valid, False otherwise.
+    Raises _UnsupportedSchema for keywords it does not know about.
+    """
+
+    # Keywords that do not change validation results
+    ANNOTATIONS = frozenset(["$schema", "$comment", "id", "title", "description", "default", "definitions", "format"])
+    TYPES = {
+        "object": lambda i: isinstance(i, dict),
+        "array": lambda i: isinstance(i, list),
+        "string": lambda i: isinstance(i, str),
+        "boolean": lambda i: isinstance(i, bool),
+        "null": lambda i: i is None,
+        "integer": lambda i: isinstance(i, int) and not isinstance(i, bool),
+        "number": lambda i: isinstance(i, (int, float)) and not isinstance(i, bool),
+    }
+
+    def __init__(self, schema):
+        self.schema = schema
+        self.refs = {}
+
+    def compile(self):
+        return self._compile(self.schema)
+
+    def _compile(self, node):
+        if not isinstance(node, dict):
+            raise _UnsupportedSchema("Schema node is not an object", node)
+
+        # Draft-04: all other keywords are ignored next to $ref
+        if "$ref" in node:
+            return self._ref(node["$ref"])
+
+        checks = []
+        for keyword, value in node.items():
+            if keyword in self.ANNOTATIONS or keyword in ["properties", "additionalProperties", "required"]:
+                continue
+            elif keyword == "type":
+                checks.append(self._type(value))
+            elif keyword == "enum":
+                checks.append(self._enum(value))
+            elif keyword == "allOf":
+                checks.extend([self._compile(subnode) for subnode in value])
+            elif keyword == "items":
+                checks.append(self._items(value))
+            else:
+                raise _UnsupportedSchema("Unsupported keyword", keyword)
+
+        if "properties" in node or "additionalProperties" in node or "required" in node:
+            checks.append(self._object(node))
+
+        if len(checks) == 0:
+            return lambda instance: True
+        elif len(checks) == 1:
+            return checks[0]
+        return lambda instance: all(check(instance) for check in checks)
+
+    def _ref(self, ref):
+        if not ref.startswith("#/"):
+            raise _UnsupportedSchema("Only local references are supported", ref)
+        if ref not in self.refs:
+            # Placeholder first, so that recursive references terminate
+            self.refs[ref] = None
+            target = self.schema
+            for part in ref[2:].split("/"):
+                target = target[part.replace("~1", "/").replace("~0", "~")]
+            self.refs[ref] = self._compile(target)
+
+        refs = self.refs
+        return lambda instance: refs[ref](instance)
+
+    def _type(self, types):
+        if isinstance(types, str):
+            types = [types]
+        checks = [self.TYPES[t] for t in types]
+        return lambda instance: any(check(instance) for check in checks)
+
+    def _enum(self, values):
+        if not all(isinstance(v, (str, int, float, bool, type(None))) for v in values):
+            raise _UnsupportedSchema("Only scalar enums are supported", values)
+        # JSON Schema does not consider True and 1 equal, Python does
+        values = [(v, isinstance(v, bool)) for v in values]
+        return lambda instance: any(instance == v and isinstance(instance, bool) == b for v, b in values)
+
+    def _items(self, items):
+        if not isinstance(items, dict):
+            raise _UnsupportedSchema("Only single schema items are supported", items)
+        check = self._compile(items)
+        return lambda instance: not isinstance(instance, list) or all(check(i) for i in instance)
+
+    def _object(self, node):
+        properties = {k: self._compile(v) for k, v in node.get("properties", {}).items()}
+        required = node.get("required", [])
+        additional = node.get("additionalProperties", True)
+        if isinstance(additional, dict):
+            additional = self._compile(additional)
+        elif not isinstance(additional, bool):
+            raise _UnsupportedSchema("Unsupported additionalProperties", additional)
+
+        def check(instance):
+            if not isinstance(instance, dict):
+                return True
+            for k in required:
+                if k not in instance:
+                    return False
+            for k, v in instance.items():
+                prop = properties.get(k)
+                if prop is not None:
+                    if not prop(v):
+                        return False
+                elif additional is False:
+                    return False
+                elif additional is not True and not additional(v):
+                    return False
+            return True
+
+        return check
+
+
+class ProfileValidator(object):
+    """
+    A JSON Schema validator for user profiles, built once per schema.
+    Use get_validator() rather than creating these directly, so that validators are shared.
+    """
+
+    def __init__(self, schema):
+        cls = jsonschema.validators.validator_for(schema)
+        cls.check_schema(schema)
+        self.schema = schema
+        self._validator = cls(schema)
+        self._check = None
+        if cls is jsonschema.Draft4Validator:
+            try:
+                self._check = _SchemaCompiler(schema).compile()
+            except (_UnsupportedSchema, KeyError) as e:
+                logger.debug("Schema cannot be compiled, using jsonschema only ({})".format(e))
+
+    def is_valid(self, profile):
+        """
+        @profile dict a user profile (e.g. User.as_dict())
+        Return bool True if the profile is valid
+        """
+        # Like validate(), jsonschema has the final say on profiles the compiled check refuses
+        if self._check is not None and self._check(profile):
+            return True
+        return self._validator.is_valid(profile)
+
+    def validate(self, profile):
+        """
+        @profile dict a user profile (e.g. User.as_dict())
+        Raises jsonschema.exceptions.ValidationError if the profile is invalid, just like jsonschema.validate()
+        """
+        if self._check is not None and self._check(profile):
+            return
+        error = jsonschema.exceptions.best_match(self._validator.iter_errors(profile))
+        if error is not None:
+            raise error
+
+
+_validators = CompiledDocumentCache(ProfileValidator)
+
+
+def get_validator(schema):
+    """
+    Returns the process-wide ProfileValidator for @schema, creating it if needed
+    @schema dict a profile JSON Schema (e.g. WellKnown().get_schema())
+    """
+    return _validators.get(schema)
+
+
+def validate(profile, schema=None):
+    """
+    Validates a user profile dict without building a User object
+    @profile dict a user profile
+    @schema dict a profile JSON Schema. Defaults to the schema of the process-wide WellKnown object
+    Raises jsonschema.exceptions.ValidationError if the profile is invalid
+    """
+    if schema is None:
+        schema = get_shared_well_known().get_schema()
+    return get_validator(schema).validate(profile)
@@ -0,0 +1,179 @@
+"""
+Read-only views of stored user profiles.
+
+Serving a profile (e.g. from the Person API) only needs to parse, filter and serialize it. Building a User for that
+also sets up WellKnown, cis_crypto signing/verification operations and a DotDict tree, which costs more than parsing
+the profile itself. ProfileView skips all of it and works on the plain parsed JSON.
+
+Ex:
+from cis_profile.view import ProfileView
+view = ProfileView(vault_item["profile"])
+if view.active:
+    view.filter_scopes(["PUBLIC"])
+    view.filter_display(["public", None])
+    return view.as_dict()
+
+To serve the same profile for several scope sets, project it instead: projections are compiled once per
+(classifications, display levels) pair, filter in a single pass and do not modify the profile.
+projection = get_projection(["PUBLIC"], ["public", None])
+public_profile = projection.apply(profile_dict)
+"""
+import functools
+import json
+import logging
+
+from cis_profile.common import MozillaDataClassification
+from cis_profile.common import DisplayLevel
+from cis_profile.sparse import is_sparse
+from cis_profile.sparse import rehydrate
+
+
+logger = logging.getLogger(__name__)
+
+
+def filter_attributes(level, valid, check):
+    """
+    Recursively filters out (i.e. deletes) attribute values.
+    @level dict of an attribute, or a whole profile (recurses through all attributes)
+    @valid list of valid attributes values, i.e. attribute values that will be retained
+    @check str the metadata attribute to check (i.e. "classification" or "display")
+    """
+    todel = []
+    for attr in level.keys():
+        if attr.startswith("_") or not isinstance(level[attr], dict):
+            continue
+        if "metadata" not in level[attr].keys():
+            filter_attributes(valid=valid, level=level[attr], check=check)
+        elif level[attr]["metadata"][check] not in valid:
+            todel.append(attr)
+
+    for _ in todel:
+        logger.debug("Removing attribute {} because it's not in {}".format(_, valid))
+        del level[_]
+
+
+class Projection(object):
+    """
+    A compiled classification/display filter. Use get_projection() rather than creating these directly, so that
+    projections are shared.
+    """
+
+    def __init__(self, classifications=None, display_levels=None):
+        """
+        @classifications iterable of str classifications to retain, or None to retain all classifications
+        @display_levels iterable of str display levels to retain, or None to retain all display levels
+        """
+        self.classifications = None if classifications is None else frozenset(classifications)
+        self.display_levels = None if display_levels is None else frozenset(display_levels)
+        self._keep = self._compile(self.classifications, self.display_levels)
+
+    @staticmethod
+    def _compile(classifications, display_levels):
+        """
+        Returns a function telling from an attribute's metadata if that attribute is retained
+        """
+        if classifications is None and display_levels is None:
+            return lambda metadata: True
+        elif display_levels is None:
+            return lambda metadata: metadata["classification"] in classifications
+        elif classifications is None:
+            return lambda metadata: metadata["display"] in display_levels
+        return lambda metadata: (
+            metadata["classification"] in classifications and metadata["display"] in display_levels
+        )
+
+    def apply(self, profile):
+        """
+        Filters @profile in a single pass, without modifying it
+        @profile dict a user profile (or attribute group, such as `access_information`)
+        Return dict the retained attributes. These are shared with @profile, not copied.
+        """
+        keep = self._keep
+        projected = {}
+        for attr, value in profile.items():
+            if isinstance(value, dict) and not attr.startswith("_"):
+                if "metadata" not in value:
+                    value = self.apply(value)
+                elif not keep(value["metadata"]):
+                    continue
+            projected[attr] = value
+        return projected
+
+
+@functools.lru_cache(maxsize=64)
+def _get_projection(classifications, display_levels):
+    return Projection(classifications, display_levels)
+
+
+def get_projection(classifications=None, display_levels=None):
+    """
+    Returns the process-wide Projection retaining attributes whose classification is in @classifications and display
+    level is in @display_levels, creating it if needed
+    @classifications iterable of str (e.g. MozillaDataClassification.PUBLIC), or None to retain all classifications
+    @display_levels iterable of str (e.g. [DisplayLevel.PUBLIC, DisplayLevel.NULL]), or None to retain all display
+    levels
+    """
+    if classifications is not None:
+        classifications = frozenset(classifications)
+    if display_levels is not None:
+        display_levels = frozenset(display_levels)
+    return _get_projection(classifications, display_levels)
+
+
+class ProfileView(object):
+    """
+    A read-only (apart from filtering) view of a user profile.
+    It does not validate, sign or verify anything: use cis_profile.User for that.
+    """
+
+    def __init__(self, profile_json):
+        """
+        @profile_json str a JSON user profile as stored in the identity vault, or an already parsed dict (which the
+        view takes ownership of, as filtering modifies it). Sparse profiles are rehydrated, see cis_profile.sparse.
+        """
+        if isinstance(profile_json, (str, bytes)):
+            profile_json = json.loads(profile_json)
+        if is_sparse(profile_json):
+            profile_json = rehydrate(profile_json)
+        self._profile = profile_json
+
+    @property
+    def active(self):
+        """
+        Return bool the value of the `active` attribute
+        """
+        return self._profile["active"]["value"]
+
+    def filter_scopes(self, scopes=MozillaDataClassification.PUBLIC):
+        """
+        Filter the view to only contain attributes with scopes listed in @scopes
+        @scopes list of str
+        """
+        filter_attributes(level=self._profile, valid=scopes, check="classification")
+
+    def filter_display(self, display_levels=[DisplayLevel.PUBLIC, DisplayLevel.NULL]):
+        """
+        Filter the view to only contain attributes with display levels listed in @display_levels
+        @display_levels list of str
+        """
+        filter_attributes(level=self._profile, valid=display_levels, check="display")
+
+    def project(self, classifications=None, display_levels=None):
+        """
+        Outputs a filtered dict version of this profile, without filtering the view itself (see get_projection())
+        @classifications iterable of str, or None to retain all classifications
+        @display_levels iterable of str, or None to retain all display levels
+        """
+        return get_projection(classifications, display_levels).apply(self._profile)
+
+    def as_dict(self):
+        """
+        Outputs a dict version of this profile. This is not a copy.
+        """
+        return self._profile
+
+    def as_json(self):
+        """
+        Outputs a JSON version of this profile
+        """
+        return json.dumps(self._profile)
@@ -1,4 +1,7 @@
+import json
+
 from cis_profile.common import DotDict
+from cis_profile.common import loads_dotdict
 
 
 class TestDotDict(object):
@@ -9,3 +12,25 @@ class TestDotDict(object):
     def test_dotdict_sublevel(self):
         x = DotDict({"test": {"sub": {"test"}}})
         print(x.test.sub)
+
+    def test_dotdict_has_no_instance_dict(self):
+        x = DotDict({"test": {"sub": [{"value": 1}]}})
+        assert not hasattr(x, "__dict__")
+        assert isinstance(x.test.sub[0], DotDict)
+        x.other = {"value": 2}
+        assert x["other"].value == 2
+
+    def test_loads_dotdict(self):
+        doc = {"test": {"sub": [{"value": 1}, "string"], "metadata": {"classification": "PUBLIC"}}}
+        x = loads_dotdict(json.dumps(doc))
+        assert x == doc
+        assert x == DotDict(doc)
+        assert isinstance(x.test, DotDict)
+        assert isinstance(x.test.sub[0], DotDict)
+        assert x.test.metadata.classification == "PUBLIC"
+
+    def test_only_enumerated_values_interned(self):
+        doc = json.dumps({"metadata": {"classification": "PUBLIC"}, "values": {"name": "user controlled value"}})
+        x, y = loads_dotdict(doc), loads_dotdict(doc)
+        assert x.metadata.classification is y.metadata.classification
+        assert x["values"]["name"] is not y["values"]["name"]
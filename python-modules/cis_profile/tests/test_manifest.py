@@ -0,0 +1,99 @@
+from cis_profile import profile
+from cis_profile import manifest
+from cis_profile.fake_profile import FakeUser
+
+import cis_crypto.operation
+import cis_profile.exceptions
+import json
+import os
+import pytest
+
+
+PUBLISHERS = ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]
+
+
+class TestManifest(object):
+    def setup(self):
+        os.environ["CIS_CONFIG_INI"] = "tests/fixture/mozilla-cis.ini"
+        self.user = profile.User(user_id="test")
+        self.user.first_name.value = "Test"
+        self.user.access_information.ldap.values = {"test_group": None, "test_group_2": None}
+
+    def test_attribute_digest(self):
+        attr = self.user.first_name
+        digest = manifest.attribute_digest(attr)
+        attr.signature.publisher.value = "ignored"
+        assert manifest.attribute_digest(attr) == digest
+        attr.value = "Changed"
+        assert manifest.attribute_digest(attr) != digest
+
+    def test_sign_verify_manifests(self):
+        manifests = {publisher: self.user.sign_manifest(publisher) for publisher in PUBLISHERS}
+        assert self.user.verify_manifests(manifests, fallback=False) is True
+
+        # Other publishers attributes are not in the manifest
+        manifests["mozilliansorg"] = manifests["ldap"]
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            self.user.verify_manifests(manifests)
+
+    def test_manifest_modified_attribute(self):
+        manifests = {publisher: self.user.sign_manifest(publisher) for publisher in PUBLISHERS}
+        self.user.access_information.ldap.values = {"test_group": None}
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            self.user.verify_manifests(manifests)
+        # Only verifying other attributes
+        assert self.user.verify_manifests(manifests, attribute_names=["first_name"]) is True
+
+    def test_manifest_fallback(self):
+        # Attributes signed the per-attribute way, and not yet in a manifest
+        for publisher in PUBLISHERS:
+            self.user.sign_all(publisher_name=publisher, safety=False)
+        manifests = {"ldap": self.user.sign_manifest("ldap")}
+        self.user.first_name.value = "Added later"
+        self.user.sign_attribute("first_name", self.user.first_name.signature.publisher.name)
+
+        assert self.user.verify_manifests(manifests) is True
+        assert self.user.verify_manifests({}) is True
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            self.user.verify_manifests(manifests, fallback=False)
+
+        self.user.first_name.value = "Not signed"
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            self.user.verify_manifests(manifests)
+
+    def test_manifest_benchmark(self):
+        import time
+
+        u = profile.User(user_structure_json=FakeUser(seed=1337).as_json())
+        cache = cis_crypto.operation.get_verified_signature_cache()
+
+        start = time.time()
+        for publisher in PUBLISHERS:
+            u.sign_all(publisher_name=publisher, safety=False)
+        taken_sign = time.time() - start
+        start = time.time()
+        for _ in range(10):
+            cache.clear()
+            u.verify_all_signatures()
+        taken_verify = (time.time() - start) / 10
+        size = len(u.as_json())
+
+        start = time.time()
+        manifests = {publisher: u.sign_manifest(publisher) for publisher in PUBLISHERS}
+        taken_manifest_sign = time.time() - start
+        start = time.time()
+        for _ in range(10):
+            cache.clear()
+            u.verify_manifests(manifests, fallback=False)
+        taken_manifest_verify = (time.time() - start) / 10
+        for _, attr in u._attributes_with_value():
+            attr["signature"]["publisher"]["value"] = ""
+        manifest_size = len(u.as_json()) + len(json.dumps(manifests))
+
+        print(
+            "test_manifest_benchmark() per-attribute signatures: {}s to sign, {}s to verify, {} bytes. Manifests: {}s "
+            "to sign, {}s to verify, {} bytes".format(
+                taken_sign, taken_verify, size, taken_manifest_sign, taken_manifest_verify, manifest_size
+            )
+        )
+        assert manifest_size < size
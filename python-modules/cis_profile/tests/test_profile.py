@@ -1,9 +1,12 @@
 from cis_profile import profile
 from cis_profile.common import MozillaDataClassification
 from cis_profile.common import DisplayLevel
+from cis_profile.common import DotDict
+from cis_profile.fake_profile import FakeUser
 
 import mock
 import copy
+import cis_crypto.operation
 import cis_profile.exceptions
 import pytest
 import os
@@ -45,6 +48,72 @@ class TestProfile(object):
         assert u is not None
         assert ddb is not None
 
+    def test_user_init_from_template_is_a_copy(self):
+        u = profile.User()
+        u.user_id.value = "test"
+        u.access_information.ldap.values = {"test": None}
+        u.usernames.metadata.classification = "test"
+        u2 = profile.User()
+        assert u2.user_id.value is None
+        assert u2.access_information.ldap["values"] is None
+        assert u2.usernames.metadata.classification != "test"
+        assert isinstance(u2.user_id.metadata, DotDict)
+
+    def test_user_clone(self):
+        u = FakeUser(seed=1337)
+        original = json.loads(u.as_json())
+        c = u.clone()
+        assert c.as_dict() == u.as_dict()
+        assert isinstance(c, FakeUser)
+
+        # Changes to the clone do not change the original user
+        c.user_id.value = "test"
+        c.access_information.ldap["values"] = {"test": None}
+        c.update_timestamp("staff_information.title")
+        c.sign_attribute("primary_email", publisher_name="ldap")
+        c.__dict__["last_name"]["value"] = "test"
+        c.as_dict()["fun_title"]["value"] = "test"
+        c.filter_scopes(MozillaDataClassification.PUBLIC)
+        assert json.loads(u.as_json()) == original
+
+        # ...and the other way around
+        c = u.clone()
+        u.first_name.value = "test"
+        u.identities.github_id_v3.metadata.display = DisplayLevel.STAFF
+        u.initialize_timestamps()
+        assert c.first_name.value == original["first_name"]["value"]
+        github_id_v3 = original["identities"]["github_id_v3"]
+        assert c.identities.github_id_v3.metadata.display == github_id_v3["metadata"]["display"]
+        assert c.last_modified.value == original["last_modified"]["value"]
+
+    def test_user_clone_merge(self):
+        u = FakeUser(seed=1337)
+        original = json.loads(u.as_json())
+        patch = profile.User()
+        patch.last_name.value = "test"
+        patch.last_name.signature.publisher.name = "mozilliansorg"
+        patch.access_information.ldap["values"] = {"test": None}
+
+        c = u.clone()
+        assert sorted(c.merge(patch)) == ["last_name", "ldap"]
+        assert c.last_name.value == "test"
+        assert c.access_information.ldap["values"] == {"test": None}
+        assert json.loads(u.as_json()) == original
+
+    def test_user_init_benchmark(self):
+        import time
+
+        profile.User()
+        start = time.time()
+        for _ in range(100):
+            profile.User()
+        taken = (time.time() - start) / 100
+        print(
+            "test_user_init_benchmark() has taken {} seconds per User() or {} User() per second".format(
+                taken, 1 / taken
+            )
+        )
+
     def test_filter_scopes(self):
         u = profile.User()
         # Make sure a value is non-public
@@ -167,6 +236,90 @@ class TestProfile(object):
         ret = u.verify_all_signatures()
         assert ret is True
 
+    def test_full_profile_signing_parallel_verification(self):
+        users = []
+        for user_id in ["test", "test2", "test3"]:
+            u = profile.User(user_id=user_id)
+            u.access_information.ldap.values = {"test_group": None, "test_group_2": None}
+            for _ in ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]:
+                u.sign_all(publisher_name=_, safety=False)
+            assert u.verify_all_signatures(workers=4) is True
+            users.append(u)
+        assert profile.verify_users_signatures(users, workers=4) is True
+
+        # Modified after signing
+        users[1].access_information.ldap.values = {"test_group": None}
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            users[1].verify_all_signatures(workers=4)
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            profile.verify_users_signatures(users, workers=4)
+
+    def test_full_profile_detached_signatures(self):
+        u = profile.User(user_structure_json=FakeUser(seed=1337).as_json())
+        for _ in ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]:
+            u.sign_all(publisher_name=_, safety=False)
+        size = len(u.as_json())
+
+        with mock.patch.dict(os.environ, {"CIS_JWS_DETACHED_PAYLOAD": "true"}):
+            u = profile.User(user_structure_json=FakeUser(seed=1337).as_json())
+            for _ in ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]:
+                u.sign_all(publisher_name=_, safety=False)
+        assert cis_crypto.operation.is_detached(u.first_name.signature.publisher.value)
+        assert u.verify_all_signatures() is True
+        print(
+            "test_full_profile_detached_signatures() profile is {} bytes, {} bytes with detached signatures".format(
+                size, len(u.as_json())
+            )
+        )
+        assert len(u.as_json()) < size
+
+        u.first_name.value = "Modified after signing"
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            u.verify_all_signatures()
+
+    def test_changed_attributes_verification(self):
+        u = profile.User(user_id="test")
+        patch = profile.User()
+        patch.first_name.value = "Test"
+        patch.access_information.ldap.values = {"test_group": None}
+        for _ in ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]:
+            u.sign_all(publisher_name=_, safety=False)
+            patch.sign_all(publisher_name=_, safety=False)
+        difference = u.merge(patch)
+        assert sorted(difference) == ["first_name", "ldap"]
+
+        # Modified after signing, but not part of the merge
+        u.user_id.value = "not test"
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            u.verify_all_signatures()
+        for workers in [None, 4]:
+            assert u.verify_all_signatures(workers=workers, attribute_names=difference) is True
+        assert [name for name, _ in u._attributes_with_value(difference)] == [
+            "first_name",
+            "access_information.ldap",
+        ]
+        assert len(u._attributes_with_value(["access_information"])) == 1
+        with pytest.raises(cis_profile.exceptions.SignatureVerificationFailure):
+            u.verify_all_signatures(attribute_names=difference + ["user_id"])
+
+    def test_changed_attributes_publishers(self):
+        old_user = profile.User()
+        old_user.active.value = True
+        u = profile.User(user_id="test")
+        u.active.value = True
+        u.first_name.value = "Test"
+        u.first_name.signature.publisher.name = "mozilliansorg"
+        u.access_information.ldap.values = {"test_group": None}
+        u.access_information.ldap.signature.publisher.name = "ldap"
+        # mozilliansorg is not allowed to create user_id, but it is not listed as changed
+        u.user_id.signature.publisher.name = "mozilliansorg"
+        assert u.verify_all_publishers(old_user, attribute_names=["first_name", "ldap"]) is True
+        with pytest.raises(cis_profile.exceptions.PublisherVerificationFailure):
+            u.verify_all_publishers(old_user, attribute_names=["first_name", "user_id"])
+        u.access_information.ldap.signature.publisher.name = "mozilliansorg"
+        with pytest.raises(cis_profile.exceptions.PublisherVerificationFailure):
+            u.verify_all_publishers(old_user, attribute_names=["first_name", "ldap"])
+
     def test_single_attribute_signing_verification(self):
         u = profile.User(user_id="test")
         u.sign_attribute("user_id", publisher_name="ldap")
@@ -266,3 +419,33 @@ class TestProfile(object):
         a.phone_numbers['values'] = {"foo": ""}
         ddb = a.as_dynamo_flat_dict()
         assert ddb["user_id"] is not None
+
+    def test_dynamo_flat_dict_forms(self):
+        from boto3.dynamodb.types import TypeDeserializer
+
+        deserializer = TypeDeserializer()
+        a = FakeUser(seed=1337)
+        a.phone_numbers["values"] = {"foo": "", "bar": "+1 555 555 5555"}
+        ddb = a.as_dynamo_flat_dict()
+        plain = a.as_dynamo_flat_dict(low_level=False)
+        assert {k: deserializer.deserialize(v) for k, v in ddb.items()} == plain
+        assert plain["phone_numbers"] == {"bar": "+1 555 555 5555"}
+        assert plain["user_id"] == a.user_id.value
+        assert ddb["user_id"] == {"S": a.user_id.value}
+        assert not _is_or_contains_empty_str(plain)
+
+    def test_dynamo_flat_dict_benchmark(self):
+        import time
+
+        # Bulk writes of 10k profiles, out of 100 different fake profiles
+        users = [FakeUser(seed=seed) for seed in range(100)]
+        for low_level in [True, False]:
+            start = time.time()
+            for _ in range(100):
+                for u in users:
+                    u.as_dynamo_flat_dict(low_level=low_level)
+            taken = time.time() - start
+            print(
+                "test_dynamo_flat_dict_benchmark() has taken {} seconds to flatten 10000 profiles (low_level={}), or "
+                "{} profiles per second".format(taken, low_level, 10000 / taken)
+            )
@@ -0,0 +1,43 @@
+import copy
+import json
+import pytest
+import time
+
+from cis_profile import fake_profile
+from cis_profile import publisher_rules
+
+
+class TestPublisherRules(object):
+    def setup(self):
+        self.rules_json = json.load(open("cis_profile/data/well-known/mozilla-iam-publisher-rules"))
+
+    def test_allowed(self):
+        rules = publisher_rules.PublisherRules(self.rules_json)
+        assert rules.allowed("user_id", "create") == frozenset(["ldap", "hris", "access_provider"])
+        assert rules.allowed("user_id", "update") == frozenset(["access_provider"])
+        # Second level attributes with their own rules
+        assert rules.allowed("ldap", "create", parent_name="access_information") == frozenset(["ldap"])
+        assert rules.allowed("hris", "update", parent_name="access_information") == frozenset(["hris"])
+        # Second level attributes sharing the rule of their parent
+        assert rules.allowed("github_id_v3", "update", parent_name="identities") == frozenset(["mozilliansorg"])
+        assert rules.allowed("title", "update", parent_name="staff_information") == frozenset(["hris"])
+        with pytest.raises(KeyError):
+            rules.allowed("not_an_attribute", "create")
+
+    def test_rules_are_shared(self):
+        rules = publisher_rules.get_publisher_rules(self.rules_json)
+        assert publisher_rules.get_publisher_rules(self.rules_json) is rules
+        assert publisher_rules.get_publisher_rules(json.loads(json.dumps(self.rules_json))) is rules
+
+    def test_verify_all_publishers_benchmark(self):
+        previous_user = fake_profile.FakeUser(seed=1337)
+        u = copy.deepcopy(previous_user)
+        u.first_name.value = "updated"
+        u.first_name.signature.publisher.name = "mozilliansorg"
+        assert u.verify_all_publishers(previous_user) is True
+
+        start = time.time()
+        for _ in range(100):
+            u.verify_all_publishers(previous_user)
+        taken = (time.time() - start) / 100
+        print("test_verify_all_publishers_benchmark() takes {} seconds per profile".format(taken))
@@ -0,0 +1,87 @@
+from cis_profile import profile
+from cis_profile import sparse
+from cis_profile.fake_profile import FakeUser
+from cis_profile.view import ProfileView
+
+import json
+import os
+
+
+class TestSparse(object):
+    def setup(self):
+        os.environ["CIS_CONFIG_INI"] = "tests/fixture/mozilla-cis.ini"
+        self.user = profile.User(user_id="test")
+        self.user.first_name.value = "Test"
+        self.user.access_information.ldap.values = {"test_group": None}
+
+    def test_sparsify(self):
+        sparse_profile = sparse.sparsify(self.user.as_dict())
+        assert sparse.is_sparse(sparse_profile)
+        assert sorted(k for k in sparse_profile.keys() if k != sparse.SPARSE_KEY) == [
+            "access_information",
+            "first_name",
+            "schema",
+            "user_id",
+        ]
+        assert list(sparse_profile["access_information"].keys()) == ["ldap"]
+        assert not sparse.is_sparse(self.user.as_dict())
+
+    def test_rehydrate(self):
+        full = self.user.as_dict()
+        sparse_profile = json.loads(json.dumps(sparse.sparsify(full)))
+        rehydrated = sparse.rehydrate(sparse_profile)
+        assert rehydrated == json.loads(json.dumps(full))
+        assert list(rehydrated.keys()) == list(full.keys())
+        # Rehydrated attributes are copies of the template
+        rehydrated["fun_title"]["value"] = "Changed"
+        assert sparse.null_template()["fun_title"]["value"] is None
+
+    def test_user_loads_sparse(self):
+        full = json.loads(self.user.as_json())
+        sparse_json = self.user.as_sparse_json()
+        assert len(sparse_json) < len(self.user.as_json()) / 4
+
+        u = profile.User(user_structure_json=sparse_json)
+        assert json.loads(u.as_json()) == full
+        u.fun_title.value = "Attribute access works"
+        assert u.fun_title.metadata.classification == "WORKGROUP CONFIDENTIAL"
+
+        u = profile.User(user_structure_json=json.loads(sparse_json))
+        assert json.loads(u.as_json()) == full
+
+    def test_view_loads_sparse(self):
+        view = ProfileView(self.user.as_sparse_json())
+        assert view.as_dict() == json.loads(self.user.as_json())
+
+    def test_sparse_signatures(self):
+        for publisher in ["ldap", "access_provider", "cis", "hris", "mozilliansorg"]:
+            self.user.sign_all(publisher_name=publisher, safety=False)
+        u = profile.User(user_structure_json=self.user.as_sparse_json())
+        assert u.verify_all_signatures() is True
+
+    def test_sparse_benchmark(self):
+        import time
+
+        fake_user = FakeUser(seed=1337)
+        full_json = fake_user.as_json()
+        sparse_json = profile.User(user_structure_json=full_json).as_sparse_json()
+
+        null_user = profile.User(user_id="ad|test")
+        null_full_json = null_user.as_json()
+        null_sparse_json = null_user.as_sparse_json()
+
+        timings = {}
+        for name, profile_json in [("full", null_full_json), ("sparse", null_sparse_json)]:
+            start = time.time()
+            for _ in range(100):
+                ProfileView(profile_json).as_dict()
+            timings[name] = (time.time() - start) / 100
+
+        print(
+            "test_sparse_benchmark() fake profile: {} bytes, {} sparse. Mostly null profile: {} bytes, {} sparse, "
+            "view load time {}".format(
+                len(full_json), len(sparse_json), len(null_full_json), len(null_sparse_json), timings
+            )
+        )
+        assert len(sparse_json) <= len(full_json) + len(sparse.SPARSE_KEY) + 8
+        assert len(null_sparse_json) < len(null_full_json) / 4
@@ -0,0 +1,82 @@
+import copy
+import json
+import jsonschema
+import pytest
+import time
+
+from cis_profile import fake_profile
+from cis_profile import validator
+
+
+class TestValidator(object):
+    def setup(self):
+        self.schema = json.load(open("cis_profile/data/profile.schema"))
+        self.profiles = [fake_profile.FakeUser(seed=x).as_dict() for x in range(5)]
+        self.profiles.append(json.load(open("cis_profile/data/user_profile_null.json")))
+
+    def test_compiled_matches_jsonschema(self):
+        v = validator.get_validator(self.schema)
+        assert v._check is not None
+        reference = jsonschema.Draft4Validator(self.schema)
+
+        invalid = copy.deepcopy(self.profiles[0])
+        invalid["user_id"]["metadata"]["display"] = "not a display level"
+        invalid_type = copy.deepcopy(self.profiles[0])
+        invalid_type["active"]["value"] = "true"
+        invalid_additional = copy.deepcopy(self.profiles[0])
+        invalid_additional["not_an_attribute"] = {}
+        invalid_required = copy.deepcopy(self.profiles[0])
+        del invalid_required["user_id"]["metadata"]
+
+        for p in self.profiles:
+            assert v.is_valid(p) is True
+            assert reference.is_valid(p) is True
+            v.validate(p)
+        for p in [invalid, invalid_type, invalid_additional, invalid_required]:
+            assert v.is_valid(p) is False
+            assert reference.is_valid(p) is False
+            with pytest.raises(jsonschema.exceptions.ValidationError):
+                v.validate(p)
+
+    def test_uncompilable_schema_fallback(self):
+        schema = {"$schema": "http://json-schema.org/draft-04/schema#", "type": "object", "maxProperties": 1}
+        v = validator.ProfileValidator(schema)
+        assert v._check is None
+        assert v.is_valid({"a": 1}) is True
+        with pytest.raises(jsonschema.exceptions.ValidationError):
+            v.validate({"a": 1, "b": 2})
+
+    def test_compiled_check_refusal_falls_back(self):
+        v = validator.ProfileValidator(self.schema)
+        v._check = lambda profile: False
+        for p in self.profiles:
+            assert v.is_valid(p) is True
+            v.validate(p)
+
+    def test_validator_is_shared(self):
+        v = validator.get_validator(self.schema)
+        assert validator.get_validator(self.schema) is v
+        # Same schema content, different object
+        assert validator.get_validator(copy.deepcopy(self.schema)) is v
+
+    def test_validate_benchmark(self):
+        rounds = 10
+        count = rounds * len(self.profiles)
+
+        start = time.time()
+        for _ in range(rounds):
+            for p in self.profiles:
+                jsonschema.validate(p, self.schema)
+        taken_jsonschema = time.time() - start
+
+        start = time.time()
+        for _ in range(rounds):
+            for p in self.profiles:
+                validator.validate(p, self.schema)
+        taken_compiled = time.time() - start
+
+        print(
+            "test_validate_benchmark(): jsonschema.validate() {} profiles/s, compiled validator {} profiles/s".format(
+                count / taken_jsonschema, count / taken_compiled
+            )
+        )
@@ -0,0 +1,95 @@
+from cis_profile import profile
+from cis_profile.common import MozillaDataClassification
+from cis_profile.common import DisplayLevel
+from cis_profile.fake_profile import FakeUser
+from cis_profile.view import ProfileView
+from cis_profile.view import get_projection
+
+import json
+import os
+
+
+class TestProfileView(object):
+    def setup(self):
+        os.environ["CIS_CONFIG_INI"] = "tests/fixture/mozilla-cis.ini"
+        self.profile_json = FakeUser(seed=1337).as_json()
+
+    def test_view_from_json(self):
+        view = ProfileView(self.profile_json)
+        assert view.as_dict() == json.loads(self.profile_json)
+        assert json.loads(view.as_json()) == json.loads(self.profile_json)
+        assert view.active == json.loads(self.profile_json)["active"]["value"]
+
+    def test_view_filters_like_user(self):
+        scopes = MozillaDataClassification.PUBLIC + MozillaDataClassification.WORKGROUP_CONFIDENTIAL
+        display_levels = [DisplayLevel.PUBLIC, DisplayLevel.AUTHENTICATED, DisplayLevel.NULL]
+
+        u = profile.User(user_structure_json=self.profile_json)
+        u.filter_scopes(scopes)
+        u.filter_display(display_levels)
+
+        view = ProfileView(self.profile_json)
+        view.filter_scopes(scopes)
+        view.filter_display(display_levels)
+
+        assert view.as_dict() == u.as_dict()
+        assert view.as_dict() != json.loads(self.profile_json)
+
+    def test_projection_matches_filters(self):
+        scopes = MozillaDataClassification.PUBLIC + MozillaDataClassification.MOZILLA_CONFIDENTIAL
+        display_levels = [DisplayLevel.PUBLIC, DisplayLevel.STAFF, DisplayLevel.NULL]
+        source = json.loads(self.profile_json)
+
+        for classifications, levels in [(scopes, display_levels), (scopes, None), (None, display_levels)]:
+            view = ProfileView(self.profile_json)
+            if classifications is not None:
+                view.filter_scopes(classifications)
+            if levels is not None:
+                view.filter_display(levels)
+            projected = get_projection(classifications, levels).apply(source)
+            assert projected == view.as_dict()
+
+        assert get_projection().apply(source) == source
+        # The source profile is not modified
+        assert source == json.loads(self.profile_json)
+
+    def test_projection_is_shared(self):
+        assert get_projection(["PUBLIC"], ["public", None]) is get_projection(("PUBLIC",), [None, "public"])
+        assert get_projection(["PUBLIC"]) is not get_projection(["PUBLIC"], ["public"])
+
+    def test_view_project(self):
+        view = ProfileView(self.profile_json)
+        projected = view.project(MozillaDataClassification.PUBLIC, [DisplayLevel.PUBLIC])
+        assert projected != view.as_dict()
+        assert view.as_dict() == json.loads(self.profile_json)
+
+    def test_view_benchmark(self):
+        import time
+
+        start = time.time()
+        for _ in range(100):
+            u = profile.User(user_structure_json=self.profile_json)
+            u.filter_scopes(MozillaDataClassification.PUBLIC)
+            u.as_dict()
+        taken_user = (time.time() - start) / 100
+
+        start = time.time()
+        for _ in range(100):
+            view = ProfileView(self.profile_json)
+            view.filter_scopes(MozillaDataClassification.PUBLIC)
+            view.as_dict()
+        taken_view = (time.time() - start) / 100
+
+        source = json.loads(self.profile_json)
+        projection = get_projection(MozillaDataClassification.PUBLIC)
+        start = time.time()
+        for _ in range(100):
+            projection.apply(source)
+        taken_projection = (time.time() - start) / 100
+
+        print(
+            "test_view_benchmark() has taken {} seconds per profile with User(), {} seconds per profile with "
+            "ProfileView() and {} seconds per already parsed profile with a projection".format(
+                taken_user, taken_view, taken_projection
+            )
+        )
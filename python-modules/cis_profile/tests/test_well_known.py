@@ -1,6 +1,11 @@
 from cis_profile.common import WellKnown
+from cis_profile.common import get_shared_well_known
+from cis_profile.common import reset_shared_well_known
 from cis_profile.profile import User
+import mock
 import os
+import threading
+import time
 
 
 class Test_WellKnown(object):
@@ -31,3 +36,107 @@ class Test_WellKnown(object):
         os.environ["CIS_DISCOVERY_URL"] = "https://auth.allizom.org/.well-known/mozilla-iam"
         u = User()
         assert u._User__well_known.discovery_url == "https://auth.allizom.org/.well-known/mozilla-iam"
+
+    def test_shared_wellknown(self):
+        reset_shared_well_known()
+        wk = get_shared_well_known("https://auth.allizom.org/.well-known/mozilla-iam")
+        assert wk is get_shared_well_known("https://auth.allizom.org/.well-known/mozilla-iam")
+        assert wk is not get_shared_well_known("https://auth.mozilla.com/.well-known/mozilla-iam")
+        assert wk is not get_shared_well_known(
+            "https://auth.allizom.org/.well-known/mozilla-iam", always_use_local_file=True
+        )
+
+    def test_wellknown_memory_cache_single_fetch(self, tmpdir):
+        wk = WellKnown("https://wellknown.test/.well-known/mozilla-iam")
+        wk._request_cache = str(tmpdir.join("cache"))
+        calls = []
+        results = []
+
+        def slow_fetch(url, entry=None):
+            calls.append(url)
+            time.sleep(0.1)
+            return {"fetched_at": time.time(), "etag": None, "last_modified": None, "data": {"api": {}}}
+
+        with mock.patch.object(wk, "_fetch", side_effect=slow_fetch):
+            threads = [threading.Thread(target=lambda: results.append(wk.get_well_known())) for _ in range(10)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            assert len(results) == 10
+            assert all(r == {"api": {}} for r in results)
+            assert len(calls) == 1
+
+            # An expired memory cache goes back to the (fresh) disk cache, not to the network
+            wk.expire()
+            assert wk.get_well_known() == {"api": {}}
+            assert len(calls) == 1
+
+    def test_wellknown_disk_cache(self, tmpdir):
+        wk = WellKnown("https://wellknown.test/.well-known/mozilla-iam")
+        wk._request_cache = str(tmpdir.join("cache"))
+        with mock.patch("requests.get") as mock_get:
+            mock_get.return_value = FakeResponse({"api": {"disk": True}}, headers={"ETag": '"v1"'})
+            assert wk.get_well_known() == {"api": {"disk": True}}
+
+        # Another process/object with the same cache does not need the network
+        wk2 = WellKnown("https://wellknown.test/.well-known/mozilla-iam")
+        wk2._request_cache = wk._request_cache
+        with mock.patch("requests.get", side_effect=Exception("should be cached")):
+            assert wk2.get_well_known() == {"api": {"disk": True}}
+
+    def test_wellknown_stale_while_revalidate(self, tmpdir):
+        wk = WellKnown("https://wellknown.test/.well-known/mozilla-iam")
+        wk._request_cache = str(tmpdir.join("cache"))
+        url = wk.discovery_url
+        entry = {"fetched_at": 0, "etag": '"v1"', "last_modified": None, "data": {"api": {"stale": True}}}
+        wk._write_cache_file("well_known", url, entry)
+
+        with mock.patch("requests.get") as mock_get:
+            mock_get.return_value = FakeResponse(None, status_code=304, headers={"ETag": '"v1"'})
+            # Stale data is served right away
+            assert wk.get_well_known() == {"api": {"stale": True}}
+            while wk._revalidating:
+                time.sleep(0.01)
+            assert mock_get.call_args[1]["headers"]["If-None-Match"] == '"v1"'
+
+        # The 304 refreshed the cached file
+        assert wk._read_cache_file("well_known", url)["fetched_at"] > 0
+
+        entry["fetched_at"] = 0
+        wk._write_cache_file("well_known", url, entry)
+        wk.expire()
+        with mock.patch("requests.get") as mock_get:
+            mock_get.return_value = FakeResponse({"api": {"stale": False}}, headers={"ETag": '"v2"'})
+            assert wk.get_well_known() == {"api": {"stale": True}}
+            while wk._revalidating:
+                time.sleep(0.01)
+        assert wk.get_well_known() == {"api": {"stale": False}}
+        assert wk._read_cache_file("well_known", url)["etag"] == '"v2"'
+
+    def test_wellknown_bundle(self):
+        wk = WellKnown(always_use_local_file=True)
+        with mock.patch("requests.get", side_effect=Exception("bundle mode must not use the network")):
+            assert isinstance(wk.get_well_known().get("api"), dict)
+            assert isinstance(wk.get_schema(), dict)
+            assert isinstance(wk.get_publisher_rules().get("create"), dict)
+
+    def test_profile_well_known_injection(self):
+        wk = WellKnown(always_use_local_file=True)
+        u = User(well_known=wk)
+        assert u._User__well_known is wk
+        with mock.patch.object(wk, "_load_builtin_file", side_effect=Exception("should be cached")):
+            User(well_known=wk)
+
+
+class FakeResponse(object):
+    def __init__(self, data, status_code=200, headers={}):
+        self.data = data
+        self.status_code = status_code
+        self.headers = headers
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
@@ -2,6 +2,7 @@ import json
 import graphene
 import cis_profile.graphene
 from cis_identity_vault.models import user
+from cis_profile.view import ProfileView
 from cis_profile_retrieval_service.common import get_table_resource
 
 
@@ -33,7 +34,7 @@ class Query(graphene.ObjectType):
                     profiles.append(json.loads())
         else:
             for vault_profile in vault.all:
-                profiles.append(json.loads(vault_profile.get("profile")))
+                profiles.append(ProfileView(vault_profile.get("profile")).as_dict())
 
     def resolve_profile(self, info, **kwargs):
         """GraphQL resolver for a single profile."""
@@ -43,7 +44,7 @@ class Query(graphene.ObjectType):
         if kwargs.get("userId"):
             search = vault.find_by_id(kwargs.get("userId"))
             if len(search.get("Items")) > 0:
-                resp = search["Items"][0]["profile"]
+                resp = json.dumps(ProfileView(search["Items"][0]["profile"]).as_dict())
         else:
             resp = json.dumps({})
         return resp
@@ -18,7 +18,8 @@ import urllib.parse
 from cis_identity_vault.models import user
 from cis_profile.common import MozillaDataClassification
 from cis_profile.common import DisplayLevel
-from cis_profile.profile import User
+from cis_profile.view import ProfileView
+from cis_profile.view import get_projection
 from cis_profile_retrieval_service.common import get_config
 from cis_profile_retrieval_service.common import initialize_vault
 from cis_profile_retrieval_service.common import get_dynamodb_client
@@ -164,6 +165,32 @@ def scope_to_display_level(scopes):
     return display_levels
 
 
+def scopes_to_projection(scopes, filter_display=None):
+    """
+    Returns the profile projection for a token's @scopes and the optional filterDisplay query argument.
+    This is the same as filtering by data classification (unless the token has read:fullprofile), then by display
+    level (unless the token has display:all), then by @filter_display (if passed), in a single pass.
+    """
+    if "read:fullprofile" in scopes:
+        classifications = None
+    else:
+        classifications = scope_to_mozilla_data_classification(scopes)
+
+    if "display:all" in scopes:
+        display_levels = None
+    else:
+        display_levels = scope_to_display_level(scopes)
+
+    if filter_display is not None:
+        filter_display_levels = DisplayLevelParms.map(filter_display)
+        if display_levels is None:
+            display_levels = filter_display_levels
+        else:
+            display_levels = [level for level in display_levels if level in filter_display_levels]
+
+    return get_projection(classifications, display_levels)
+
+
 def graphql_view():
     view_func = GraphQLView.as_view(
         "graphql",
@@ -241,7 +268,7 @@ class v2UsersByAny(Resource):
         if args.get("active") is not None and args.get("active").lower() == "false":
             active = False
 
-        all_users = identity_vault.all_filtered(connection_method=args.get("connectionMethod"), active=active)
+        all_users = identity_vault.iter_filtered(connection_method=args.get("connectionMethod"), active=active)
         # Convert vault data to cis-profile-like data format
         all_users_cis = []
         for cuser in all_users:
@@ -283,32 +310,27 @@ def getUser(id, find_by):
 
     if len(result["Items"]) > 0:
         vault_profile = result["Items"][0]["profile"]
-        v2_profile = User(user_structure_json=json.loads(vault_profile))
+        v2_profile = ProfileView(vault_profile)
 
-        if v2_profile.active.value == active:
+        if v2_profile.active == active:
             if "read:fullprofile" in scopes:
                 logger.info(
                     "read:fullprofile in token not filtering based on scopes.",
                     extra={"query_args": args, "scopes": scopes},
                 )
-            else:
-                v2_profile.filter_scopes(scope_to_mozilla_data_classification(scopes))
 
             if "display:all" in scopes:
                 logger.info(
                     "display:all in token not filtering profile based on display.",
                     extra={"query_args": args, "scopes": scopes},
                 )
-            else:
-                v2_profile.filter_display(scope_to_display_level(scopes))
 
             if filter_display is not None:
                 logger.info(
                     "filter_display argument is passed, applying display level filter.", extra={"query_args": args}
                 )
-                v2_profile.filter_display(DisplayLevelParms.map(filter_display))
 
-            return jsonify(v2_profile.as_dict())
+            return jsonify(scopes_to_projection(scopes, filter_display).apply(v2_profile.as_dict()))
 
     logger.info("No user was found for the query", extra={"query_args": args, "scopes": scopes})
     return jsonify({})
@@ -359,41 +381,31 @@ class v2Users(Resource):
         else:
             active = True  # Support returning only active users by default.
 
-        for profile in result.get("Items"):
-            vault_profile = json.loads(profile.get("profile"))
-            v2_profile = User(user_structure_json=vault_profile)
-
-            # This must be a pre filtering check because mutation is real.
-            if v2_profile.active.value == active:
-                allowed_in_list = True
-            else:
-                allowed_in_list = False
+        if "read:fullprofile" in scopes:
+            # Assume someone has asked for all the data.
+            logger.info(
+                "The provided token has access to all of the data.", extra={"query_args": args, "scopes": scopes}
+            )
+        else:
+            # Assume the we are filtering falls back to public with no scopes
+            logger.info("This is a limited scoped query.", extra={"query_args": args, "scopes": scopes})
 
-            if "read:fullprofile" in scopes:
-                # Assume someone has asked for all the data.
-                logger.info(
-                    "The provided token has access to all of the data.", extra={"query_args": args, "scopes": scopes}
-                )
-                pass
-            else:
-                # Assume the we are filtering falls back to public with no scopes
-                logger.info("This is a limited scoped query.", extra={"query_args": args, "scopes": scopes})
-                v2_profile.filter_scopes(scope_to_mozilla_data_classification(scopes))
+        if "display:all" in scopes:
+            logger.info("display:all in token not filtering profile.", extra={"query_args": args, "scopes": scopes})
+        else:
+            logger.info("display filtering engaged for query.", extra={"query_args": args, "scopes": scopes})
 
-            if "display:all" in scopes:
-                logger.info("display:all in token not filtering profile.", extra={"query_args": args, "scopes": scopes})
-            else:
-                logger.info("display filtering engaged for query.", extra={"query_args": args, "scopes": scopes})
-                v2_profile.filter_display(scope_to_display_level(scopes))
+        # Compiled once for the whole page, applied to each profile without copying it
+        projection = scopes_to_projection(scopes, filter_display)
 
-            if filter_display is not None:
-                v2_profile.filter_display(DisplayLevelParms.map(filter_display))
+        for profile in result.get("Items"):
+            vault_profile = profile.get("profile")
+            v2_profile = ProfileView(vault_profile)
 
-            if allowed_in_list:
-                v2_profiles.append(v2_profile.as_dict())
+            if v2_profile.active == active:
+                v2_profiles.append(projection.apply(v2_profile.as_dict()))
             else:
                 logger.debug("Skipping adding this profile to the list of profiles because it is: {}".format(active))
-                pass
 
         response = {"Items": v2_profiles, "nextPage": next_page_token}
         return jsonify(response)
@@ -251,9 +251,7 @@ class HRISPublisher:
         if self.report is not None:
             return self.report
 
-        hris_url = self.secret_manager.secret("hris_url")
-        hris_username = self.secret_manager.secret("hris_user")
-        hris_password = self.secret_manager.secret("hris_password")
+        hris_url, hris_username, hris_password = self.secret_manager.secrets(["hris_url", "hris_user", "hris_password"])
 
         logger.info("Fetching HRIS report from {}".format(hris_url))
         params = dict(format="json")
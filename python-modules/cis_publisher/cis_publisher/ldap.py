@@ -12,7 +12,7 @@ logger = logging.getLogger(__name__)
 
 class LDAPPublisher:
     def __init__(self):
-        self.secret_manager = cis_publisher.secret.Manager()
+        self.secret_manager = cis_publisher.secret.Manager(prefetch=["bucket", "bucket_key"])
 
     def publish(self, user_ids=None):
         """
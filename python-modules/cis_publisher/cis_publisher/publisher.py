@@ -5,7 +5,7 @@ import time
 import threading
 import queue
 from urllib.parse import urlencode, quote_plus
-from cis_profile.common import WellKnown
+from cis_profile.common import get_shared_well_known
 from cis_profile import User
 from cis_publisher import secret
 from cis_publisher import common
@@ -61,9 +61,9 @@ class Publish:
         if self.__inited:
             return
         logger.info("Getting API URLs from well-known {}".format(self.__discovery_url))
-        self.secret_manager = secret.Manager()
+        self.secret_manager = secret.Manager(prefetch=["client_id", "client_secret"])
         self.config = common.get_config()
-        self.__well_known = WellKnown(self.__discovery_url)
+        self.__well_known = get_shared_well_known(self.__discovery_url)
         wk = self.__well_known.get_well_known()
         self.api_url = wk["api"]["endpoints"]
         # XXX These are not currently used